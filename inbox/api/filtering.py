@@ -357,7 +357,8 @@ def messages_or_drafts(namespace_id, drafts, subject, from_addr, to_addr,
         subqueryload(Message.messagecategories).joinedload('category',
                                                            'created_at'),
         subqueryload(Message.parts).joinedload(Part.block),
-        subqueryload(Message.events))
+        subqueryload(Message.events),
+        *Message.body_loading_options())
 
     prepared = query(db_session).params(**param_dict)
     return prepared.all()
@@ -1,7 +1,6 @@
 import arrow
 import datetime
 import calendar
-from json import JSONEncoder, dumps
 from flask import Response
 
 from inbox.models import (Message, Contact, Calendar, Event, When,
@@ -9,6 +8,7 @@ from inbox.models import (Message, Contact, Calendar, Event, When,
                           Metadata)
 from inbox.models.event import (RecurringEvent, RecurringEventOverride,
                                 InflatedEvent)
+from inbox.util.json_codec import get_codec
 from nylas.logging import get_logger
 log = get_logger()
 
@@ -398,9 +398,14 @@ class APIEncoder(object):
     """
 
     def __init__(self, namespace_public_id=None, expand=False, is_n1=False):
+        # Encode with the json module JSON columns use.
+        self.json = get_codec().module
         self.encoder_class = self._encoder_factory(namespace_public_id, expand, is_n1=is_n1)
+        self.encoder = self.encoder_class()
 
     def _encoder_factory(self, namespace_public_id, expand, is_n1=False):
+        JSONEncoder = self.json.JSONEncoder
+
         class InternalEncoder(JSONEncoder):
 
             def default(self, obj):
@@ -430,12 +435,12 @@ class APIEncoder(object):
 
         """
         if pretty:
-            return dumps(obj,
-                         sort_keys=True,
-                         indent=4,
-                         separators=(',', ': '),
-                         cls=self.encoder_class)
-        return dumps(obj, cls=self.encoder_class)
+            return self.json.dumps(obj,
+                                   sort_keys=True,
+                                   indent=4,
+                                   separators=(',', ': '),
+                                   cls=self.encoder_class)
+        return self.encoder.encode(obj)
 
     def jsonify(self, obj):
         """
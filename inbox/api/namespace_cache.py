@@ -0,0 +1,100 @@
+"""
+In-process cache of the namespaces API requests are made for.
+
+Every request looks its namespace up to authenticate, and most then load it
+again, with its account, to serve the request. Polling clients make many
+requests for the same namespace in a short time, so the namespace and a
+summary of its account are cached for API_NAMESPACE_CACHE_TTL seconds.
+
+Entries are only used while the account's version in redis is the one they
+were loaded with. Any process that updates or deletes the namespace or its
+account bumps it (see inbox.models.account), so a deleted namespace stops
+authenticating at once. If redis can't be reached, the namespace is loaded
+from the database. The TTL bounds how long changes made without the ORM
+go unnoticed. Requests which write load the namespace from the database,
+so they never act on a stale copy.
+
+"""
+import time
+from collections import namedtuple
+
+import redis
+
+from inbox.config import config
+from inbox.models import Namespace
+from inbox.models.account import get_account_version
+from inbox.models.session import global_session_scope
+from inbox.util.stats import statsd_client
+from nylas.logging import get_logger
+log = get_logger()
+
+NAMESPACE_CACHE_TTL = config.get('API_NAMESPACE_CACHE_TTL', 10)
+MAX_CACHED_NAMESPACES = 10000
+
+NamespaceSummary = namedtuple('NamespaceSummary', [
+    'id', 'public_id', 'account_id', 'provider', 'category_type',
+    'sync_state'])
+
+CachedNamespace = namedtuple('CachedNamespace', [
+    'summary', 'namespace', 'expires_at', 'version'])
+
+# Cached namespaces by public id.
+_cache = {}
+# Stands for the version of accounts whose version couldn't be read. It
+# doesn't equal any version, so entries aren't used or cached meanwhile.
+_UNKNOWN = object()
+
+
+def get_cached_namespace(public_id):
+    """
+    The cached namespace with the given public id, loading it on a miss, or
+    None if there's no such namespace. Its `namespace` is detached; merge
+    it into a session with load=False to use it without a query.
+
+    """
+    cached = _cache.get(public_id)
+    if (cached is not None and cached.expires_at > time.time() and
+            cached.version == _get_version(cached.summary.account_id)):
+        statsd_client.incr('api.namespace_cache.hits')
+        return cached
+
+    statsd_client.incr('api.namespace_cache.misses')
+    with global_session_scope() as db_session:
+        namespace = db_session.query(Namespace).filter(
+            Namespace.public_id == public_id).first()
+        if namespace is None:
+            _cache.pop(public_id, None)
+            return None
+        account = namespace.account
+        summary = NamespaceSummary(
+            id=namespace.id, public_id=namespace.public_id,
+            account_id=namespace.account_id, provider=account.provider,
+            category_type=account.category_type,
+            sync_state=account.sync_state)
+        db_session.expunge_all()
+
+    # A change committed between loading the namespace and reading the
+    # version goes unnoticed until the entry expires.
+    version = _get_version(summary.account_id)
+    if version is _UNKNOWN:
+        return CachedNamespace(summary, namespace, 0, version)
+    if len(_cache) >= MAX_CACHED_NAMESPACES:
+        _cache.clear()
+    cached = CachedNamespace(summary, namespace,
+                             time.time() + NAMESPACE_CACHE_TTL, version)
+    _cache[public_id] = cached
+    return cached
+
+
+def clear():
+    _cache.clear()
+
+
+
+def _get_version(account_id):
+    try:
+        return get_account_version(account_id)
+    except redis.RedisError:
+        log.warning('Error getting account version', account_id=account_id,
+                    exc_info=True)
+        return _UNKNOWN
@@ -6,6 +6,7 @@ import uuid
 import base64
 import gevent
 import itertools
+import redis
 from hashlib import sha256
 from datetime import datetime
 from collections import namedtuple
@@ -49,9 +50,10 @@ from inbox.contacts.search import ContactSearchClient
 from inbox.sendmail.base import (create_message_from_json, update_draft,
                                  delete_draft, create_draft_from_mime,
                                  SendMailException)
-from inbox.ignition import engine_manager
+from inbox.ignition import engine_manager, redis_txn
 from inbox.models.action_log import schedule_action
-from inbox.models.session import new_session, session_scope
+from inbox.models.session import new_session, session_scope, has_writes
+from inbox.sqlalchemy_ext.query_profile import start_profile, stop_profile
 from inbox.search.base import get_search_client, SearchBackendException, SearchStoreException
 from inbox.transactions import delta_sync
 from inbox.api.err import (err, APIException, NotFoundError, InputError,
@@ -119,6 +121,45 @@ APIFeatures = namedtuple('APIFeatures', ['optimistic_updates'])
 # API_VERSIONS list.
 API_VERSIONS = ['2016-03-07', '2016-08-09']
 
+# For this long after a client's writes, its reads go to the primary even if
+# they could go to a replica, so that it sees its writes.
+REPLICA_STICKINESS = config.get('REPLICA_STICKINESS', 30)
+RECENT_WRITE_KEY = 'api-recent-write:{}'
+
+
+def replica_read(view):
+    """ Mark a GET endpoint as able to read from a lagging replica. """
+    view.replica_read = True
+    return view
+
+
+def recently_written(namespace_id):
+    try:
+        return redis_txn.exists(RECENT_WRITE_KEY.format(namespace_id))
+    except redis.RedisError:
+        return True
+
+
+def note_write(namespace_id):
+    try:
+        redis_txn.set(RECENT_WRITE_KEY.format(namespace_id), 1,
+                      ex=REPLICA_STICKINESS)
+    except redis.RedisError:
+        log.warning('Error noting write', namespace_id=namespace_id,
+                    exc_info=True)
+
+
+def get_engine(namespace_id):
+    """ The engine for the request: a replica's, if the endpoint can read
+    from one and the client didn't write recently. """
+    view = app.view_functions.get(request.endpoint)
+    if (request.method == 'GET' and getattr(view, 'replica_read', False) and
+            engine_manager.replica_engines.get(
+                engine_manager.shard_key_for_id(namespace_id)) and
+            not recently_written(namespace_id)):
+        return engine_manager.get_replica_for_id(namespace_id)
+    return engine_manager.get_for_id(namespace_id)
+
 
 @app.before_request
 def start():
@@ -138,9 +179,22 @@ def start():
         'namespace_id': g.namespace_id,
     }
 
-    engine = engine_manager.get_for_id(g.namespace_id)
+    # Only internal deployments return profiles, which are costly to make.
+    g.profile_header = (config.get('QUERY_PROFILE_HEADER', False) and
+                        bool(request.headers.get('X-Query-Profile')))
+    if g.profile_header or config.get('QUERY_PROFILING', False):
+        start_profile(request.endpoint or 'unknown')
+
+    engine = get_engine(g.namespace_id)
     g.db_session = new_session(engine)
-    g.namespace = Namespace.get(g.namespace_id, g.db_session)
+    if (hasattr(g, 'cached_namespace') and
+            request.method not in ('POST', 'PUT', 'PATCH', 'DELETE')):
+        # Use the namespace (and account) cached by authentication, without
+        # querying for them again.
+        g.namespace = g.db_session.merge(g.cached_namespace.namespace,
+                                         load=False)
+    else:
+        g.namespace = Namespace.get(g.namespace_id, g.db_session)
 
     if not g.namespace:
         # The only way this can occur is if there used to be an account that
@@ -182,19 +236,52 @@ def before_remote_request():
         if g.namespace:
             # Logging provider here to ensure that the provider is only logged for
             # requests that modify data or are proxied to remote servers.
+            cached = getattr(g, 'cached_namespace', None)
             request.environ['log_context']['provider'] = \
-                    g.namespace.account.provider
+                    cached.summary.provider if cached \
+                    else g.namespace.account.provider
 
         # Disable validation so we can perform requests on paused accounts.
         # valid_account(g.namespace)
 
 
+def release_db_session():
+    """
+    Commit the request's changes, if any, and return its connection to the
+    pool, for endpoints which then wait for a long time. Objects loaded so
+    far are detached; g.namespace stays usable.
+
+    """
+    if g.namespace in g.db_session:
+        # Committing would expire it, and it couldn't be reloaded once
+        # detached. Flush first so that its changes are still committed.
+        g.db_session.flush()
+        g.db_session.expunge(g.namespace)
+    if has_writes(g.db_session):
+        g.db_session.commit()
+    g.db_session.close()
+
+
 @app.after_request
 def finish(response):
     if response.status_code == 200 and hasattr(g, 'db_session'):  # be cautious
-        g.db_session.commit()
+        # Read-only requests needn't commit: closing the session rolls its
+        # transaction back.
+        if (request.method in ('POST', 'PUT', 'PATCH', 'DELETE') or
+                has_writes(g.db_session)):
+            g.db_session.commit()
+        if request.method in ('POST', 'PUT', 'PATCH', 'DELETE') and \
+                engine_manager.replica_engines.get(
+                    engine_manager.shard_key_for_id(g.namespace_id)):
+            note_write(g.namespace_id)
     if hasattr(g, 'db_session'):
         g.db_session.close()
+    profile = stop_profile()
+    if profile is not None:
+        profile_header = getattr(g, 'profile_header', False)
+        profile.report(log_top=profile_header)
+        if profile_header:
+            response.headers['X-Query-Profile'] = profile.header()
     return response
 
 
@@ -285,6 +372,7 @@ def status():
 # Threads
 #
 @app.route('/threads/')
+@replica_read
 def thread_query_api():
     g.parser.add_argument('subject', type=bounded_str, location='args')
     g.parser.add_argument('to', type=bounded_str, location='args')
@@ -339,6 +427,7 @@ def thread_query_api():
 
 
 @app.route('/threads/search', methods=['GET'])
+@replica_read
 def thread_search_api():
     g.parser.add_argument('q', type=bounded_str, location='args')
     args = strict_parse_args(g.parser, request.args)
@@ -367,6 +456,7 @@ def thread_search_api():
 
 
 @app.route('/threads/search/streaming', methods=['GET'])
+@replica_read
 def thread_streaming_search_api():
     g.parser.add_argument('q', type=bounded_str, location='args')
     args = strict_parse_args(g.parser, request.args)
@@ -446,6 +536,7 @@ def thread_api_delete(public_id):
 # Messages
 ##
 @app.route('/messages/')
+@replica_read
 def message_query_api():
     g.parser.add_argument('subject', type=bounded_str, location='args')
     g.parser.add_argument('to', type=bounded_str, location='args')
@@ -498,12 +589,16 @@ def message_query_api():
         view=args['view'],
         db_session=g.db_session)
 
+    if args['view'] not in ('count', 'ids'):
+        Message.prefetch_bodies(messages)
+
     # Use a new encoder object with the expand parameter set.
     encoder = APIEncoder(g.namespace.public_id, args['view'] == 'expanded')
     return encoder.jsonify(messages)
 
 
 @app.route('/messages/search', methods=['GET'])
+@replica_read
 def message_search_api():
     g.parser.add_argument('q', type=bounded_str, location='args')
     args = strict_parse_args(g.parser, request.args)
@@ -516,6 +611,7 @@ def message_search_api():
         results = search_client.search_messages(g.db_session, args['q'],
                                                 offset=args['offset'],
                                                 limit=args['limit'])
+        Message.prefetch_bodies(results)
         return g.encoder.jsonify(results)
     except SearchBackendException as exc:
         kwargs = {}
@@ -531,6 +627,7 @@ def message_search_api():
 
 
 @app.route('/messages/search/streaming', methods=['GET'])
+@replica_read
 def message_streaming_search_api():
     g.parser.add_argument('q', type=bounded_str, location='args')
     args = strict_parse_args(g.parser, request.args)
@@ -853,6 +950,7 @@ def folder_label_delete_api(public_id):
 # Contacts
 ##
 @app.route('/contacts/', methods=['GET'])
+@replica_read
 def contact_api():
     g.parser.add_argument('filter', type=bounded_str, default='',
                           location='args')
@@ -918,6 +1016,7 @@ def contact_read_api(public_id):
 # Events
 ##
 @app.route('/events/', methods=['GET'])
+@replica_read
 def event_api():
     g.parser.add_argument('event_id', type=valid_public_id, location='args')
     g.parser.add_argument('calendar_id', type=valid_public_id, location='args')
@@ -1259,6 +1358,7 @@ def event_rsvp_api():
 # Files
 #
 @app.route('/files/', methods=['GET'])
+@replica_read
 def files_api():
     g.parser.add_argument('filename', type=bounded_str, location='args')
     g.parser.add_argument('message_id', type=valid_public_id, location='args')
@@ -1521,6 +1621,9 @@ def draft_query_api():
         view=args['view'],
         db_session=g.db_session)
 
+    if args['view'] not in ('count', 'ids'):
+        Message.prefetch_bodies(drafts)
+
     return g.encoder.jsonify(drafts)
 
 
@@ -1814,8 +1917,7 @@ def sync_deltas():
             raise InputError('Invalid cursor parameter')
 
     # The client wants us to wait until there are changes
-    g.db_session.expunge(g.namespace)
-    g.db_session.close()  # hack to close the flask session
+    release_db_session()
     poll_interval = LONG_POLL_POLL_INTERVAL
 
     start_time = time.time()
@@ -1937,10 +2039,9 @@ def stream_changes():
             raise InputError('Invalid cursor {}'.format(args['cursor']))
         transaction_pointer = query_result[0]
 
-    # Hack to not keep a database session open for the entire (long) request
+    # Don't keep a database connection for the entire (long) request
     # duration.
-    g.db_session.expunge(g.namespace)
-    g.db_session.close()
+    release_db_session()
 
     poll_interval = config.get('STREAMING_API_POLL_INTERVAL', 1)
     # TODO make transaction log support the `expand` feature
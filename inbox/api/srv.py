@@ -5,6 +5,7 @@ from werkzeug.exceptions import default_exceptions, HTTPException
 from sqlalchemy.orm.exc import NoResultFound
 
 from inbox.api.kellogs import APIEncoder
+from inbox.api.namespace_cache import get_cached_namespace
 from inbox.auth.generic import GenericAuthHandler
 from inbox.auth.gmail import GmailAuthHandler
 from nylas.logging import get_logger
@@ -83,18 +84,16 @@ def auth():
     else:
         namespace_public_id = request.authorization.username
 
-    with global_session_scope() as db_session:
-        try:
-            valid_public_id(namespace_public_id)
-            namespace = db_session.query(Namespace) \
-                .filter(Namespace.public_id == namespace_public_id).one()
-            g.namespace_id = namespace.id
-            g.account_id = namespace.account.id
-        except NoResultFound:
-            return make_response((
-                "Could not verify access credential.", 401,
-                {'WWW-Authenticate': 'Basic realm="API '
-                 'Access Token Required"'}))
+    valid_public_id(namespace_public_id)
+    cached = get_cached_namespace(namespace_public_id)
+    if cached is None:
+        return make_response((
+            "Could not verify access credential.", 401,
+            {'WWW-Authenticate': 'Basic realm="API '
+             'Access Token Required"'}))
+    g.namespace_id = cached.summary.id
+    g.account_id = cached.summary.account_id
+    g.cached_namespace = cached
 
 
 @app.after_request
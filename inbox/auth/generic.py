@@ -16,11 +16,15 @@ from inbox.models import Namespace
 from inbox.models.backends.generic import GenericAccount
 from inbox.sendmail.smtp.postel import SMTPClient
 from inbox.util.url import matching_subdomains
-from inbox.crispin import CrispinClient
+from inbox.crispin import CrispinClient, enable_compression
 
 PROVIDER = 'generic'
 AUTH_HANDLER_CLS = 'GenericAuthHandler'
 
+# Most recently negotiated TLS session per IMAP (host, port), so that
+# reconnects can resume it instead of doing a full handshake.
+_tls_sessions = {}
+
 
 class GenericAuthHandler(AuthHandler):
 
@@ -180,6 +184,7 @@ class GenericAuthHandler(AuthHandler):
                             ssl_required=ssl_required,
                             error=exc)
 
+        enable_compression(conn, self.provider_name)
         return conn
 
     def _supports_condstore(self, conn):
@@ -371,7 +376,7 @@ def create_imap_connection(host, port, ssl_required, use_timeout=True):
     timeout = 300 if use_timeout else None
 
     # TODO: certificate pinning for well known sites
-    context = create_default_context()
+    context = SessionResumingContext(create_default_context(), (host, port))
     conn = IMAPClient(host, port=port, use_uid=True,
                       ssl=use_ssl, ssl_context=context, timeout=timeout)
 
@@ -433,3 +438,42 @@ def create_default_context():
                           ossllib.SSL_MODE_AUTO_RETRY)
 
     return context
+
+
+class SessionResumingContext(object):
+    """
+    Wraps a backports.ssl.SSLContext so that the sockets it creates offer
+    the last TLS session negotiated with the same endpoint, letting servers
+    which support session resumption skip the full handshake on reconnect.
+
+    If the underlying OpenSSL connection doesn't expose sessions, this falls
+    back to a normal handshake.
+
+    """
+
+    def __init__(self, context, endpoint):
+        self._context = context
+        self._endpoint = endpoint
+
+    def __getattr__(self, name):
+        return getattr(self._context, name)
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        do_handshake = kwargs.pop('do_handshake_on_connect', True)
+        ssl_sock = self._context.wrap_socket(
+            sock, *args, do_handshake_on_connect=False, **kwargs)
+        conn = getattr(ssl_sock, '_conn', None)
+        session = _tls_sessions.get(self._endpoint)
+        if session is not None and hasattr(conn, 'set_session'):
+            try:
+                conn.set_session(session)
+            except Exception:
+                log.info('Error offering TLS session for resumption',
+                         endpoint=self._endpoint, exc_info=True)
+        if not do_handshake:
+            return ssl_sock
+
+        ssl_sock.do_handshake()
+        if hasattr(conn, 'get_session'):
+            _tls_sessions[self._endpoint] = conn.get_session()
+        return ssl_sock
@@ -10,6 +10,7 @@ log = get_logger()
 from inbox.auth.base import AuthHandler
 from inbox.auth.generic import create_imap_connection
 from inbox.basicauth import ConnectionError, OAuthError
+from inbox.crispin import enable_compression
 from inbox.models.backends.oauth import token_manager
 
 
@@ -32,6 +33,7 @@ class OAuthAuthHandler(AuthHandler):
         """
         conn = self._get_IMAP_connection(account, use_timeout)
         self._authenticate_IMAP_connection(account, conn)
+        enable_compression(conn, self.provider_name)
         return conn
 
     def _get_IMAP_connection(self, account, use_timeout=True):
@@ -2,12 +2,19 @@
 import contextlib
 import re
 import time
+import zlib
 import imaplib
 import imapclient
+from imapclient.imap_utf7 import decode as utf7_decode
+from imapclient.response_parser import parse_response
 
 # Prevent "got more than 1000000 bytes" errors for servers that send more data.
 imaplib._MAXLINE = 10000000
 
+# imaplib refuses to send commands it doesn't know about. COMPRESS (RFC 4978)
+# is only valid once authenticated.
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
 # Even though RFC 2060 says that the date component must have two characters
 # (either two digits or space+digit), it seems that some IMAP servers only
 # return one digit. Fun times.
@@ -30,14 +37,16 @@ from collections import namedtuple, defaultdict
 
 import gevent
 from backports import ssl
-from gevent import socket
+from gevent import select, socket
 from gevent.lock import BoundedSemaphore
 from gevent.queue import Queue
 from sqlalchemy.orm import joinedload
 
+from inbox.config import config
 from inbox.util.concurrency import retry
 from inbox.util.itert import chunk
 from inbox.util.misc import or_none
+from inbox.util.stats import statsd_client
 from inbox.basicauth import GmailSettingError
 from inbox.models import Account
 from inbox.models.session import session_scope
@@ -65,6 +74,28 @@ RawFolder = namedtuple('RawFolder', 'display_name role')
 # This prevents multiple greenlets from concurrently creating duplicate
 # connection pools for a given account.
 _lock_map = defaultdict(threading.Lock)
+# Account ids to read-only and writable connection pools.
+_readonly_pools = {}
+_writable_pools = {}
+# Whether read-only pools are kept warm (see enable_pool_keepalive). Only
+# sync processes do: others, like API processes fetching messages directly,
+# would hold connections open for every account they ever touched.
+_pool_keepalive = False
+
+# Minimum number of authenticated connections kept open in read-only pools
+# that are in use, so that polls and direct fetches don't pay for connection
+# setup.
+POOL_MIN_CONNECTIONS = config.get('CRISPIN_POOL_MIN_CONNECTIONS', 1)
+# How often (in seconds) idle connections get a NOOP. IMAP servers may drop
+# connections idle for more than 30 minutes (RFC 3501 section 5.4), and many
+# do so much sooner.
+POOL_KEEPALIVE_INTERVAL = config.get('CRISPIN_POOL_KEEPALIVE_INTERVAL', 120)
+# Pools which haven't been checked out from for this long (in seconds) stop
+# being kept warm and log out their connections.
+POOL_IDLE_TIMEOUT = config.get('CRISPIN_POOL_IDLE_TIMEOUT', 1800)
+
+# Whether to negotiate COMPRESS=DEFLATE with servers that support it.
+IMAP_COMPRESSION = config.get('IMAP_COMPRESSION', True)
 
 # Exception classes which indicate the network connection to the IMAP
 # server is broken.
@@ -94,13 +125,23 @@ class DraftDeletionException(Exception):
 def _get_connection_pool(account_id, pool_size, pool_map, readonly):
     with _lock_map[account_id]:
         if account_id not in pool_map:
-            pool_map[account_id] = CrispinConnectionPool(
-                account_id, num_connections=pool_size,
-                readonly=readonly)
+            pool = CrispinConnectionPool(account_id,
+                                         num_connections=pool_size,
+                                         readonly=readonly)
+            if readonly and _pool_keepalive:
+                pool.start_keepalive()
+            pool_map[account_id] = pool
         return pool_map[account_id]
 
 
-def connection_pool(account_id, pool_size=None, pool_map=dict()):
+def enable_pool_keepalive():
+    """ Keep the read-only connection pools created from now on warm.
+    Called by sync processes. """
+    global _pool_keepalive
+    _pool_keepalive = True
+
+
+def connection_pool(account_id, pool_size=None, pool_map=_readonly_pools):
     """ Per-account crispin connection pool.
 
     Use like this:
@@ -124,7 +165,8 @@ def connection_pool(account_id, pool_size=None, pool_map=dict()):
     return _get_connection_pool(account_id, pool_size, pool_map, True)
 
 
-def writable_connection_pool(account_id, pool_size=1, pool_map=dict()):
+def writable_connection_pool(account_id, pool_size=1,
+                             pool_map=_writable_pools):
     """ Per-account crispin connection pool, with *read-write* connections.
 
     Use like this:
@@ -137,6 +179,15 @@ def writable_connection_pool(account_id, pool_size=1, pool_map=dict()):
     return _get_connection_pool(account_id, pool_size, pool_map, False)
 
 
+def close_connection_pool(account_id, pool_map=_readonly_pools):
+    """ Discard the account's read-only connection pool, e.g. because its
+    sync stopped. Stops keeping it warm, and logs out idle connections. """
+    with _lock_map[account_id]:
+        pool = pool_map.pop(account_id, None)
+    if pool is not None:
+        pool.close()
+
+
 class CrispinConnectionPool(object):
     """
     Connection pool for Crispin clients.
@@ -151,15 +202,26 @@ class CrispinConnectionPool(object):
         How many connections in the pool.
     readonly : bool
         Is the connection to the IMAP server read-only?
+    min_connections : int
+        How many connections to keep open and authenticated while the pool
+        is in use, once `start_keepalive()` has been called.
     """
 
-    def __init__(self, account_id, num_connections, readonly):
+    def __init__(self, account_id, num_connections, readonly,
+                 min_connections=POOL_MIN_CONNECTIONS):
         log.info('Creating Crispin connection pool',
                  account_id=account_id, num_connections=num_connections)
         self.account_id = account_id
         self.readonly = readonly
+        self.num_connections = num_connections
+        self.min_connections = min(min_connections, num_connections)
         self._queue = Queue(num_connections, items=num_connections * [None])
         self._sem = BoundedSemaphore(num_connections)
+        self._last_checkout = time.time()
+        self._keepalive_greenlet = None
+        # Connections discarded because of errors, which are yet to be
+        # replaced.
+        self._discarded = 0
         self._set_account_info()
 
     def _should_timeout_connection(self):
@@ -186,8 +248,12 @@ class CrispinConnectionPool(object):
         # The queue implementation does not have that property; having
         # greenlets simply block on self._queue.get(block=True) could cause
         # individual greenlets to block for arbitrarily long.
+        start = time.time()
         self._sem.acquire()
         client = self._queue.get()
+        self._last_checkout = time.time()
+        statsd_client.timing('crispin.pool.checkout_wait',
+                             (self._last_checkout - start) * 1000)
         try:
             if client is None:
                 client = self._new_connection()
@@ -203,9 +269,10 @@ class CrispinConnectionPool(object):
             # thing to do.
             log.info('IMAP connection error; discarding connection',
                      exc_info=True)
-            if client is not None and \
-               not isinstance(exc, CONN_UNUSABLE_EXC_CLASSES):
-                self._logout(client)
+            if client is not None:
+                self._discarded += 1
+                if not isinstance(exc, CONN_UNUSABLE_EXC_CLASSES):
+                    self._logout(client)
             client = None
             raise exc
         except:
@@ -214,6 +281,85 @@ class CrispinConnectionPool(object):
             self._queue.put(client)
             self._sem.release()
 
+    def start_keepalive(self):
+        """ Start a greenlet which keeps `min_connections` connections open
+        and authenticated, and NOOPs idle ones so the server doesn't drop
+        them.
+        """
+        if self._keepalive_greenlet is None:
+            self._keepalive_greenlet = gevent.spawn(self._keepalive_loop)
+
+    def close(self):
+        """ Stop the keepalive greenlet and log out idle connections. """
+        if self._keepalive_greenlet is not None:
+            self._keepalive_greenlet.kill()
+            self._keepalive_greenlet = None
+        self._visit_idle_clients(self._logout_idle_client)
+
+    def _keepalive_loop(self):
+        # Pre-warm right away, then keep connections alive periodically.
+        while True:
+            try:
+                self._keepalive()
+            except Exception:
+                log.warning('Error keeping IMAP connections alive',
+                            account_id=self.account_id, exc_info=True)
+            gevent.sleep(POOL_KEEPALIVE_INTERVAL)
+
+    def _keepalive(self):
+        if time.time() - self._last_checkout > POOL_IDLE_TIMEOUT:
+            self._visit_idle_clients(self._logout_idle_client)
+            return
+
+        # Checked-out connections are open and in use.
+        warm = [self.num_connections - self._queue.qsize()]
+
+        def refresh(client):
+            if client is None:
+                return None
+            try:
+                client.conn.noop()
+            except CONN_DISCARD_EXC_CLASSES as exc:
+                log.info('IMAP connection keepalive failed; discarding '
+                         'connection', account_id=self.account_id,
+                         error=exc)
+                self._discarded += 1
+                if not isinstance(exc, CONN_UNUSABLE_EXC_CLASSES):
+                    self._logout(client)
+                return None
+            warm[0] += 1
+            return client
+
+        def prewarm(client):
+            if client is None and warm[0] < self.min_connections:
+                client = self._new_connection()
+                warm[0] += 1
+            return client
+
+        self._visit_idle_clients(refresh)
+        self._visit_idle_clients(prewarm)
+
+    def _logout_idle_client(self, client):
+        if client is not None:
+            self._logout(client)
+        return None
+
+    def _visit_idle_clients(self, visit):
+        """ Call `visit` on each client which isn't checked out, replacing it
+        in the pool with the return value. Doesn't block on clients in use.
+        """
+        # The queue is FIFO, so putting a client back moves it behind the
+        # ones we haven't visited yet.
+        for _ in range(self.num_connections):
+            if not self._sem.acquire(blocking=False):
+                break
+            client = self._queue.get()
+            try:
+                client = visit(client)
+            finally:
+                self._queue.put(client)
+                self._sem.release()
+
     def _set_account_info(self):
         with session_scope(self.account_id) as db_session:
             account = db_session.query(ImapAccount).get(self.account_id)
@@ -222,6 +368,7 @@ class CrispinConnectionPool(object):
             self.provider_info = account.provider_info
             self.email_address = account.email_address
             self.auth_handler = account.auth_handler
+            self.imap_host = account.imap_endpoint[0]
             if account.provider == 'gmail':
                 self.client_cls = GmailCrispinClient
             else:
@@ -245,7 +392,15 @@ class CrispinConnectionPool(object):
             account, self._should_timeout_connection())
 
     def _new_connection(self):
+        start = time.time()
         conn = self._new_raw_connection()
+        statsd_client.timing('crispin.pool.connect_latency',
+                             (time.time() - start) * 1000)
+        if self._discarded:
+            # First connections, and ones after idle logouts, aren't
+            # reconnects.
+            self._discarded -= 1
+            statsd_client.incr('crispin.pool.reconnects')
         return self.client_cls(self.account_id, self.provider_info,
                                self.email_address, conn,
                                readonly=self.readonly)
@@ -261,6 +416,166 @@ retry_crispin = functools.partial(
     retry, retry_classes=CONN_RETRY_EXC_CLASSES, exc_callback=_exc_callback)
 
 
+def enable_compression(conn, provider_name):
+    """
+    Negotiate COMPRESS=DEFLATE (RFC 4978) on an authenticated IMAPClient
+    connection, if the server supports it. Compression is an optimization,
+    so if the server rejects the command the connection is left as is.
+
+    Returns
+    -------
+    bool
+        Whether the connection is now compressed.
+
+    """
+    if not IMAP_COMPRESSION or not conn.has_capability('COMPRESS=DEFLATE'):
+        return False
+    imap = conn._imap
+    try:
+        typ, data = imap._simple_command('COMPRESS', 'DEFLATE')
+    except imaplib.IMAP4.abort:
+        raise
+    except imaplib.IMAP4.error as exc:
+        typ, data = 'BAD', [str(exc)]
+    if typ != 'OK':
+        log.warning('COMPRESS=DEFLATE advertised but rejected; continuing '
+                    'uncompressed', provider=provider_name, response=data)
+        return False
+    transport = DeflateTransport(imap, provider_name)
+    transport.install()
+    # IMAPClient.idle_check waits on the socket, which doesn't see responses
+    # already inflated into the transport's buffer.
+    conn.idle_check = transport.idle_check
+    return True
+
+
+class DeflateTransport(object):
+    """
+    Raw DEFLATE stream between an imaplib connection and its socket. imaplib
+    (and imapclient) only talk to the server through the connection's
+    `read`, `readline` and `send` methods, so installing the transport
+    replaces those.
+
+    Compressed and uncompressed byte counts are reported to statsd, per
+    provider, whenever a command is sent.
+
+    Parameters
+    ----------
+    imap : imaplib.IMAP4
+        The connection, right after the server accepted COMPRESS.
+    provider_name : str
+        Used in metric names.
+
+    """
+    READ_SIZE = 16384
+
+    def __init__(self, imap, provider_name):
+        self.imap = imap
+        self.provider_name = provider_name
+        self.sock = imap.socket()
+        self._send = imap.send
+        self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                            zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._buffer = ''
+        # [compressed, uncompressed] bytes not yet reported, per direction.
+        self._received = [0, 0]
+        self._sent = [0, 0]
+
+    def install(self):
+        self.imap.read = self.read
+        self.imap.readline = self.readline
+        self.imap.send = self.send
+
+    def send(self, data):
+        compressed = (self._compressor.compress(data) +
+                      self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        self._send(compressed)
+        self._sent[0] += len(compressed)
+        self._sent[1] += len(data)
+        self.report()
+
+    def _inflate(self):
+        data = self.sock.recv(self.READ_SIZE)
+        if not data:
+            raise imaplib.IMAP4.abort('socket error: EOF')
+        inflated = self._decompressor.decompress(data)
+        self._received[0] += len(data)
+        self._received[1] += len(inflated)
+        return inflated
+
+    def read(self, size):
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        try:
+            while length < size:
+                chunk = self._inflate()
+                chunks.append(chunk)
+                length += len(chunk)
+        except socket.error:
+            # Keep what was read for the next call; see idle_check.
+            self._buffer = ''.join(chunks)
+            raise
+        data = ''.join(chunks)
+        self._buffer = data[size:]
+        return data[:size]
+
+    def readline(self):
+        chunks = [self._buffer]
+        chunk = self._buffer
+        try:
+            while '\n' not in chunk:
+                chunk = self._inflate()
+                chunks.append(chunk)
+        except socket.error:
+            self._buffer = ''.join(chunks)
+            raise
+        data = ''.join(chunks)
+        end = data.index('\n') + 1
+        self._buffer = data[end:]
+        return data[:end]
+
+    def idle_check(self, timeout=None):
+        """
+        IMAPClient.idle_check for the compressed connection: only waits for
+        the socket if no response is already buffered, then reads responses
+        until the socket has no more data.
+
+        """
+        if '\n' not in self._buffer:
+            readable, _, _ = select.select([self.sock], [], [], timeout)
+            if not readable:
+                return []
+        responses = []
+        self.sock.setblocking(0)
+        try:
+            while True:
+                try:
+                    line = self.readline()
+                except socket.error:
+                    break
+                # Untagged responses, e.g. '* 3 EXISTS' or '* OK Still here'.
+                line = line.rstrip('\r\n')[2:]
+                if line.startswith(('OK ', 'NO ')):
+                    responses.append(tuple(line.split(' ', 1)))
+                else:
+                    responses.append(parse_response([line]))
+        finally:
+            self.sock.setblocking(1)
+        return responses
+
+    def report(self):
+        for direction, counts in (('received', self._received),
+                                  ('sent', self._sent)):
+            if not counts[1]:
+                continue
+            prefix = 'crispin.compression.{}.{}'.format(self.provider_name,
+                                                        direction)
+            statsd_client.incr(prefix + '.compressed_bytes', counts[0])
+            statsd_client.incr(prefix + '.uncompressed_bytes', counts[1])
+            counts[0] = counts[1] = 0
+
+
 class CrispinClient(object):
     """
     Generic IMAP client wrapper.
@@ -635,6 +950,59 @@ class CrispinClient(object):
     def idle_supported(self):
         return 'IDLE' in self.conn.capabilities()
 
+    def list_status_supported(self):
+        return 'LIST-STATUS' in self.conn.capabilities()
+
+    def folder_statuses(self, folder_names, what):
+        """
+        STATUS data items `what` (e.g. ['UIDNEXT', 'HIGHESTMODSEQ']) for
+        many folders in a single round trip, using LIST-STATUS (RFC 5819)
+        if the server supports it, and pipelined STATUS commands otherwise.
+
+        Returns
+        -------
+        dict
+            Mapping of folder name: {data item: value}. Folders the server
+            didn't return a status for are omitted.
+
+        """
+        if not folder_names:
+            return {}
+        items = '({})'.format(' '.join(what))
+        imap = self.conn._imap
+        # Drop anything left over from earlier commands.
+        imap.untagged_responses.pop('STATUS', None)
+        if self.list_status_supported():
+            typ, data = imap._simple_command(
+                'LIST', '""', '*', 'RETURN', '(STATUS {})'.format(items))
+            imap.untagged_responses.pop('LIST', None)
+            if typ != 'OK':
+                raise imaplib.IMAP4.error('LIST-STATUS failed: {}'.format(
+                    data))
+        else:
+            tags = [imap._command('STATUS',
+                                  self.conn._normalise_folder(name), items)
+                    for name in folder_names]
+            for tag in tags:
+                # A NO response (e.g. for a folder deleted since we last
+                # listed folders) just means there's no status for it.
+                imap._command_complete('STATUS', tag)
+        responses = imap.untagged_responses.pop('STATUS', [])
+
+        wanted = set(folder_names)
+        statuses = {}
+        parsed = parse_response(responses) if responses else ()
+        for name, status_items in zip(parsed[::2], parsed[1::2]):
+            if isinstance(name, (int, long)):
+                # Purely numeric folder names get parsed as numbers.
+                name = str(name)
+            if self.conn.folder_encode:
+                name = utf7_decode(name)
+            if name in wanted:
+                statuses[name] = dict(zip(status_items[::2],
+                                          status_items[1::2]))
+        return statuses
+
     def search_uids(self, criteria):
         """
         Find UIDs in this folder matching the criteria. See
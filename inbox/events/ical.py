@@ -15,6 +15,7 @@ from util import serialize_datetime, valid_base36
 from timezones import timezones_table
 from inbox.contacts.processing import update_contacts_from_event
 from inbox.models.event import Event, EVENT_STATUSES
+from inbox.models.roles import Blob
 from inbox.events.util import MalformedEventError
 from inbox.util.addr import canonicalize_address
 from inbox.models.action_log import schedule_action
@@ -388,10 +389,13 @@ def import_attached_events(db_session, account, message):
     """Import events from a file into the 'Emailed events' calendar."""
     assert account is not None
 
+    prefetched = Blob.prefetch([part.block
+                                for part in message.attached_event_files])
     for part in message.attached_event_files:
         part_data = ''
         try:
-            part_data = part.block.data
+            part_data = (prefetched.get(part.block.data_sha256) or
+                         part.block.data)
             if part_data == '':
                 continue
 
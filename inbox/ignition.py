@@ -1,11 +1,14 @@
 import limitlion
+import itertools
 import time
 import weakref
 import gevent
 import redis
 from socket import gethostname
 from urllib import quote_plus as urlquote
-from sqlalchemy import create_engine, event
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.util import queue as sqla_queue
 
 from inbox.sqlalchemy_ext.util import (ForceStrictMode,
                                        disabled_dubiously_many_queries_warning)
@@ -22,10 +25,151 @@ DB_POOL_SIZE = config.get_required('DB_POOL_SIZE')
 DB_POOL_MAX_OVERFLOW = config.get('DB_POOL_MAX_OVERFLOW') or 5
 DB_POOL_TIMEOUT = config.get('DB_POOL_TIMEOUT') or 60
 
+# Pools are resized between DB_POOL_MIN_SIZE and DB_POOL_MAX_SIZE (which
+# shards can override with POOL_MIN_SIZE and POOL_MAX_SIZE) to keep the
+# average checkout wait under DB_POOL_WAIT_SLO seconds. By default both are
+# DB_POOL_SIZE, so pools aren't resized.
+DB_POOL_MIN_SIZE = config.get('DB_POOL_MIN_SIZE') or DB_POOL_SIZE
+DB_POOL_MAX_SIZE = config.get('DB_POOL_MAX_SIZE') or DB_POOL_SIZE
+DB_POOL_WAIT_SLO = config.get('DB_POOL_WAIT_SLO', 0.05)
+DB_POOL_RESIZE_INTERVAL = config.get('DB_POOL_RESIZE_INTERVAL', 30)
+# Smoothing factor for the checkout wait moving average.
+POOL_WAIT_ALPHA = 0.1
+
+# Finding where a connection was checked out walks the stack, which is too
+# expensive to do on every checkout. It's done for one in
+# DB_CHECKOUT_SAMPLE_INTERVAL checkouts, and when connections held for more
+# than DB_CHECKOUT_SLOW_THRESHOLD seconds are checked back in.
+DB_CHECKOUT_SAMPLE_INTERVAL = config.get('DB_CHECKOUT_SAMPLE_INTERVAL', 100)
+DB_CHECKOUT_SLOW_THRESHOLD = config.get('DB_CHECKOUT_SLOW_THRESHOLD', 30)
+
+# Replicas more than REPLICA_MAX_LAG seconds behind aren't read from. Lag is
+# checked in the background at most every REPLICA_LAG_CHECK_INTERVAL seconds
+# per replica. Replica connections time out after REPLICA_CONNECT_TIMEOUT
+# seconds, so an unreachable replica is noticed quickly.
+REPLICA_MAX_LAG = config.get('REPLICA_MAX_LAG', 5)
+REPLICA_LAG_CHECK_INTERVAL = config.get('REPLICA_LAG_CHECK_INTERVAL', 5)
+REPLICA_CONNECT_TIMEOUT = config.get('REPLICA_CONNECT_TIMEOUT', 2)
+
 
 pool_tracker = weakref.WeakKeyDictionary()
 
 
+class TimedQueuePool(QueuePool):
+    """ A QueuePool which notes how long each checkout waited for a
+    connection, in the connection record's info. """
+
+    def _do_get(self):
+        start = time.time()
+        record = super(TimedQueuePool, self)._do_get()
+        record.info['pool_wait'] = time.time() - start
+        return record
+
+
+class AdaptiveQueuePool(TimedQueuePool):
+    """
+    A TimedQueuePool which resizes itself between `min_size` and `max_size`.
+    Every `resize_interval` seconds it grows by a quarter if checkouts have
+    waited more than `wait_slo` seconds on average, and shrinks by one
+    connection if some of its connections went unused throughout.
+
+    A pool which is waiting too long and can't grow any more is saturated;
+    low-priority work should check saturated() and hold off.
+
+    """
+    min_size = DB_POOL_MIN_SIZE
+    max_size = DB_POOL_MAX_SIZE
+    wait_slo = DB_POOL_WAIT_SLO
+    resize_interval = DB_POOL_RESIZE_INTERVAL
+
+    def __init__(self, *args, **kwargs):
+        super(AdaptiveQueuePool, self).__init__(*args, **kwargs)
+        self.wait_avg = 0
+        self.peak_checkedout = 0
+        self.observed_at = self.resized_at = time.time()
+
+    def _do_get(self):
+        try:
+            record = super(AdaptiveQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            self._observe(self._timeout)
+            raise
+        self._observe(record.info['pool_wait'])
+        return record
+
+    def _observe(self, wait):
+        self.wait_avg += POOL_WAIT_ALPHA * (wait - self.wait_avg)
+        self.peak_checkedout = max(self.peak_checkedout, self.checkedout())
+        self.observed_at = time.time()
+        if self.observed_at - self.resized_at >= self.resize_interval:
+            self.adjust()
+
+    def adjust(self):
+        size = self.size()
+        if self.wait_avg > self.wait_slo:
+            new_size = min(size + max(size // 4, 1), self.max_size)
+        elif self.peak_checkedout < size:
+            new_size = max(size - 1, self.min_size)
+        else:
+            new_size = size
+        self.peak_checkedout = self.checkedout()
+        self.resized_at = time.time()
+        if new_size != size:
+            log.info('Resizing connection pool', pool=self.logging_name,
+                     size=size, new_size=new_size,
+                     wait_avg=self.wait_avg)
+            self.resize(new_size)
+
+    def resize(self, size):
+        with self._overflow_lock:
+            # _overflow counts connections beyond the pool's size.
+            self._overflow -= size - self._pool.maxsize
+            self._pool.maxsize = size
+        # Close idle connections the smaller pool has no room for. Ones
+        # checked in later are closed by QueuePool, as the pool is full.
+        while self._pool.qsize() > size:
+            try:
+                conn = self._pool.get(False)
+            except sqla_queue.Empty:
+                break
+            try:
+                conn.close()
+            finally:
+                self._dec_overflow()
+
+    def saturated(self):
+        return (self.size() >= self.max_size and
+                self.wait_avg > self.wait_slo and
+                time.time() - self.observed_at < self.resize_interval)
+
+    def stats(self):
+        return {
+            'size': self.size(),
+            'min_size': self.min_size,
+            'max_size': self.max_size,
+            'checkedout': self.checkedout(),
+            'checkedin': self.checkedin(),
+            'overflow': self.overflow(),
+            'utilization': self.checkedout() / float(self.size() +
+                                                     self._max_overflow),
+            'wait_avg_ms': int(self.wait_avg * 1000),
+            'saturated': self.saturated(),
+        }
+
+    def recreate(self):
+        pool = super(AdaptiveQueuePool, self).recreate()
+        pool.min_size = self.min_size
+        pool.max_size = self.max_size
+        return pool
+
+
+def checkout_source():
+    f, name = find_first_app_frame_and_name(ignores=['sqlalchemy',
+                                                     'inbox.ignition',
+                                                     'nylas.logging'])
+    return '{}:{}'.format(name, f.f_lineno)
+
+
 # See
 # https://github.com/PyMySQL/mysqlclient-python/blob/master/samples/waiter_gevent.py
 def gevent_waiter(fd, hub=gevent.hub.get_hub()):
@@ -44,11 +188,14 @@ def build_uri(username, password, hostname, port, database_name):
 
 def engine(database_name, database_uri, pool_size=DB_POOL_SIZE,
            max_overflow=DB_POOL_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT,
-           echo=False):
+           min_pool_size=DB_POOL_MIN_SIZE, max_pool_size=DB_POOL_MAX_SIZE,
+           connect_timeout=60, echo=False):
     engine = create_engine(database_uri,
                            listeners=[ForceStrictMode()],
                            isolation_level='READ COMMITTED',
                            echo=echo,
+                           poolclass=AdaptiveQueuePool,
+                           pool_logging_name=database_name,
                            pool_size=pool_size,
                            pool_timeout=pool_timeout,
                            pool_recycle=3600,
@@ -56,53 +203,74 @@ def engine(database_name, database_uri, pool_size=DB_POOL_SIZE,
                            connect_args={'binary_prefix': True,
                                          'charset': 'utf8mb4',
                                          'waiter': gevent_waiter,
-                                         'connect_timeout': 60})
+                                         'connect_timeout': connect_timeout})
+    engine.pool.min_size = min(min_pool_size, pool_size)
+    engine.pool.max_size = max(max_pool_size, pool_size)
+
+    hostname = gethostname().replace(".", "-")
+    process_name = str(config.get("PROCESS_NAME", "main_process"))
+    metric_prefix = ".".join(["dbconn", database_name, hostname,
+                              process_name])
+    checkouts = itertools.count()
 
     @event.listens_for(engine, 'checkout')
     def receive_checkout(dbapi_connection, connection_record,
                          connection_proxy):
         '''Log checkedout and overflow when a connection is checked out'''
-        hostname = gethostname().replace(".", "-")
-        process_name = str(config.get("PROCESS_NAME", "main_process"))
-
         if config.get('ENABLE_DB_TXN_METRICS', False):
-            statsd_client.gauge(".".join(
-                ["dbconn", database_name, hostname, process_name,
-                 "checkedout"]),
+            statsd_client.gauge(metric_prefix + ".checkedout",
                                 connection_proxy._pool.checkedout())
 
-            statsd_client.gauge(".".join(
-                ["dbconn", database_name, hostname, process_name,
-                 "overflow"]),
+            statsd_client.gauge(metric_prefix + ".overflow",
                                 connection_proxy._pool.overflow())
 
-        # Keep track of where and why this connection was checked out.
-        log = get_logger()
-        context = log._context._dict.copy()
-        f, name = find_first_app_frame_and_name(ignores=['sqlalchemy',
-                                                         'inbox.ignition',
-                                                         'nylas.logging'])
-        source = '{}:{}'.format(name, f.f_lineno)
-
-        pool_tracker[dbapi_connection] = {
-            'source': source,
-            'context': context,
+        pool_wait = connection_record.info.pop('pool_wait', None)
+        if pool_wait is not None:
+            statsd_client.timing(metric_prefix + ".pool_wait",
+                                 int(pool_wait * 1000))
+
+        # Keep track of where and why this connection was checked out. The
+        # greenlet's stack shows what it's doing with it now.
+        checkout = {
+            'source': None,
+            'context': None,
+            'greenlet': gevent.getcurrent(),
             'checkedout_at': time.time()
         }
+        if next(checkouts) % DB_CHECKOUT_SAMPLE_INTERVAL == 0:
+            checkout['source'] = checkout_source()
+            checkout['context'] = get_logger()._context._dict.copy()
+        pool_tracker[dbapi_connection] = checkout
 
     @event.listens_for(engine, 'checkin')
     def receive_checkin(dbapi_connection, connection_record):
-        if dbapi_connection in pool_tracker:
-            del pool_tracker[dbapi_connection]
+        checkout = pool_tracker.pop(dbapi_connection, None)
+        if checkout is None:
+            return
+        held = time.time() - checkout['checkedout_at']
+        if held > DB_CHECKOUT_SLOW_THRESHOLD:
+            # Connections are usually checked in by the code which checked
+            # them out.
+            log.warning('Long connection checkout', held=held,
+                        source=checkout['source'] or checkout_source(),
+                        context=checkout['context'])
 
     return engine
 
 
 class EngineManager(object):
+    """
+    Engines for each shard. Database hosts may list REPLICAS (each a
+    HOSTNAME and PORT), which hold all of the host's shards; reads which
+    tolerate some lag can use them through get_replica_for_id.
+
+    """
 
     def __init__(self, databases, users, include_disabled=False):
         self.engines = {}
+        self.replica_engines = {}
         self._engine_zones = {}
+        self._replica_lag = {}
         keys = set()
         schema_names = set()
         use_proxysql = config.get('USE_PROXYSQL', False)
@@ -136,15 +304,87 @@ class EngineManager(object):
                                 database_name=schema_name,
                                 hostname=hostname,
                                 port=port)
-                self.engines[key] = engine(schema_name, uri)
+                self.engines[key] = engine(
+                    schema_name, uri,
+                    min_pool_size=shard.get('POOL_MIN_SIZE',
+                                            DB_POOL_MIN_SIZE),
+                    max_pool_size=shard.get('POOL_MAX_SIZE',
+                                            DB_POOL_MAX_SIZE))
                 self._engine_zones[key] = zone
 
+                self.replica_engines[key] = []
+                for replica in database.get('REPLICAS', []):
+                    # Replicas default to the primary's credentials.
+                    replica_user = users.get(replica['HOSTNAME'],
+                                             users[hostname])
+                    uri = build_uri(username=replica_user['USER'],
+                                    password=replica_user['PASSWORD'],
+                                    database_name=schema_name,
+                                    hostname=replica['HOSTNAME'],
+                                    port=replica['PORT'])
+                    self.replica_engines[key].append(
+                        engine(schema_name, uri,
+                               connect_timeout=REPLICA_CONNECT_TIMEOUT))
+
     def shard_key_for_id(self, id_):
         return 0
 
     def get_for_id(self, id_):
         return self.engines[self.shard_key_for_id(id_)]
 
+    def get_replica_for_id(self, id_, max_lag=None):
+        """
+        An engine for a replica of the shard of `id_` which is at most
+        `max_lag` seconds (by default, REPLICA_MAX_LAG) behind, or the
+        primary's if there's none. Each id prefers the same replica, so
+        that consecutive reads don't go back in time.
+
+        """
+        if max_lag is None:
+            max_lag = REPLICA_MAX_LAG
+        key = self.shard_key_for_id(id_)
+        replicas = self.replica_engines.get(key)
+        if not replicas:
+            return self.engines[key]
+        start = id_ % len(replicas)
+        for replica in replicas[start:] + replicas[:start]:
+            lag = self.replica_lag(replica)
+            if lag is not None and lag <= max_lag:
+                return replica
+        statsd_client.incr('dbconn.replica_fallback')
+        return self.engines[key]
+
+    def replica_lag(self, engine):
+        """ How many seconds a replica was behind its primary when last
+        checked, or None if it isn't replicating, can't be reached or hasn't
+        been checked yet. Stale values are refreshed in the background. """
+        checked_at, lag = self._replica_lag.get(engine, (0, None))
+        if time.time() - checked_at >= REPLICA_LAG_CHECK_INTERVAL:
+            # Keep the old value until the check is done, so only one
+            # check runs at a time.
+            self._replica_lag[engine] = (time.time(), lag)
+            gevent.spawn(self._check_replica_lag, engine)
+        return lag
+
+    def _check_replica_lag(self, engine):
+        try:
+            status = engine.execute('SHOW SLAVE STATUS').first()
+            lag = status['Seconds_Behind_Master'] if status else None
+        except Exception:
+            log.warning('Error checking replica lag', url=repr(engine.url),
+                        exc_info=True)
+            lag = None
+        self._replica_lag[engine] = (time.time(), lag)
+
+    def pool_saturated(self, id_):
+        """ Whether the shard of `id_` is out of connections to give, so
+        low-priority work on it should wait. """
+        return self.get_for_id(id_).pool.saturated()
+
+    def pool_stats(self):
+        return {key: engine.pool.stats()
+                for key, engine in self.engines.iteritems()}
+
     def zone_for_id(self, id_):
         return self._engine_zones[self.shard_key_for_id(id_)]
 
@@ -155,7 +395,7 @@ engine_manager = EngineManager(config.get_required('DATABASE_HOSTS'),
                                config.get_required('DATABASE_USERS'))
 
 
-def init_db(engine, key=0):
+def init_db(engine, key=0, partition_transactions=True):
     """
     Make the tables.
 
@@ -165,6 +405,11 @@ def init_db(engine, key=0):
     From now on, we should ony be creating tables+columns via SQLalchemy *once*
     and all subsequent changes done via migration scripts.
 
+    Shards are stamped with the head revision afterwards, so changes that
+    migrations make beyond what the models declare have to be made here too:
+    the transaction tables are partitioned by day (see migration 252), unless
+    `partition_transactions` is False.
+
     """
     from inbox.models.base import MailSyncBase
     from sqlalchemy import event, DDL
@@ -180,6 +425,10 @@ def init_db(engine, key=0):
     with disabled_dubiously_many_queries_warning():
         MailSyncBase.metadata.create_all(engine)
 
+    if partition_transactions:
+        from inbox.models.util import partition_transaction_tables
+        partition_transaction_tables(engine)
+
 
 def verify_db(engine, schema, key):
     from inbox.models.base import MailSyncBase
@@ -249,4 +498,7 @@ redis_txn = redis.Redis(
     config["TXN_REDIS_HOSTNAME"],
     int(config["REDIS_PORT"]),
     db=config["TXN_REDIS_DB"],
+    # Transaction ids are published on every commit, which shouldn't hang
+    # when redis does.
+    socket_timeout=config.get("TXN_REDIS_SOCKET_TIMEOUT", 1),
 )
@@ -46,8 +46,6 @@ SYNC_MONITOR_CLS = 'GmailSyncMonitor'
 
 
 MAX_DOWNLOAD_BYTES = 2 ** 20
-# USE MAX_DOWNLOAD_COUNT = 1 instead of 30 until N1 launch herding dies.
-MAX_DOWNLOAD_COUNT = 1
 
 
 class GmailSyncMonitor(ImapSyncMonitor):
@@ -315,6 +313,8 @@ class GmailFolderSyncEngine(FolderSyncEngine):
                 imap_folder_info_entry.uidvalidity, uidvalidity))
             imap_folder_info_entry.uidvalidity = uidvalidity
             imap_folder_info_entry.highestmodseq = None
+            # Queued updates are for the old UIDVALIDITY.
+            self.discard_folder_state()
             db_session.commit()
 
     def __deduplicate_message_object_creation(self, db_session, raw_messages,
@@ -389,7 +389,7 @@ class GmailFolderSyncEngine(FolderSyncEngine):
 
     def download_and_commit_uids(self, crispin_client, uids):
         start = datetime.utcnow()
-        raw_messages = crispin_client.uids(uids)
+        raw_messages = self.fetch_uids(crispin_client, uids)
         if not raw_messages:
             return
         new_uids = set()
@@ -451,15 +451,19 @@ class GmailFolderSyncEngine(FolderSyncEngine):
 
     def batch_download_uids(self, crispin_client, uids, metadata,
                             max_download_bytes=MAX_DOWNLOAD_BYTES,
-                            max_download_count=MAX_DOWNLOAD_COUNT):
+                            max_download_count=None):
         expanded_pending_uids = self.expand_uids_to_download(
             crispin_client, uids, metadata)
         count = 0
         while True:
             dl_size = 0
             batch = []
+            # Unless overridden, the batch size adapts to how well the
+            # provider is keeping up.
+            batch_count = (max_download_count or
+                           self.rate_controller.batch_size)
             while (dl_size < max_download_bytes and
-                   len(batch) < max_download_count):
+                   len(batch) < batch_count):
                 try:
                     uid = expanded_pending_uids.next()
                 except StopIteration:
@@ -472,7 +476,7 @@ class GmailFolderSyncEngine(FolderSyncEngine):
             self.download_and_commit_uids(crispin_client, batch)
             self.heartbeat_status.publish()
             count += len(batch)
-            if self.throttled and count >= THROTTLE_COUNT:
+            if self.rate_controller.throttled and count >= THROTTLE_COUNT:
                 # Throttled accounts' folders sync at a rate of
                 # 1 message/ minute, after the first approx. THROTTLE_COUNT
                 # messages for this batch are synced.
@@ -480,14 +484,6 @@ class GmailFolderSyncEngine(FolderSyncEngine):
                 # not the #(messages).
                 gevent.sleep(THROTTLE_WAIT)
 
-    @property
-    def throttled(self):
-        with session_scope(self.namespace_id) as db_session:
-            account = db_session.query(Account).get(self.account_id)
-            throttled = account.throttled
-
-        return throttled
-
 
 def g_msgids(namespace_id, session, in_):
     if not in_:
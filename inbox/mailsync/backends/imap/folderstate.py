@@ -0,0 +1,125 @@
+"""
+Coalesced writes of folder sync state.
+
+Folder sync engines keep their folder's ImapFolderInfo (uidnext,
+highestmodseq, last_slow_refresh, ...) in memory and used to write every
+change straight back, each in its own transaction, as they did with the
+uid count metrics in ImapFolderSyncStatus. With a FolderStateWriter, an
+account's engines queue those updates instead, and the writer flushes the
+whole account's queue in one transaction every FOLDER_STATE_FLUSH_INTERVAL
+seconds, and for a folder at checkpoints such as state changes.
+
+Losing queued updates in a crash is safe: a stale uidnext or
+last_slow_refresh only means some extra checking after a restart, and
+engines only queue a highestmodseq once the flag changes up to it are
+committed, so a stale one means re-fetching changes which were already
+applied.
+
+"""
+from collections import defaultdict
+
+import gevent
+from gevent import Greenlet
+from gevent.lock import BoundedSemaphore
+
+from inbox.config import config
+from inbox.models.backends.imap import ImapFolderInfo, ImapFolderSyncStatus
+from inbox.models.session import session_scope
+from inbox.util.debug import bind_context
+from inbox.util.stats import statsd_client
+from nylas.logging import get_logger
+log = get_logger()
+
+FOLDER_STATE_FLUSH_INTERVAL = config.get('FOLDER_STATE_FLUSH_INTERVAL', 30)
+
+
+class FolderStateWriter(Greenlet):
+    """
+    Queues ImapFolderInfo and ImapFolderSyncStatus metric updates for the
+    folders of an account, and periodically writes them all at once.
+
+    Parameters
+    ----------
+    account_id, namespace_id : int
+        Which account the folders belong to.
+    flush_interval : int
+        Seconds between flushes.
+
+    """
+
+    def __init__(self, account_id, namespace_id,
+                 flush_interval=FOLDER_STATE_FLUSH_INTERVAL):
+        bind_context(self, 'folderstatewriter', account_id)
+        self.account_id = account_id
+        self.namespace_id = namespace_id
+        self.flush_interval = flush_interval
+        # folder id -> {ImapFolderInfo attribute: value}
+        self.folder_info = defaultdict(dict)
+        # folder id -> ImapFolderSyncStatus metrics
+        self.metrics = defaultdict(dict)
+        # Held while writing, so discarded updates can't be in flight.
+        self.lock = BoundedSemaphore(1)
+        Greenlet.__init__(self)
+
+    def update_folder_info(self, folder_id, **values):
+        self.folder_info[folder_id].update(values)
+
+    def update_metrics(self, folder_id, metrics):
+        self.metrics[folder_id].update(metrics)
+
+    def discard(self, folder_id):
+        with self.lock:
+            self.folder_info.pop(folder_id, None)
+            self.metrics.pop(folder_id, None)
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                log.error('Error flushing folder state',
+                          account_id=self.account_id, exc_info=True)
+
+    def flush(self, folder_id=None):
+        """ Write the queued updates for `folder_id`, or for all of the
+        account's folders. """
+        with self.lock:
+            folder_ids = ([folder_id] if folder_id is not None else
+                          set(self.folder_info) | set(self.metrics))
+            folder_info = {id_: self.folder_info.pop(id_)
+                           for id_ in folder_ids if id_ in self.folder_info}
+            metrics = {id_: self.metrics.pop(id_)
+                       for id_ in folder_ids if id_ in self.metrics}
+            if not folder_info and not metrics:
+                return
+            try:
+                with session_scope(self.namespace_id) as db_session:
+                    self._write(db_session, folder_info, metrics)
+                    db_session.commit()
+            except Exception:
+                # Keep the updates for the next flush, unless newer ones
+                # were queued meanwhile.
+                for id_, values in folder_info.iteritems():
+                    values.update(self.folder_info[id_])
+                    self.folder_info[id_] = values
+                for id_, values in metrics.iteritems():
+                    values.update(self.metrics[id_])
+                    self.metrics[id_] = values
+                raise
+        statsd_client.incr('mailsync.folder_state.flushes')
+        statsd_client.incr('mailsync.folder_state.folders',
+                           len(set(folder_info) | set(metrics)))
+
+    def _write(self, db_session, folder_info, metrics):
+        for folder_id, values in folder_info.iteritems():
+            db_session.query(ImapFolderInfo).filter(
+                ImapFolderInfo.account_id == self.account_id,
+                ImapFolderInfo.folder_id == folder_id).update(
+                values, synchronize_session=False)
+        if metrics:
+            statuses = db_session.query(ImapFolderSyncStatus).filter(
+                ImapFolderSyncStatus.account_id == self.account_id,
+                ImapFolderSyncStatus.folder_id.in_(metrics))
+            for status in statuses:
+                status.update_metrics(metrics[status.folder_id])
@@ -62,6 +62,7 @@ sessions reduce scalability.
 """
 from __future__ import division
 
+import time
 from datetime import datetime, timedelta
 from gevent import Greenlet
 import gevent
@@ -85,7 +86,12 @@ from inbox.models import Folder, Account, Message
 from inbox.models.backends.imap import (ImapFolderSyncStatus, ImapThread,
                                         ImapUid, ImapFolderInfo)
 from inbox.models.session import session_scope
+from inbox.sqlalchemy_ext.query_profile import profile_queries
 from inbox.mailsync.backends.imap import common
+from inbox.mailsync.backends.imap.poller import MAX_WAIT_FOR_CHANGE
+from inbox.mailsync.backends.imap.scheduler import is_hot_folder
+from inbox.mailsync.backends.imap.ratecontrol import (rate_controller,
+                                                      is_throttling_error)
 from inbox.mailsync.backends.base import (MailsyncDone, MailsyncError,
                                           THROTTLE_COUNT, THROTTLE_WAIT)
 from inbox.heartbeat.store import HeartbeatStatusProxy
@@ -114,7 +120,8 @@ class FolderSyncEngine(Greenlet):
     """Base class for a per-folder IMAP sync engine."""
 
     def __init__(self, account_id, namespace_id, folder_name,
-                 email_address, provider_name, syncmanager_lock):
+                 email_address, provider_name, syncmanager_lock,
+                 status_poller=None, scheduler=None, state_writer=None):
 
         with session_scope(namespace_id) as db_session:
             try:
@@ -148,6 +155,19 @@ class FolderSyncEngine(Greenlet):
         self.last_fast_refresh = None
         self.flags_fetch_results = {}
         self.conn_pool = connection_pool(self.account_id)
+        self.rate_controller = rate_controller(self.account_id,
+                                               self.conn_pool.imap_host)
+        # Account-wide FolderStatusPoller, if the monitor runs one.
+        self.status_poller = status_poller
+        # ColdFolderScheduler to hand the folder over to once it reaches the
+        # 'poll' state, unless it's a hot folder.
+        if scheduler is not None and is_hot_folder(self.folder_role):
+            scheduler = None
+        self.scheduler = scheduler
+        # Account-wide FolderStateWriter to queue folder state updates with,
+        # if the monitor runs one. Otherwise they're written immediately.
+        self.state_writer = state_writer
+        self._condstore_supported = None
 
         self.state_handlers = {
             'initial': self.initial_sync,
@@ -209,12 +229,28 @@ class FolderSyncEngine(Greenlet):
                      folder_id=self.folder_id, account_id=self.account_id)
             raise MailsyncDone()
 
-        # NOTE: The parent ImapSyncMonitor handler could kill us at any
-        # time if it receives a shutdown command. The shutdown command is
-        # equivalent to ctrl-c.
-        while self.state != 'finish':
-            retry_with_logging(self._run_impl, account_id=self.account_id,
-                               provider=self.provider_name, logger=log)
+        if self.status_poller is not None:
+            self.status_poller.watch(self.folder_name)
+        handed_off = False
+        ran = False
+        try:
+            # NOTE: The parent ImapSyncMonitor handler could kill us at any
+            # time if it receives a shutdown command. The shutdown command is
+            # equivalent to ctrl-c.
+            while self.state != 'finish':
+                if (self.scheduler is not None and self.state == 'poll' and
+                        (ran or
+                         self.folder_name not in self.scheduler.handed_back)):
+                    self.flush_folder_state()
+                    self.scheduler.add(self)
+                    handed_off = True
+                    return
+                retry_with_logging(self._run_impl, account_id=self.account_id,
+                                   provider=self.provider_name, logger=log)
+                ran = True
+        finally:
+            if self.status_poller is not None and not handed_off:
+                self.status_poller.unwatch(self.folder_name)
 
     def _run_impl(self):
         old_state = self.state
@@ -277,6 +313,8 @@ class FolderSyncEngine(Greenlet):
         # Loads the folder sync status and invokes the provided callback to
         # modify it. Commits any changes and updates `self.state` to ensure
         # they are never out of sync.
+        # State changes are checkpoints for queued folder state too.
+        self.flush_folder_state()
         with session_scope(self.namespace_id) as db_session:
             try:
                 saved_folder_status = db_session.query(ImapFolderSyncStatus)\
@@ -371,8 +409,6 @@ class FolderSyncEngine(Greenlet):
 
             new_uids = set(remote_uids).difference(local_uids)
             with session_scope(self.namespace_id) as db_session:
-                account = db_session.query(Account).get(self.account_id)
-                throttled = account.throttled
                 self.update_uid_counts(
                     db_session,
                     remote_uid_count=len(remote_uids),
@@ -390,7 +426,7 @@ class FolderSyncEngine(Greenlet):
                 self.download_and_commit_uids(crispin_client, [uid])
                 self.heartbeat_status.publish()
                 count += 1
-                if throttled and count >= THROTTLE_COUNT:
+                if self.rate_controller.throttled and count >= THROTTLE_COUNT:
                     # Throttled accounts' folders sync at a rate of
                     # 1 message/ minute, after the first approx. THROTTLE_COUNT
                     # messages per folder are synced.
@@ -439,7 +475,31 @@ class FolderSyncEngine(Greenlet):
                 idling = False
         # Close IMAP connection before sleeping
         if not idling:
+            self.wait_for_changes()
+
+    def visit(self):
+        """ Poll the folder once, without idling or waiting afterwards. Used
+        by the ColdFolderScheduler, which decides when to visit the folder.
+        Returns whether anything changed since the previous visit.
+        """
+        before = (self.uidnext, self.highestmodseq)
+        with self.conn_pool.get() as crispin_client:
+            self.check_uid_changes(crispin_client)
+        self.heartbeat_status.publish(state=self.state)
+        return (self.uidnext, self.highestmodseq) != before
+
+    def wait_for_changes(self):
+        if self.status_poller is None:
             gevent.sleep(self.poll_frequency)
+            return
+        # With CONDSTORE, everything a poll looks at shows up in the folder
+        # status, so there's no need to wake up until the poller sees it
+        # change. Otherwise flags still need to be refreshed periodically.
+        if self._condstore_supported:
+            timeout = MAX_WAIT_FOR_CHANGE
+        else:
+            timeout = self.poll_frequency
+        self.status_poller.wait_for_change(self.folder_name, timeout)
 
     def resync_uids_impl(self):
         # First, let's check if the UIVDALIDITY change was spurious, if
@@ -468,6 +528,7 @@ class FolderSyncEngine(Greenlet):
         self.uidvalidity = remote_uidvalidity
         self.highestmodseq = None
         self.uidnext = remote_uidnext
+        self.flush_folder_state()
 
     @retry_crispin
     def poll_for_changes(self):
@@ -553,14 +614,32 @@ class FolderSyncEngine(Greenlet):
             else:
                 parent_thread.messages.append(message_obj)
 
+    def fetch_uids(self, crispin_client, uids):
+        """Download raw messages for `uids`, subject to the account's rate
+        controller."""
+        with self.rate_controller.slot():
+            start = time.time()
+            try:
+                raw_messages = crispin_client.uids(uids)
+            except imaplib.IMAP4.error as exc:
+                if is_throttling_error(exc):
+                    self.rate_controller.record_throttle(exc)
+                raise
+            latency = time.time() - start
+        num_bytes = sum(len(msg.body) for msg in raw_messages
+                        if msg.body is not None)
+        self.rate_controller.record_success(latency, num_bytes, len(uids))
+        return raw_messages
+
     def download_and_commit_uids(self, crispin_client, uids):
         start = datetime.utcnow()
-        raw_messages = crispin_client.uids(uids)
+        raw_messages = self.fetch_uids(crispin_client, uids)
         if not raw_messages:
             return 0
 
         new_uids = set()
-        with self.syncmanager_lock:
+        with self.syncmanager_lock, \
+                profile_queries('mailsync.download_and_commit_uids'):
             with session_scope(self.namespace_id) as db_session:
                 account = Account.get(self.account_id, db_session)
                 folder = Folder.get(self.folder_id, db_session)
@@ -618,22 +697,35 @@ class FolderSyncEngine(Greenlet):
             statsd_client.timing(metric, latency_per_uid)
 
     def update_uid_counts(self, db_session, **kwargs):
-        saved_status = db_session.query(ImapFolderSyncStatus).join(Folder). \
-            filter(ImapFolderSyncStatus.account_id == self.account_id,
-                   Folder.name == self.folder_name).one()
         # We're not updating the current_remote_count metric
         # so don't update uid_checked_timestamp.
         if kwargs.get('remote_uid_count') is None:
-            saved_status.update_metrics(kwargs)
+            metrics = kwargs
         else:
             metrics = dict(uid_checked_timestamp=datetime.utcnow())
             metrics.update(kwargs)
-            saved_status.update_metrics(metrics)
+        if self.state_writer is not None:
+            self.state_writer.update_metrics(self.folder_id, metrics)
+            return
+        saved_status = db_session.query(ImapFolderSyncStatus).join(Folder). \
+            filter(ImapFolderSyncStatus.account_id == self.account_id,
+                   Folder.name == self.folder_name).one()
+        saved_status.update_metrics(metrics)
+
+    def folder_status(self, crispin_client, what):
+        """STATUS `what` for this folder, taken from the account's status
+        poller if it has fresh values."""
+        if self.status_poller is not None:
+            status = self.status_poller.status(self.folder_name,
+                                               max_age=self.poll_frequency)
+            if status is not None and all(item in status for item in what):
+                return status
+        return crispin_client.conn.folder_status(self.folder_name, what)
 
     def get_new_uids(self, crispin_client):
         try:
-            remote_uidnext = crispin_client.conn.folder_status(
-                self.folder_name, ['UIDNEXT']).get('UIDNEXT')
+            remote_uidnext = self.folder_status(
+                crispin_client, ['UIDNEXT']).get('UIDNEXT')
         except ValueError:
             # Work around issue where ValueError is raised on parsing STATUS
             # response.
@@ -665,8 +757,8 @@ class FolderSyncEngine(Greenlet):
         self.uidnext = remote_uidnext
 
     def condstore_refresh_flags(self, crispin_client):
-        new_highestmodseq = crispin_client.conn.folder_status(
-            self.folder_name, ['HIGHESTMODSEQ'])['HIGHESTMODSEQ']
+        new_highestmodseq = self.folder_status(
+            crispin_client, ['HIGHESTMODSEQ'])['HIGHESTMODSEQ']
         # Ensure that we have an initial highestmodseq value stored before we
         # begin polling for changes.
         if self.highestmodseq is None:
@@ -795,7 +887,8 @@ class FolderSyncEngine(Greenlet):
 
     def check_uid_changes(self, crispin_client):
         self.get_new_uids(crispin_client)
-        if crispin_client.condstore_supported():
+        self._condstore_supported = crispin_client.condstore_supported()
+        if self._condstore_supported:
             self.condstore_refresh_flags(crispin_client)
         else:
             self.generic_refresh_flags(crispin_client)
@@ -858,6 +951,10 @@ class FolderSyncEngine(Greenlet):
             return imapfolderinfo
 
     def _update_imap_folder_info(self, attrname, value):
+        if self.state_writer is not None:
+            self.state_writer.update_folder_info(self.folder_id,
+                                                 **{attrname: value})
+            return
         with session_scope(self.namespace_id) as db_session:
             imapfolderinfo = db_session.query(ImapFolderInfo). \
                 filter(ImapFolderInfo.account_id == self.account_id,
@@ -866,6 +963,20 @@ class FolderSyncEngine(Greenlet):
             setattr(imapfolderinfo, attrname, value)
             db_session.commit()
 
+    def flush_folder_state(self):
+        """ Write this folder's queued state updates, if any. """
+        if self.state_writer is not None:
+            self.state_writer.flush(self.folder_id)
+
+    def discard_folder_state(self):
+        """ Drop this folder's queued state updates and cached folder
+        info, before it's changed behind the engine's back. """
+        if self.state_writer is not None:
+            self.state_writer.discard(self.folder_id)
+        for attrname in ('_uidvalidity', '_uidnext', '_highestmodseq',
+                         '_last_slow_refresh'):
+            self.__dict__.pop(attrname, None)
+
     def uidvalidity_cb(self, account_id, folder_name, select_info):
         assert folder_name == self.folder_name
         assert account_id == self.account_id
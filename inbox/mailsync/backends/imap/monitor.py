@@ -8,7 +8,12 @@ from inbox.models import Account, Folder
 from inbox.models.category import Category, sanitize_name
 from inbox.models.session import session_scope
 from inbox.mailsync.backends.base import BaseMailSyncMonitor
-from inbox.mailsync.backends.imap.generic import FolderSyncEngine
+from inbox.mailsync.backends.imap.generic import (FolderSyncEngine,
+                                                  INBOX_POLL_FREQUENCY)
+from inbox.mailsync.backends.imap.folderstate import FolderStateWriter
+from inbox.mailsync.backends.imap.poller import FolderStatusPoller
+from inbox.mailsync.backends.imap.scheduler import (ColdFolderScheduler,
+                                                    SCHEDULE_COLD_FOLDERS)
 from inbox.mailsync.gc import DeleteHandler
 log = get_logger()
 
@@ -35,6 +40,9 @@ class ImapSyncMonitor(BaseMailSyncMonitor):
 
         self.folder_monitors = Group()
         self.delete_handler = None
+        self.status_poller = None
+        self.folder_scheduler = None
+        self.folder_state_writer = None
 
         BaseMailSyncMonitor.__init__(self, account, heartbeat)
 
@@ -121,6 +129,9 @@ class ImapSyncMonitor(BaseMailSyncMonitor):
                             self.folder_monitors}
 
         for folder_name in self.prepare_sync():
+            if (self.folder_scheduler is not None and
+                    folder_name in self.folder_scheduler):
+                continue
             if folder_name in running_monitors:
                 thread = running_monitors[folder_name]
             else:
@@ -132,13 +143,18 @@ class ImapSyncMonitor(BaseMailSyncMonitor):
                                                 folder_name,
                                                 self.email_address,
                                                 self.provider_name,
-                                                self.syncmanager_lock)
+                                                self.syncmanager_lock,
+                                                status_poller=self.status_poller,
+                                                scheduler=self.folder_scheduler,
+                                                state_writer=self.folder_state_writer)
                 self.folder_monitors.start(thread)
 
             while not thread.state == 'poll' and not thread.ready():
                 sleep(self.heartbeat)
 
-            if thread.ready():
+            # Cold folders' engines exit once they hand over to the scheduler.
+            if thread.ready() and not (self.folder_scheduler is not None and
+                                       folder_name in self.folder_scheduler):
                 log.info('Folder sync engine exited',
                          account_id=self.account_id,
                          folder_name=folder_name,
@@ -153,9 +169,44 @@ class ImapSyncMonitor(BaseMailSyncMonitor):
                 uid_accessor=lambda m: m.imapuids)
             self.delete_handler.start()
 
+    def start_status_poller(self):
+        if self.status_poller is None:
+            self.status_poller = FolderStatusPoller(
+                self.account_id, connection_pool(self.account_id),
+                poll_frequency=INBOX_POLL_FREQUENCY)
+            self.status_poller.start()
+
+    def start_folder_state_writer(self):
+        if self.folder_state_writer is None:
+            self.folder_state_writer = FolderStateWriter(self.account_id,
+                                                         self.namespace_id)
+            self.folder_state_writer.start()
+
+    def start_folder_scheduler(self):
+        if SCHEDULE_COLD_FOLDERS and self.folder_scheduler is None:
+            self.folder_scheduler = ColdFolderScheduler(
+                self.account_id, status_poller=self.status_poller)
+            self.folder_scheduler.start()
+
+    def _cleanup(self):
+        if self.folder_scheduler is not None:
+            self.folder_scheduler.kill()
+            with session_scope(self.namespace_id) as db_session:
+                for engine in self.folder_scheduler.engines.values():
+                    engine.set_stopped(db_session)
+        if self.status_poller is not None:
+            self.status_poller.kill()
+        BaseMailSyncMonitor._cleanup(self)
+        if self.folder_state_writer is not None:
+            self.folder_state_writer.kill()
+            self.folder_state_writer.flush()
+
     def sync(self):
         try:
             self.start_delete_handler()
+            self.start_status_poller()
+            self.start_folder_state_writer()
+            self.start_folder_scheduler()
             self.start_new_folder_sync_engines()
             while True:
                 sleep(self.refresh_frequency)
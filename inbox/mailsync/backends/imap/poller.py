@@ -0,0 +1,119 @@
+"""
+Account-wide folder status polling.
+
+Rather than having every folder sync engine issue its own STATUS command on
+every poll, a single FolderStatusPoller per account fetches UIDNEXT (and
+HIGHESTMODSEQ, where CONDSTORE is supported) for all of the account's synced
+folders in one round trip, then wakes up only the engines whose folders
+changed. Engines use the poller's values instead of issuing STATUS
+themselves as long as they're fresh.
+
+"""
+import time
+
+import gevent
+from gevent import Greenlet
+from gevent.event import Event
+
+from inbox.crispin import retry_crispin
+from inbox.util.debug import bind_context
+from nylas.logging import get_logger
+log = get_logger()
+
+# Engines for folders on CONDSTORE-capable servers only need to wake up when
+# the poller sees a change; this is a safety net in case it misses one.
+MAX_WAIT_FOR_CHANGE = 300
+
+
+class FolderStatusPoller(Greenlet):
+    """
+    Periodically fetches the status of every watched folder of an account.
+
+    Parameters
+    ----------
+    account_id : int
+        Which account to poll.
+    conn_pool : CrispinConnectionPool
+        Pool to check out a connection from for each poll.
+    poll_frequency : int
+        Seconds to wait between polls.
+
+    """
+
+    def __init__(self, account_id, conn_pool, poll_frequency):
+        bind_context(self, 'folderstatuspoller', account_id)
+        self.account_id = account_id
+        self.conn_pool = conn_pool
+        self.poll_frequency = poll_frequency
+        # folder name -> (status dict, time fetched)
+        self.statuses = {}
+        # folder name -> Event set when the folder's status changes
+        self._changed = {}
+        Greenlet.__init__(self)
+
+    def watch(self, folder_name):
+        if folder_name not in self._changed:
+            self._changed[folder_name] = Event()
+
+    def unwatch(self, folder_name):
+        self._changed.pop(folder_name, None)
+        self.statuses.pop(folder_name, None)
+
+    def status(self, folder_name, max_age):
+        """ The last polled status for `folder_name`, or None if there isn't
+        one fetched within the last `max_age` seconds.
+        """
+        if folder_name not in self.statuses:
+            return None
+        status, fetched_at = self.statuses[folder_name]
+        if time.time() - fetched_at > max_age:
+            return None
+        return status
+
+    def wait_for_change(self, folder_name, timeout):
+        """ Block until the poller sees a change to `folder_name`'s status
+        (or one happened since the last call), or `timeout` seconds pass.
+        """
+        event = self._changed.get(folder_name)
+        if event is None:
+            gevent.sleep(timeout)
+            return
+        event.wait(timeout)
+        event.clear()
+
+    def pop_changed(self, folder_name):
+        """ Whether the poller saw a change to `folder_name`'s status since
+        the last call, without blocking.
+        """
+        event = self._changed.get(folder_name)
+        if event is None or not event.is_set():
+            return False
+        event.clear()
+        return True
+
+    def _run(self):
+        while True:
+            retry_crispin(self.poll)()
+            gevent.sleep(self.poll_frequency)
+
+    def poll(self):
+        folder_names = list(self._changed)
+        if not folder_names:
+            return
+        with self.conn_pool.get() as crispin_client:
+            what = ['UIDNEXT']
+            if crispin_client.condstore_supported():
+                what.append('HIGHESTMODSEQ')
+            statuses = crispin_client.folder_statuses(folder_names, what)
+        self.update(statuses)
+
+    def update(self, statuses):
+        now = time.time()
+        for folder_name, status in statuses.iteritems():
+            previous = self.statuses.get(folder_name)
+            self.statuses[folder_name] = (status, now)
+            if previous is not None and previous[0] == status:
+                continue
+            event = self._changed.get(folder_name)
+            if event is not None:
+                event.set()
@@ -0,0 +1,307 @@
+"""
+Adaptive download rate control for IMAP sync.
+
+Each account gets a RateController which decides how many UIDs a folder sync
+engine may download per batch and how many downloads may be in flight at
+once for the account. Limits follow an AIMD (additive increase,
+multiplicative decrease) scheme: every batch that completes within
+TARGET_BATCH_LATENCY grows the limits a little, while slow batches and
+provider throttling signals (Gmail's [OVERQUOTA]/[THROTTLED] responses,
+Office365's "Request is throttled" BAD responses) cut them down and, for
+throttling signals, pause downloads for a backoff period.
+
+Account controllers are chained to a controller for the provider's IMAP
+host, so that the limits for a host which is throttling many accounts at
+once shrink as a whole. The effective limits are the minimum of the two.
+Backoff periods only pause the throttled account.
+
+All state lives in memory. In particular the manual `Account.throttled` bit
+is only re-read from the database every ACCOUNT_STATE_TTL seconds rather
+than on every batch.
+
+"""
+from __future__ import division
+import re
+import time
+import threading
+import contextlib
+
+import imaplib
+import gevent
+from gevent.event import Event
+
+from inbox.config import config
+from inbox.models import Account
+from inbox.models.session import session_scope
+from inbox.util.stats import statsd_client
+from nylas.logging import get_logger
+log = get_logger()
+
+MIN_BATCH_SIZE = 1
+MAX_BATCH_SIZE = config.get('RATE_CONTROL_MAX_BATCH_SIZE', 30)
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = config.get('RATE_CONTROL_MAX_CONCURRENCY', 3)
+
+# Batches that take longer than this (in seconds) are treated as a sign of
+# congestion on the provider side.
+TARGET_BATCH_LATENCY = config.get('RATE_CONTROL_TARGET_BATCH_LATENCY', 10)
+
+ACCOUNT_DECREASE_FACTOR = 0.5
+# Host-wide limits are shared by many accounts, so back off more gently.
+HOST_DECREASE_FACTOR = 0.8
+
+# Seconds to pause downloads after a throttling signal. Doubles on
+# consecutive signals up to MAX_THROTTLE_BACKOFF.
+THROTTLE_BACKOFF = config.get('RATE_CONTROL_THROTTLE_BACKOFF', 30)
+MAX_THROTTLE_BACKOFF = config.get('RATE_CONTROL_MAX_THROTTLE_BACKOFF', 900)
+
+# How long (in seconds) a cached `Account.throttled` value is trusted.
+ACCOUNT_STATE_TTL = 60
+
+# Smoothing factor for the latency and throughput moving averages.
+EWMA_ALPHA = 0.2
+
+# Substrings of IMAP error responses which indicate the provider is
+# throttling us.
+THROTTLE_SIGNALS = (
+    '[OVERQUOTA]',
+    '[THROTTLED]',
+    'Request is throttled',
+    'Server Unavailable. 15',
+)
+
+_SUGGESTED_BACKOFF_RE = re.compile(r'Suggested Backoff Time: (\d+) millis')
+
+
+def is_throttling_error(exc):
+    """Whether `exc` is an IMAP error signalling provider throttling."""
+    if not isinstance(exc, imaplib.IMAP4.error):
+        return False
+    message = str(exc)
+    return any(signal in message for signal in THROTTLE_SIGNALS)
+
+
+def suggested_backoff(exc):
+    """
+    Returns the backoff (in seconds) suggested by the server in a throttling
+    response, or None. Office365 includes one in its BAD responses, e.g.
+    "Request is throttled. Suggested Backoff Time: 29963 milliseconds".
+
+    """
+    match = _SUGGESTED_BACKOFF_RE.search(str(exc))
+    if match is None:
+        return None
+    return int(match.group(1)) / 1000.0
+
+
+def _ewma(current, sample):
+    if current is None:
+        return sample
+    return (1 - EWMA_ALPHA) * current + EWMA_ALPHA * sample
+
+
+class RateController(object):
+    """
+    AIMD controller for the batch size and download concurrency of a single
+    account or IMAP host.
+
+    Parameters
+    ----------
+    name : str
+        Used for logging and metric names.
+    decrease_factor : float
+        Multiplier applied to the limits on a congestion signal.
+    initial_batch_size : int
+        Starting batch size; limits grow from there.
+    latency_sensitive : bool
+        Whether slow batches count as congestion signals, or only explicit
+        throttling responses do.
+    parent : RateController, optional
+        A host-wide controller whose limits also apply.
+
+    """
+
+    def __init__(self, name, decrease_factor=ACCOUNT_DECREASE_FACTOR,
+                 initial_batch_size=MIN_BATCH_SIZE, latency_sensitive=True,
+                 parent=None):
+        self.name = name
+        self.decrease_factor = decrease_factor
+        self.latency_sensitive = latency_sensitive
+        self.parent = parent
+        self._batch_size = float(initial_batch_size)
+        self._concurrency = float(MAX_CONCURRENCY)
+        self.latency = None
+        self.bytes_per_second = None
+        self.consecutive_throttles = 0
+        self.resume_at = 0
+        self._inflight = 0
+        self._slot_freed = Event()
+
+    @property
+    def batch_size(self):
+        size = int(self._batch_size)
+        if self.parent is not None:
+            size = min(size, self.parent.batch_size)
+        return max(MIN_BATCH_SIZE, size)
+
+    @property
+    def concurrency(self):
+        concurrency = int(self._concurrency)
+        if self.parent is not None:
+            concurrency = min(concurrency, self.parent.concurrency)
+        return max(MIN_CONCURRENCY, concurrency)
+
+    @property
+    def backoff_remaining(self):
+        return max(0, self.resume_at - time.time())
+
+    def _increase(self):
+        self._batch_size = min(MAX_BATCH_SIZE, self._batch_size + 1)
+        # Grow concurrency by roughly one slot per `concurrency` successes,
+        # as TCP does per round trip.
+        self._concurrency = min(MAX_CONCURRENCY,
+                                self._concurrency + 1 / self._concurrency)
+
+    def _decrease(self):
+        self._batch_size = max(MIN_BATCH_SIZE,
+                               self._batch_size * self.decrease_factor)
+        self._concurrency = max(MIN_CONCURRENCY,
+                                self._concurrency * self.decrease_factor)
+
+    def record_success(self, latency, num_bytes, num_uids):
+        """Record a completed download of `num_uids` UIDs."""
+        self.latency = _ewma(self.latency, latency)
+        if latency > 0:
+            self.bytes_per_second = _ewma(self.bytes_per_second,
+                                          num_bytes / latency)
+        self.consecutive_throttles = 0
+        if latency > TARGET_BATCH_LATENCY and self.latency_sensitive:
+            self._decrease()
+        elif num_uids >= self.batch_size:
+            # Only grow the window if we actually filled it.
+            self._increase()
+        if self.parent is not None:
+            self.parent.record_success(latency, num_bytes, num_uids)
+
+    def record_throttle(self, exc):
+        """Record a provider throttling signal and start backing off."""
+        self.consecutive_throttles += 1
+        self._decrease()
+        backoff = suggested_backoff(exc)
+        if backoff is None:
+            backoff = min(MAX_THROTTLE_BACKOFF,
+                          THROTTLE_BACKOFF *
+                          2 ** (self.consecutive_throttles - 1))
+        self.resume_at = max(self.resume_at, time.time() + backoff)
+        log.warning('Provider throttling detected; backing off',
+                    controller=self.name, backoff=backoff,
+                    batch_size=self.batch_size,
+                    concurrency=self.concurrency, error=str(exc))
+        statsd_client.incr('mailsync.ratecontrol.throttled')
+        if self.parent is not None:
+            # Providers throttle per account, so the other accounts on the
+            # host don't have to wait; they only get smaller limits.
+            self.parent._decrease()
+
+    @contextlib.contextmanager
+    def slot(self):
+        """
+        Wait out any active backoff and until fewer than `concurrency`
+        downloads are in flight, then hold a download slot.
+
+        """
+        backoff = self.backoff_remaining
+        if backoff:
+            gevent.sleep(backoff)
+        while self._inflight >= self.concurrency:
+            self._slot_freed.clear()
+            self._slot_freed.wait(timeout=1)
+        self._inflight += 1
+        try:
+            yield
+        finally:
+            self._inflight -= 1
+            self._slot_freed.set()
+
+    def stats(self):
+        return {
+            'batch_size': self.batch_size,
+            'concurrency': self.concurrency,
+            'inflight': self._inflight,
+            'latency': self.latency,
+            'bytes_per_second': self.bytes_per_second,
+            'backoff_remaining': self.backoff_remaining,
+        }
+
+
+class AccountRateController(RateController):
+    """
+    RateController for a single account, which also respects the manual
+    `Account.throttled` bit.
+
+    """
+
+    def __init__(self, account_id, parent=None):
+        RateController.__init__(self, 'account:{}'.format(account_id),
+                                parent=parent)
+        self.account_id = account_id
+        self._throttled = None
+        self._throttled_checked_at = None
+
+    @property
+    def throttled(self):
+        now = time.time()
+        if (self._throttled_checked_at is None or
+                now - self._throttled_checked_at > ACCOUNT_STATE_TTL):
+            with session_scope(self.account_id) as db_session:
+                self._throttled = bool(db_session.query(Account.throttled).
+                                       filter(Account.id == self.account_id).
+                                       scalar())
+            self._throttled_checked_at = now
+        return self._throttled
+
+    @property
+    def batch_size(self):
+        if self.throttled:
+            return MIN_BATCH_SIZE
+        return RateController.batch_size.fget(self)
+
+    @property
+    def concurrency(self):
+        if self.throttled:
+            return MIN_CONCURRENCY
+        return RateController.concurrency.fget(self)
+
+
+# Lazily-initialized maps of controllers, guarded by _controllers_lock.
+_host_controllers = {}
+_account_controllers = {}
+_controllers_lock = threading.Lock()
+
+
+def rate_controller(account_id, imap_host=None):
+    """
+    Per-account rate controller, chained to a controller shared by all
+    accounts on `imap_host` (if given).
+
+    """
+    with _controllers_lock:
+        if account_id not in _account_controllers:
+            parent = None
+            if imap_host is not None:
+                if imap_host not in _host_controllers:
+                    _host_controllers[imap_host] = RateController(
+                        'host:{}'.format(imap_host),
+                        decrease_factor=HOST_DECREASE_FACTOR,
+                        initial_batch_size=MAX_BATCH_SIZE,
+                        latency_sensitive=False)
+                parent = _host_controllers[imap_host]
+            _account_controllers[account_id] = AccountRateController(
+                account_id, parent=parent)
+        return _account_controllers[account_id]
+
+
+def rate_control_stats():
+    """Snapshot of all host-level controllers, for the HTTP frontend."""
+    return {host: controller.stats()
+            for host, controller in _host_controllers.items()}
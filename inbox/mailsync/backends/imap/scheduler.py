@@ -0,0 +1,144 @@
+"""
+Shared polling for an account's "cold" folders.
+
+By default every synced folder gets its own long-lived FolderSyncEngine
+greenlet. For accounts with hundreds of folders that costs a greenlet (and
+often a connection) per folder, although most folders rarely change. In
+folder scheduler mode (SCHEDULE_COLD_FOLDERS), only folders with a role in
+HOT_FOLDER_ROLES keep a dedicated engine. Other folders run their initial
+sync as usual and are then handed over to the account's ColdFolderScheduler,
+which visits them round-robin with a small pool of workers. Folders that
+keep changing are visited every MIN_VISIT_INTERVAL seconds; the interval
+doubles up to MAX_VISIT_INTERVAL for each visit that finds nothing new.
+
+"""
+import time
+
+import gevent
+from gevent import Greenlet
+from gevent.pool import Pool
+
+from inbox.config import config
+from inbox.util.debug import bind_context
+from nylas.logging import get_logger
+log = get_logger()
+
+SCHEDULE_COLD_FOLDERS = config.get('SCHEDULE_COLD_FOLDERS', False)
+HOT_FOLDER_ROLES = ('inbox', 'sent', 'drafts', 'all')
+# Cold folder visits check out connections from the account's pool, so one
+# worker means cold folders share a single connection.
+COLD_FOLDER_WORKERS = config.get('COLD_FOLDER_WORKERS', 1)
+MIN_VISIT_INTERVAL = 30
+MAX_VISIT_INTERVAL = 900
+SCHEDULER_TICK = 1
+
+
+def is_hot_folder(role):
+    return role in HOT_FOLDER_ROLES
+
+
+class ColdFolderScheduler(Greenlet):
+    """
+    Visits the cold folders of an account, taking over from their
+    FolderSyncEngines once they reach the 'poll' state.
+
+    Parameters
+    ----------
+    account_id : int
+        Which account the folders belong to.
+    status_poller : FolderStatusPoller, optional
+        If given, folders are also visited as soon as the poller sees their
+        status change.
+    num_workers : int
+        How many folders may be visited concurrently.
+
+    """
+
+    def __init__(self, account_id, status_poller=None,
+                 num_workers=COLD_FOLDER_WORKERS):
+        bind_context(self, 'coldfolderscheduler', account_id)
+        self.account_id = account_id
+        self.status_poller = status_poller
+        self.workers = Pool(num_workers)
+        self.engines = {}
+        self.intervals = {}
+        self.next_visit = {}
+        self._visiting = set()
+        # Folders handed back to a dedicated engine after a failed visit.
+        # Their new engine must run at least once before handing them over
+        # again, since only it recovers from the error.
+        self.handed_back = set()
+        Greenlet.__init__(self)
+
+    def __contains__(self, folder_name):
+        return folder_name in self.engines
+
+    def add(self, engine):
+        folder_name = engine.folder_name
+        log.info('Scheduling cold folder', account_id=self.account_id,
+                 folder_name=folder_name)
+        self.engines[folder_name] = engine
+        self.handed_back.discard(folder_name)
+        self.intervals[folder_name] = MIN_VISIT_INTERVAL
+        self.next_visit[folder_name] = time.time() + MIN_VISIT_INTERVAL
+        if self.status_poller is not None:
+            self.status_poller.watch(folder_name)
+
+    def remove(self, folder_name):
+        self.engines.pop(folder_name, None)
+        self.intervals.pop(folder_name, None)
+        self.next_visit.pop(folder_name, None)
+        if self.status_poller is not None:
+            self.status_poller.unwatch(folder_name)
+
+    def due(self, now):
+        """ Engines whose folders should be visited now, most overdue
+        first.
+        """
+        due = []
+        for folder_name, engine in self.engines.items():
+            if folder_name in self._visiting:
+                continue
+            changed = (self.status_poller is not None and
+                       self.status_poller.pop_changed(folder_name))
+            if changed or now >= self.next_visit[folder_name]:
+                due.append(engine)
+        return sorted(due, key=lambda e: self.next_visit[e.folder_name])
+
+    def _run(self):
+        try:
+            while True:
+                for engine in self.due(time.time()):
+                    self._visiting.add(engine.folder_name)
+                    # Blocks while all workers are busy.
+                    self.workers.spawn(self.visit, engine)
+                gevent.sleep(SCHEDULER_TICK)
+        finally:
+            self.workers.kill()
+
+    def visit(self, engine):
+        folder_name = engine.folder_name
+        try:
+            changed = engine.visit()
+        except Exception:
+            # Dedicated engines know how to recover from errors (UIDVALIDITY
+            # changes, deleted folders, ...), so hand the folder back. The
+            # monitor starts a new engine for it on its next refresh.
+            log.warning('Error visiting cold folder; handing it back to a '
+                        'dedicated engine', account_id=self.account_id,
+                        folder_name=folder_name, exc_info=True)
+            self.remove(folder_name)
+            self.handed_back.add(folder_name)
+            return
+        finally:
+            self._visiting.discard(folder_name)
+
+        if folder_name not in self.engines:
+            return
+        if changed:
+            interval = MIN_VISIT_INTERVAL
+        else:
+            interval = min(MAX_VISIT_INTERVAL,
+                           self.intervals[folder_name] * 2)
+        self.intervals[folder_name] = interval
+        self.next_visit[folder_name] = time.time() + interval
@@ -3,8 +3,10 @@ import gevent._threading  # This is a clone of the *real* threading module
 from pympler import muppy, summary
 from werkzeug.serving import run_simple, WSGIRequestHandler
 from flask import Flask, jsonify, request
+from inbox.ignition import engine_manager
 from inbox.instrumentation import (GreenletTracer, KillerGreenletTracer,
                                    ProfileCollector)
+from inbox.mailsync.backends.imap.ratecontrol import rate_control_stats
 
 
 class HTTPFrontend(object):
@@ -98,6 +100,15 @@ class SyncHTTPFrontend(ProfilingHTTPFrontend):
             else:
                 return 'Account not assigned to this process', 409
 
+        @app.route('/ratecontrol', methods=['GET'])
+        def ratecontrol():
+            return jsonify(rate_control_stats())
+
+        @app.route('/dbpool', methods=['GET'])
+        def dbpool():
+            return jsonify({str(key): stats for key, stats in
+                            engine_manager.pool_stats().iteritems()})
+
         @app.route('/build-metadata', methods=['GET'])
         def build_metadata():
             filename = '/usr/share/python/cloud-core/metadata.txt'
@@ -5,6 +5,7 @@ from sqlalchemy import func
 from sqlalchemy.orm import load_only
 from nylas.logging import get_logger
 log = get_logger()
+from inbox.ignition import engine_manager
 from inbox.models import Message, Thread
 from inbox.models.category import Category, EPOCH
 from inbox.models.message import MessageCategory
@@ -12,6 +13,7 @@ from inbox.models.folder import Folder
 from inbox.models.session import session_scope
 from inbox.util.concurrency import retry_with_logging
 from inbox.util.itert import chunk
+from inbox.util.stats import statsd_client
 from inbox.mailsync.backends.imap import common
 from inbox.util.debug import bind_context
 from inbox.mailsync.backends.imap.generic import uidvalidity_cb
@@ -68,10 +70,15 @@ class DeleteHandler(gevent.Greenlet):
                                provider=self.provider_name)
 
     def _run_impl(self):
-        current_time = datetime.datetime.utcnow()
-        self.check(current_time)
-        self.gc_deleted_categories()
-        self.gc_deleted_threads(current_time)
+        # Garbage collection can wait while the shard's connection pool is
+        # saturated; skip this round and leave the connections to sync.
+        if engine_manager.pool_saturated(self.namespace_id):
+            statsd_client.incr('mailsync.gc.deferred')
+        else:
+            current_time = datetime.datetime.utcnow()
+            self.check(current_time)
+            self.gc_deleted_categories()
+            self.gc_deleted_threads(current_time)
         gevent.sleep(self.message_ttl.total_seconds())
 
     def check(self, current_time):
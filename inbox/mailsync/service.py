@@ -9,6 +9,7 @@ from sqlalchemy.exc import OperationalError
 
 from inbox.providers import providers
 from inbox.config import config
+from inbox.crispin import close_connection_pool, enable_pool_keepalive
 from inbox.contacts.remote_sync import ContactSync
 from inbox.events.remote_sync import EventSync, GoogleEventSync
 from inbox.heartbeat.status import clear_heartbeat_status
@@ -89,6 +90,7 @@ class SyncService(object):
         self.poll_interval = int((random.random() * (poll_interval - min_poll_interval)) + min_poll_interval)
         self.semaphore = BoundedSemaphore(1)
         self.zone = config.get('ZONE')
+        enable_pool_keepalive()
 
         # Note that we don't partition by zone for the private queues.
         # There's not really a reason to since there's one queue per machine
@@ -308,6 +310,7 @@ class SyncService(object):
             if account_id in self.email_sync_monitors:
                 self.email_sync_monitors[account_id].kill()
                 del self.email_sync_monitors[account_id]
+            close_connection_pool(account_id)
 
             # Stop contacts sync if necessary
             if account_id in self.contact_sync_monitors:
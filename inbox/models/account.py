@@ -2,13 +2,15 @@ import os
 import traceback
 from datetime import datetime
 
+import redis
 from sqlalchemy import (Column, BigInteger, String, DateTime, Boolean,
                         ForeignKey, Enum, inspect, bindparam, Index, event)
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, object_session
 from sqlalchemy.orm.session import Session
 from sqlalchemy.sql.expression import false
 
 from inbox.config import config
+from inbox.ignition import redis_txn
 from inbox.sqlalchemy_ext.util import JSON, MutableDict, bakery
 
 from inbox.models.mixins import (HasPublicID, HasEmailAddress, HasRunState,
@@ -16,6 +18,7 @@ from inbox.models.mixins import (HasPublicID, HasEmailAddress, HasRunState,
                                  DeletedAtMixin)
 from inbox.models.base import MailSyncBase
 from inbox.models.calendar import Calendar
+from inbox.models.namespace import Namespace
 from inbox.scheduling.event_queue import EventQueue
 from inbox.providers import provider_info
 from nylas.logging.sentry import log_uncaught_errors
@@ -421,3 +424,52 @@ def after_flush(session, flush_context):
 
 Index('ix_account_sync_should_run_sync_host', Account.sync_should_run,
       Account.sync_host, mysql_length={'sync_host': 191})
+
+
+# Each account's version in redis is bumped when the account or its
+# namespace is updated or deleted, once the change commits, so that every
+# process caching them (see inbox.api.namespace_cache) sees they're stale.
+ACCOUNT_VERSION_KEY = 'account-version:{}'
+# Key in session.info of the ids of changed accounts.
+CHANGED_ACCOUNTS_KEY = 'changed_accounts'
+
+
+def get_account_version(account_id):
+    """ The account's version in redis. Raises redis.RedisError. """
+    return redis_txn.get(ACCOUNT_VERSION_KEY.format(account_id))
+
+
+def bump_account_versions(account_ids):
+    try:
+        pipe = redis_txn.pipeline(transaction=False)
+        for account_id in account_ids:
+            pipe.incr(ACCOUNT_VERSION_KEY.format(account_id))
+        pipe.execute()
+    except redis.RedisError:
+        log.warning('Error bumping account versions',
+                    account_ids=list(account_ids), exc_info=True)
+
+
+def _note_changed_account(mapper, connection, target):
+    account_id = target.id if isinstance(target, Account) else \
+        target.account_id
+    session = object_session(target)
+    if session is not None and account_id is not None:
+        session.info.setdefault(CHANGED_ACCOUNTS_KEY, set()).add(account_id)
+
+
+for event_name in ('after_update', 'after_delete'):
+    event.listen(Account, event_name, _note_changed_account, propagate=True)
+    event.listen(Namespace, event_name, _note_changed_account)
+
+
+@event.listens_for(Session, 'after_commit')
+def bump_changed_account_versions(session):
+    account_ids = session.info.pop(CHANGED_ACCOUNTS_KEY, None)
+    if account_ids:
+        bump_account_versions(account_ids)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_changed_accounts(session):
+    session.info.pop(CHANGED_ACCOUNTS_KEY, None)
@@ -0,0 +1,114 @@
+from collections import Counter
+
+from sqlalchemy import Column, Integer, event, inspect
+from sqlalchemy.dialects.mysql import VARCHAR
+from sqlalchemy.sql import text
+
+from inbox.models.base import MailSyncBase
+from inbox.models.block import Block
+from inbox.models.message import Message, MessageBody
+
+
+class BlobReference(MailSyncBase):
+    """
+    How many messages, message bodies and blocks on this shard reference a
+    blockstore hash.
+
+    Counts are maintained as rows are inserted, updated and deleted, so that
+    deleting a namespace can tell which of its blobs are still used by
+    other namespaces without searching the message and block tables.
+
+    Blobs referenced by rows which predate this table aren't counted.
+    A positive count therefore reliably means a blob is in use, but a zero
+    or missing count has to be double-checked (see unreferenced_hashes).
+
+    """
+    data_sha256 = Column(VARCHAR(64, charset='ascii'), nullable=False,
+                         unique=True)
+    refcount = Column(Integer, nullable=False, default=0)
+
+
+_add_references = text(
+    'INSERT INTO blobreference (data_sha256, refcount) '
+    'VALUES (:data_sha256, :count) '
+    'ON DUPLICATE KEY UPDATE refcount = refcount + VALUES(refcount)')
+
+_remove_references = text(
+    'UPDATE blobreference SET refcount = GREATEST(refcount - :count, 0) '
+    'WHERE data_sha256 = :data_sha256')
+
+
+def _execute(connection, statement, hashes):
+    counts = Counter(h for h in hashes if h)
+    if counts:
+        connection.execute(statement, [{'data_sha256': h, 'count': count}
+                                       for h, count in counts.iteritems()])
+
+
+def add_blob_references(connection, hashes):
+    _execute(connection, _add_references, hashes)
+
+
+def remove_blob_references(connection, hashes):
+    """
+    Decrement reference counts for `hashes`, one per occurrence. Callers
+    which bulk-delete messages or blocks must call this themselves, since
+    that bypasses the ORM events below.
+
+    """
+    _execute(connection, _remove_references, hashes)
+
+
+def unreferenced_hashes(db_session, hashes):
+    """
+    The subset of `hashes` which no message, body or block on the shard
+    references any more, and which can hence be removed from the
+    blockstore. Their BlobReference rows are deleted.
+
+    """
+    hashes = set(filter(None, hashes))
+    if not hashes:
+        return set()
+
+    counts = dict(db_session.query(BlobReference.data_sha256,
+                                   BlobReference.refcount).
+                  filter(BlobReference.data_sha256.in_(hashes)))
+    candidates = {h for h in hashes if counts.get(h, 0) <= 0}
+    if not candidates:
+        return set()
+
+    # Double-check zero and missing counts, which may be due to references
+    # from before counts were kept. All these columns are indexed.
+    referenced = set()
+    for column in (Message.data_sha256, MessageBody.data_sha256,
+                   Block.data_sha256):
+        referenced.update(h for h, in db_session.query(column).
+                          filter(column.in_(candidates)).distinct())
+    unreferenced = candidates - referenced
+
+    if unreferenced:
+        db_session.query(BlobReference).filter(
+            BlobReference.data_sha256.in_(unreferenced),
+            BlobReference.refcount <= 0).delete(synchronize_session=False)
+    return unreferenced
+
+
+def _after_insert(mapper, connection, target):
+    add_blob_references(connection, [target.data_sha256])
+
+
+def _after_update(mapper, connection, target):
+    history = inspect(target).attrs.data_sha256.history
+    if history.has_changes():
+        remove_blob_references(connection, history.deleted)
+        add_blob_references(connection, history.added)
+
+
+def _after_delete(mapper, connection, target):
+    remove_blob_references(connection, [target.data_sha256])
+
+
+for cls in (Message, MessageBody, Block):
+    event.listen(cls, 'after_insert', _after_insert, propagate=True)
+    event.listen(cls, 'after_update', _after_update, propagate=True)
+    event.listen(cls, 'after_delete', _after_delete, propagate=True)
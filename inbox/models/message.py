@@ -7,7 +7,7 @@ from collections import defaultdict
 
 from flanker import mime
 from sqlalchemy import (Column, Integer, BigInteger, String, DateTime,
-                        Boolean, Enum, Index, bindparam)
+                        Boolean, Enum, Index, bindparam, inspect)
 from sqlalchemy.dialects.mysql import LONGBLOB, VARCHAR
 from sqlalchemy.orm import (relationship, backref, validates, joinedload,
                             subqueryload, load_only, synonym)
@@ -21,7 +21,10 @@ from inbox.util.html import plaintext2html, strip_tags
 from inbox.sqlalchemy_ext.util import JSON, json_field_too_long, bakery
 from inbox.util.addr import parse_mimepart_address_header
 from inbox.util.misc import parse_references, get_internaldate
-from inbox.util.blockstore import save_to_blockstore
+from inbox.util.blockstore import (save_to_blockstore, get_from_blockstore,
+                                   get_many_from_blockstore)
+from inbox.s3.base import get_raw_from_provider
+from inbox.s3.exc import EmailFetchException
 from inbox.security.blobstorage import encode_blob, decode_blob
 from inbox.models.mixins import (HasPublicID, HasRevisions, UpdatedAtMixin,
                                  DeletedAtMixin)
@@ -33,6 +36,13 @@ from inbox.util.encoding import unicode_safe_truncate
 
 SNIPPET_LENGTH = 191
 
+# Where new message bodies are stored: 'inline' in the message table,
+# 'table' in the narrow messagebody table, or 'blockstore' (with the
+# messagebody table pointing to the blob). Bodies stored out of row are only
+# loaded when Message.body is accessed. Existing bodies are moved with
+# bin/backfill-message-bodies.
+BODY_STORAGE = config.get('MESSAGE_BODY_STORAGE', 'inline')
+
 
 def _trim_filename(s, namespace_id, max_len=255):
     if s is None:
@@ -479,18 +489,44 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin,
     def calculate_plaintext_snippet(self, text):
         return unicode_safe_truncate(' '.join(text.split()), SNIPPET_LENGTH)
 
+    def _may_have_stored_body(self):
+        # While bodies are stored inline, only look at stored_body if it's
+        # already loaded, so that bodies don't cost a lazy load each.
+        return (BODY_STORAGE != 'inline' or
+                'stored_body' not in inspect(self).unloaded)
+
     @property
     def body(self):
-        if self._compacted_body is None:
+        blob = self._compacted_body
+        if (blob is None and self._may_have_stored_body() and
+                self.stored_body is not None):
+            blob = self.stored_body.blob
+        if blob is None:
             return None
-        return decode_blob(self._compacted_body).decode('utf-8')
+        return decode_blob(blob).decode('utf-8')
 
     @body.setter
     def body(self, value):
-        if value is None:
-            self._compacted_body = None
-        else:
-            self._compacted_body = encode_blob(value.encode('utf-8'))
+        blob = None
+        if value is not None:
+            blob = encode_blob(value.encode('utf-8'))
+        self.store_body(blob)
+
+    def store_body(self, blob, storage=None):
+        """ Store an encoded body blob (or None), in the message table or
+        out of row according to `storage` (BODY_STORAGE by default).
+        """
+        storage = storage or BODY_STORAGE
+        if blob is None or storage == 'inline':
+            self._compacted_body = blob
+            if self._may_have_stored_body():
+                self.stored_body = None
+            return
+
+        self._compacted_body = None
+        if self.stored_body is None:
+            self.stored_body = MessageBody()
+        self.stored_body.store(blob, storage)
 
     @property
     def participants(self):
@@ -599,13 +635,30 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin,
                    '_compacted_body', 'thread_id', 'namespace_id']
         if expand:
             columns += ['message_id_header', 'in_reply_to', 'references']
-        return (
+        options = (
             load_only(*columns),
             subqueryload('parts').joinedload('block'),
             subqueryload('thread').load_only('public_id', 'discriminator'),
             subqueryload('events').load_only('public_id', 'discriminator'),
             subqueryload('messagecategories').joinedload('category')
         )
+        return options + cls.body_loading_options()
+
+    @classmethod
+    def body_loading_options(cls):
+        if BODY_STORAGE == 'inline':
+            return ()
+        # API responses include bodies, so load them all at once.
+        return (subqueryload('stored_body'),)
+
+    @classmethod
+    def prefetch_bodies(cls, messages):
+        """ Fetch the bodies of `messages` stored in the blockstore
+        concurrently (see MessageBody.prefetch).
+        """
+        if BODY_STORAGE != 'inline':
+            MessageBody.prefetch([message.stored_body for message
+                                  in messages])
 
 
 # Need to explicitly specify the index length for table generation with MySQL
@@ -658,3 +711,129 @@ class MessageCategory(MailSyncBase):
 
 Index('message_category_ids',
       MessageCategory.message_id, MessageCategory.category_id)
+
+
+class MessageBody(MailSyncBase):
+    """
+    A message body stored out of the message table, so that scanning
+    messages doesn't read bodies. The encoded blob is either stored here,
+    or in the blockstore (keyed by its hash).
+
+    """
+    message_id = Column(BigInteger, nullable=False, unique=True)
+    message = relationship(
+        'Message',
+        primaryjoin='foreign(MessageBody.message_id) == remote(Message.id)',
+        backref=backref('stored_body',
+                        uselist=False,
+                        cascade="all, delete-orphan"))
+
+    data = Column(LONGBLOB, nullable=True)
+    data_sha256 = Column(VARCHAR(64, charset='ascii'), nullable=True,
+                         index=True)
+
+    def store(self, blob, storage):
+        if storage == 'blockstore':
+            data_sha256 = sha256(blob).hexdigest()
+            save_to_blockstore(data_sha256, blob)
+            self.data, self.data_sha256 = None, data_sha256
+            self._blob = (data_sha256, blob)
+        else:
+            assert storage == 'table', \
+                'Unknown body storage {}'.format(storage)
+            self.data, self.data_sha256 = blob, None
+
+    @staticmethod
+    def prefetch(bodies):
+        """
+        Fetch the blobs of `bodies` that are in the blockstore concurrently,
+        so that a page of messages costs one round trip rather than one per
+        message. Bodies that weren't found are recovered when read.
+
+        """
+        bodies = [body for body in bodies if body is not None and
+                  body.data is None and body.data_sha256 is not None]
+        values = get_many_from_blockstore(
+            [body.data_sha256 for body in bodies])
+        for body in bodies:
+            value = values.get(body.data_sha256)
+            if value is not None:
+                body._blob = (body.data_sha256, value)
+
+    @property
+    def blob(self):
+        if self.data is not None or self.data_sha256 is None:
+            return self.data
+        data_sha256, blob = getattr(self, '_blob', (None, None))
+        if data_sha256 != self.data_sha256:
+            blob = get_from_blockstore(self.data_sha256)
+            if blob is None:
+                log.warning('Message body missing from blockstore',
+                            message_id=self.message_id,
+                            data_sha256=self.data_sha256)
+                blob = self._recover()
+            self._blob = (self.data_sha256, blob)
+        return blob
+
+    def _recover(self):
+        """
+        Rebuild a body missing from the blockstore from the raw message
+        (fetched from the provider if it's gone too), like Block.data does
+        for attachments.
+
+        """
+        message = self.message
+        raw_mime = get_from_blockstore(message.data_sha256)
+        if raw_mime is None:
+            raw_mime = get_raw_from_provider(message)
+            if raw_mime is None:
+                raise EmailFetchException(
+                    "Couldn't find message {} on the email server".format(
+                        message.id))
+            save_to_blockstore(sha256(raw_mime).hexdigest(), raw_mime,
+                               repair=True)
+
+        parsed = mime.from_string(raw_mime)
+        html_parts = []
+        plain_parts = []
+        for mimepart in parsed.walk(
+                with_self=parsed.content_type.is_singlepart()):
+            if not mimepart.content_type.is_multipart():
+                _add_text_body_part(mimepart, html_parts, plain_parts)
+        html_body = ''.join(html_parts).decode('utf-8').strip()
+        if not html_body:
+            plain_body = '\n'.join(plain_parts).decode('utf-8').strip()
+            html_body = plaintext2html(plain_body, False)
+
+        blob = encode_blob(html_body.encode('utf-8'))
+        # Encrypted blobs don't encode the same way twice. Those aren't
+        # stored again, since API reads may use a read-only session; they're
+        # rebuilt from the raw message, which is, on every read.
+        if sha256(blob).hexdigest() == self.data_sha256:
+            save_to_blockstore(self.data_sha256, blob, repair=True)
+        log.info('Recovered message body', message_id=self.message_id,
+                 data_sha256=self.data_sha256)
+        return blob
+
+
+def _add_text_body_part(mimepart, html_parts, plain_parts):
+    """ Add `mimepart` to `html_parts` or `plain_parts` if it's part of the
+    text body, as Message._parse_mimepart does, skipping attachments.
+    """
+    disposition, _ = mimepart.content_disposition
+    content_type, _ = mimepart.content_type
+    if disposition not in (None, 'inline'):
+        return
+    if disposition == 'inline' and (mimepart.detected_file_name or
+                                    mimepart.headers.get('Content-Id')):
+        return
+    data = mimepart.body
+    if data is None:
+        return
+    normalized_data = data.encode('utf-8', 'strict')
+    normalized_data = normalized_data.replace('\r\n', '\n'). \
+        replace('\r', '\n')
+    if content_type == 'text/html':
+        html_parts.append(normalized_data)
+    elif content_type == 'text/plain':
+        plain_parts.append(normalized_data)
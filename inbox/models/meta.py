@@ -7,6 +7,7 @@ def load_models():
     from inbox.models.base import MailSyncBase
     from inbox.models.action_log import ActionLog
     from inbox.models.block import Block, Part
+    from inbox.models.blob_reference import BlobReference
     from inbox.models.contact import (EventContactAssociation,
                                       MessageContactAssociation, Contact,
                                       PhoneNumber)
@@ -14,7 +15,7 @@ def load_models():
     from inbox.models.data_processing import DataProcessingCache
     from inbox.models.event import Event
     from inbox.models.folder import Folder
-    from inbox.models.message import Message, MessageCategory
+    from inbox.models.message import Message, MessageCategory, MessageBody
     from inbox.models.namespace import Namespace
     from inbox.models.search import ContactSearchIndexCursor
     from inbox.models.secret import Secret
@@ -29,5 +30,6 @@ def load_models():
                DataProcessingCache, Event, EventContactAssociation, Folder,
                Message, Namespace, ContactSearchIndexCursor, Secret,
                Thread, Transaction, When, Time, TimeSpan, Date, DateSpan,
-               Label, Category, MessageCategory, Metadata, AccountTransaction]
+               Label, Category, MessageCategory, Metadata, AccountTransaction,
+               BlobReference, MessageBody]
     return exports
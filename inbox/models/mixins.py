@@ -3,6 +3,7 @@ from datetime import datetime
 
 from sqlalchemy import Column, DateTime, String, inspect, Boolean, sql, func
 from sqlalchemy.ext.hybrid import hybrid_property, Comparator
+from sqlalchemy.orm import object_session
 
 from inbox.sqlalchemy_ext.util import Base36UID, generate_public_id, ABCMixin
 from inbox.models.constants import MAX_INDEXABLE_LENGTH
@@ -10,6 +11,19 @@ from inbox.util.addr import canonicalize_address
 from inbox.util.encoding import unicode_safe_truncate
 
 
+# Key in session.info of the objects in the session that were manually marked
+# as dirty, by id.
+MARKED_DIRTY_KEY = 'marked_dirty'
+
+
+def track_dirty(session, obj):
+    marked = session.info.setdefault(MARKED_DIRTY_KEY, {})
+    if getattr(obj, 'dirty', False):
+        marked[id(obj)] = obj
+    else:
+        marked.pop(id(obj), None)
+
+
 class HasRevisions(ABCMixin):
     """Mixin for tables that should be versioned in the transaction log."""
     @property
@@ -54,6 +68,24 @@ class HasRevisions(ABCMixin):
     # Must be defined by subclasses
     API_OBJECT_NAME = abc.abstractproperty()
 
+    @property
+    def dirty(self):
+        """
+        Whether the object was manually marked as changed, so that it gets an
+        update revision even if none of its versioned attributes changed.
+        Marked objects are tracked by their session, so that flushes don't
+        have to look through the whole session for them.
+
+        """
+        return getattr(self, '_dirty', False)
+
+    @dirty.setter
+    def dirty(self, value):
+        self._dirty = value
+        session = object_session(self)
+        if session is not None:
+            track_dirty(session, self)
+
     def has_versioned_changes(self):
         """
         Return True if the object has changes on any of its column properties
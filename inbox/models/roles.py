@@ -17,7 +17,23 @@ STORE_MESSAGE_ATTACHMENTS = config.get('STORE_MESSAGE_ATTACHMENTS', True)
 class Blob(object):
     """ A blob of data that can be saved to local or remote (S3) disk. """
     size = Column(Integer, default=0)
-    data_sha256 = Column(String(64))
+    data_sha256 = Column(String(64), index=True)
+
+    @staticmethod
+    def prefetch(blobs):
+        """
+        Fetch the data of `blobs` from the blockstore concurrently. Returns
+        a dict of hash to data, which callers should use rather than each
+        blob's `data`: large blocks aren't cached, and a large prefetch can
+        evict its own blocks from the cache. Blobs whose data wasn't found
+        are left out, so that reading their `data` tries the provider.
+
+        """
+        values = blockstore.get_many_from_blockstore(
+            [blob.data_sha256 for blob in blobs
+             if blob.size and not hasattr(blob, '_data')])
+        return {data_sha256: value for data_sha256, value
+                in values.iteritems() if value is not None}
 
     @property
     def data(self):
@@ -67,7 +83,7 @@ class Blob(object):
 
                         with statsd_client.timer('{}.blockstore_save_latency'.format(
                                                  statsd_string)):
-                            blockstore.save_to_blockstore(msg_sha256, raw_mime)
+                            blockstore.save_to_blockstore(msg_sha256, raw_mime, repair=True)
                     else:
                         # We found it in the blockstore --- report this.
                         statsd_client.incr('{}.cache_hits'.format(statsd_string))
@@ -100,7 +116,7 @@ class Blob(object):
 
                                 with statsd_client.timer('{}.blockstore_save_latency'.format(
                                                          statsd_string)):
-                                    blockstore.save_to_blockstore(self.data_sha256, data)
+                                    blockstore.save_to_blockstore(self.data_sha256, data, repair=True)
                                     return data
                     log.error("Couldn't find the attachment in the raw message", message_id=message.id)
 
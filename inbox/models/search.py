@@ -1,8 +1,7 @@
-from sqlalchemy import Column, ForeignKey
+from sqlalchemy import Column, BigInteger
 
 from inbox.models.base import MailSyncBase
 from inbox.models.mixins import UpdatedAtMixin, DeletedAtMixin
-from inbox.models.transaction import Transaction
 
 
 class ContactSearchIndexCursor(MailSyncBase, UpdatedAtMixin,
@@ -12,5 +11,5 @@ class ContactSearchIndexCursor(MailSyncBase, UpdatedAtMixin,
     Is namespace-agnostic.
 
     """
-    transaction_id = Column(ForeignKey(Transaction.id), nullable=True,
-                            index=True)
+    # Not a foreign key, since the transaction table is partitioned.
+    transaction_id = Column(BigInteger, nullable=True, index=True)
@@ -9,6 +9,7 @@ from sqlalchemy.ext.horizontal_shard import ShardedSession
 
 from inbox.config import config
 from inbox.ignition import engine_manager
+from inbox.util import blockstore
 from inbox.util.stats import statsd_client
 from nylas.logging import get_logger, find_first_app_frame_and_name
 log = get_logger()
@@ -45,13 +46,22 @@ def new_session(engine, versioned=True):
 
         # Make statsd calls for transaction times
         transaction_start_map = {}
-        frame, modname = find_first_app_frame_and_name(
-            ignores=['sqlalchemy', 'inbox.models.session', 'nylas.logging',
-                     'contextlib'])
-        funcname = frame.f_code.co_name
-        modname = modname.replace(".", "-")
-        metric_name = 'db.{}.{}.{}'.format(engine.url.database, modname,
-                                           funcname)
+        caller = {}
+
+        def get_caller():
+            # Walking the stack is expensive, so it's only done once a
+            # transaction needs to be reported. Sessions are usually
+            # committed by the code which created them, via session_scope.
+            if not caller:
+                frame, modname = find_first_app_frame_and_name(
+                    ignores=['sqlalchemy', 'inbox.models.session',
+                             'nylas.logging', 'contextlib'])
+                caller['modname'] = modname.replace(".", "-")
+                caller['funcname'] = frame.f_code.co_name
+                caller['metric_name'] = 'db.{}.{}.{}'.format(
+                    engine.url.database, caller['modname'],
+                    caller['funcname'])
+            return caller
 
         @event.listens_for(session, 'after_begin')
         def after_begin(session, transaction, connection):
@@ -73,21 +83,55 @@ def new_session(engine, versioned=True):
             t = time.time()
             latency = int((t - start_time) * 1000)
             if config.get('ENABLE_DB_TXN_METRICS', False):
+                metric_name = get_caller()['metric_name']
                 statsd_client.timing(metric_name, latency)
                 statsd_client.incr(metric_name)
             if latency > MAX_SANE_TRX_TIME_MS:
                 log.warning('Long transaction', latency=latency,
-                            modname=modname, funcname=funcname)
+                            modname=get_caller()['modname'],
+                            funcname=get_caller()['funcname'])
 
     return session
 
 
+@event.listens_for(Session, 'before_commit')
+def wait_for_blockstore_uploads(session):
+    # Rows about to be committed may reference blocks that are still being
+    # uploaded in the background; make sure they're stored first.
+    blockstore.wait_for_uploads()
+
+
+@event.listens_for(Session, 'after_flush')
+def note_writes(session, flush_context):
+    session.info['has_writes'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def clear_writes(session):
+    session.info.pop('has_writes', None)
+
+
+def has_writes(session):
+    """ Whether the session's transaction has changes to commit, flushed
+    or not. Statements run with session.execute aren't tracked. """
+    return bool(session.info.get('has_writes') or session.new or
+                session.dirty or session.deleted)
+
+
 def configure_versioning(session):
+    from inbox.models.mixins import track_dirty
     from inbox.models.transaction import (
         create_revisions, propagate_changes, increment_versions,
-        bump_redis_txn_id
+        collect_txn_ids, bump_redis_txn_id, discard_txn_ids
     )
 
+    @event.listens_for(session, 'after_attach')
+    def after_attach(session, instance):
+        # Objects may have been marked as dirty before joining the session.
+        if getattr(instance, 'dirty', False):
+            track_dirty(session, instance)
+
     @event.listens_for(session, 'before_flush')
     def before_flush(session, flush_context, instances):
         propagate_changes(session)
@@ -100,18 +144,29 @@ def configure_versioning(session):
         grab object IDs on new objects.
 
         """
-        # Note: `bump_redis_txn_id` __must__ come first. `create_revisions`
+        # Note: `collect_txn_ids` __must__ come first. `create_revisions`
         # creates new objects which haven't been flushed to the db yet.
-        # `bump_redis_txn_id` looks at objects on the session and expects them
+        # `collect_txn_ids` looks at objects on the session and expects them
         # to have already have an id (since they've already been flushed to the
         # db)
         try:
-            bump_redis_txn_id(session)
+            collect_txn_ids(session)
         except Exception:
-            log.exception('bump_redis_txn_id exception')
+            log.exception('collect_txn_ids exception')
             pass
         create_revisions(session)
 
+    @event.listens_for(session, 'after_commit')
+    def after_commit(session):
+        try:
+            bump_redis_txn_id(session)
+        except Exception:
+            log.exception('bump_redis_txn_id exception')
+
+    @event.listens_for(session, 'after_rollback')
+    def after_rollback(session):
+        discard_txn_ids(session)
+
     return session
 
 
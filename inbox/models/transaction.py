@@ -1,16 +1,33 @@
+import time
+
 import redis
 from sqlalchemy import (Column, BigInteger, String, Index, Enum,
                         inspect, func)
 from sqlalchemy.orm import relationship
+from sqlalchemy.util import IdentitySet
 
 from inbox.config import config
 from inbox.ignition import redis_txn
 from inbox.models.base import MailSyncBase
 from inbox.models.category import EPOCH
-from inbox.models.mixins import HasPublicID, HasRevisions
+from inbox.models.mixins import (HasPublicID, HasRevisions,
+                                 MARKED_DIRTY_KEY)
 from inbox.models.namespace import Namespace
+from nylas.logging import get_logger
+log = get_logger()
 
 TXN_REDIS_KEY = 'latest-txn-by-namespace'
+# Key in session.info of the latest transaction ids by namespace public id,
+# to be published to redis on commit.
+TXN_IDS_KEY = 'txn_ids'
+TXN_REDIS_RETRY_INTERVAL = config.get('TXN_REDIS_RETRY_INTERVAL', 10)
+MAX_CACHED_PUBLIC_IDS = 100000
+
+_namespace_public_ids = {}
+# Transaction ids which couldn't be published yet, and when to try again.
+_unpublished = {}
+_retry_after = 0
+_zadd_gt_supported = True
 
 
 class Transaction(MailSyncBase, HasPublicID):
@@ -52,22 +69,48 @@ Index('ix_accounttransaction_namespace_id_created_at',
       AccountTransaction.namespace_id, AccountTransaction.created_at)
 
 
-def is_dirty(session, obj):
-    if obj in session.dirty and obj.has_versioned_changes():
+def is_dirty(obj, dirty):
+    """ Whether `obj` has versioned changes or was marked as dirty, given
+    the session's (pre-computed) `dirty` set. """
+    if obj in dirty and obj.has_versioned_changes():
         return True
     if hasattr(obj, 'dirty') and getattr(obj, 'dirty'):
         return True
     return False
 
 
+def marked_dirty(session):
+    """ The objects in the session which were manually marked as dirty. """
+    return [obj for obj in session.info.get(MARKED_DIRTY_KEY, {}).values()
+            if obj in session]
+
+
+def changed_objects(session, dirty):
+    """
+    The objects in the session which may need revisions: the new, modified,
+    deleted and manually marked ones. Modified objects are tracked by the
+    session through attribute events, so this is proportional to what
+    changed rather than to the size of the session.
+
+    """
+    objects = IdentitySet(session.new)
+    objects.update(dirty)
+    objects.update(session.deleted)
+    objects.update(marked_dirty(session))
+    return objects
+
+
 def create_revisions(session):
-    for obj in session:
+    new = session.new
+    dirty = session.dirty
+    deleted = session.deleted
+    for obj in changed_objects(session, dirty):
         if (not isinstance(obj, HasRevisions) or
                 obj.should_suppress_transaction_creation):
             continue
-        if obj in session.new:
+        if obj in new:
             create_revision(obj, session, 'insert')
-        elif is_dirty(session, obj):
+        elif is_dirty(obj, dirty):
             # Need to unmark the object as 'dirty' to prevent an infinite loop
             # (the pre-flush hook may be called again before a commit
             # occurs). This emulates what happens to objects in session.dirty,
@@ -75,7 +118,7 @@ def create_revisions(session):
             # invocation of the pre-flush hook.
             obj.dirty = False
             create_revision(obj, session, 'update')
-        elif obj in session.deleted:
+        elif obj in deleted:
             create_revision(obj, session, 'delete')
 
 
@@ -140,34 +183,97 @@ def propagate_changes(session):
 def increment_versions(session):
     from inbox.models.thread import Thread
     from inbox.models.metadata import Metadata
-    for obj in session:
-        if isinstance(obj, Thread) and is_dirty(session, obj):
+    dirty = session.dirty
+    objects = IdentitySet(dirty)
+    objects.update(marked_dirty(session))
+    for obj in objects:
+        if isinstance(obj, Thread) and is_dirty(obj, dirty):
             # This issues SQL for an atomic increment.
             obj.version = Thread.version + 1
-        if isinstance(obj, Metadata) and is_dirty(session, obj):
+        if isinstance(obj, Metadata) and is_dirty(obj, dirty):
             # This issues SQL for an atomic increment.
             obj.version = Metadata.version + 1  # TODO what's going on here?
 
 
+def get_namespace_public_id(session, namespace_id):
+    """ The public id of a namespace, cached since it never changes. """
+    public_id = _namespace_public_ids.get(namespace_id)
+    if public_id is None:
+        # The namespace was just used to create the transaction, so it
+        # should still be in the session. If not, a sql statement will be
+        # emitted.
+        namespace = session.query(Namespace).get(namespace_id)
+        assert namespace, "namespace for transaction doesn't exist"
+        public_id = str(namespace.public_id)
+        if len(_namespace_public_ids) >= MAX_CACHED_PUBLIC_IDS:
+            _namespace_public_ids.clear()
+        _namespace_public_ids[namespace_id] = public_id
+    return public_id
+
+
+def collect_txn_ids(session):
+    """
+    Called from the post-flush hook to note the latest transaction id of
+    each namespace with new transactions, to be published to redis once the
+    session commits (see bump_redis_txn_id).
+
+    """
+    txn_ids = session.info.setdefault(TXN_IDS_KEY, {})
+    for obj in session.new:
+        if isinstance(obj, Transaction) and obj.id:
+            public_id = get_namespace_public_id(session, obj.namespace_id)
+            txn_ids[public_id] = max(obj.id, txn_ids.get(public_id, 0))
+
+
+def discard_txn_ids(session):
+    """ Called on rollback: the transactions weren't committed. """
+    session.info.pop(TXN_IDS_KEY, None)
+
+
 def bump_redis_txn_id(session):
     """
-    Called from post-flush hook to bump the latest id stored in redis
+    Called from the post-commit hook to bump the latest transaction ids
+    stored in redis, in a single round trip.
+
+    Ids are only ever raised, so that commits finishing out of order don't
+    move a namespace's id back. If redis is unavailable, ids are kept and
+    merged into later bumps, which aren't attempted for
+    TXN_REDIS_RETRY_INTERVAL seconds, so that commits don't keep waiting on
+    redis.
+
     """
-    def get_namespace_public_id(namespace_id):
-        # the namespace was just used to create the transaction, so it should
-        # still be in the session. If not, a sql statement will be emitted.
-        namespace = session.query(Namespace).get(namespace_id)
-        assert namespace, "namespace for transaction doesn't exist"
-        return str(namespace.public_id)
-
-    mappings = {
-        get_namespace_public_id(obj.namespace_id): obj.id
-        for obj in session
-        if (
-            obj in session.new
-            and isinstance(obj, Transaction)
-            and obj.id
-        )
-    }
-    if mappings:
-        redis_txn.zadd(TXN_REDIS_KEY, **mappings)
+    global _retry_after
+    for public_id, txn_id in session.info.pop(TXN_IDS_KEY, {}).iteritems():
+        _unpublished[public_id] = max(txn_id, _unpublished.get(public_id, 0))
+    if not _unpublished or time.time() < _retry_after:
+        return
+
+    mappings = dict(_unpublished)
+    _unpublished.clear()
+    try:
+        _zadd_gt(mappings)
+    except redis.RedisError:
+        for public_id, txn_id in mappings.iteritems():
+            _unpublished[public_id] = max(txn_id,
+                                          _unpublished.get(public_id, 0))
+        _retry_after = time.time() + TXN_REDIS_RETRY_INTERVAL
+        log.warning('Error bumping transaction ids in redis',
+                    unpublished=len(_unpublished), exc_info=True)
+
+
+def _zadd_gt(mappings):
+    global _zadd_gt_supported
+    if _zadd_gt_supported:
+        args = []
+        for public_id, txn_id in mappings.iteritems():
+            args.extend([txn_id, public_id])
+        pipe = redis_txn.pipeline(transaction=False)
+        pipe.execute_command('ZADD', TXN_REDIS_KEY, 'GT', *args)
+        try:
+            pipe.execute()
+            return
+        except redis.ResponseError:
+            # GT needs redis 6.2.
+            log.warning('ZADD GT not supported, falling back to ZADD')
+            _zadd_gt_supported = False
+    redis_txn.zadd(TXN_REDIS_KEY, **mappings)
@@ -1,18 +1,26 @@
 import time
 import math
+import calendar
 import gevent
 import requests
 import datetime
 from collections import OrderedDict
-from sqlalchemy import desc, func
+from sqlalchemy import and_, desc, func, or_
+from sqlalchemy.orm import load_only, subqueryload
 from sqlalchemy.orm.exc import NoResultFound
 
 import limitlion
+from gevent.pool import Pool
 
+from inbox.config import config
 from inbox.ignition import redis_txn
-from inbox.models import Account, Block, Message, Namespace
+from inbox.models import (Account, Block, Message, MessageBody, Namespace,
+                          Part)
 from inbox.models.transaction import Transaction, TXN_REDIS_KEY
-from inbox.util.blockstore import delete_from_blockstore
+from inbox.models.blob_reference import (remove_blob_references,
+                                         unreferenced_hashes)
+from inbox.util.blockstore import (delete_from_blockstore,
+                                   move_to_cold_storage)
 from inbox.util.stats import statsd_client
 from inbox.models.session import session_scope
 from nylas.logging.sentry import log_uncaught_errors
@@ -25,6 +33,24 @@ from nylas.logging import get_logger
 # can be much larger than the CHUNK_SIZE.
 CHUNK_SIZE = 100
 
+# S3 deletes up to 1000 keys per DeleteObjects request.
+BLOB_DELETE_BATCH_SIZE = 1000
+
+# How many groups of tables are deleted from concurrently. All chunks still
+# go through the shared bulk_throttle.
+DELETION_CONCURRENCY = config.get('ACCOUNT_DELETION_CONCURRENCY', 4)
+DELETION_PROGRESS_KEY = 'account-deletion-progress:{}:{}'
+
+# Tables which purge_transactions keeps trimmed. They may be partitioned by
+# day (see migration 252), in which case add_transaction_partitions has to
+# create partitions ahead of time.
+TRANSACTION_TABLES = ('transaction', 'accounttransaction')
+PARTITION_DAYS_AHEAD = 7
+
+# How far (received_date and id) moving a shard's messages to cold storage
+# got, and when the run which got there started.
+COLD_STORAGE_PROGRESS_KEY = 'cold-storage-position:{}'
+
 log = get_logger()
 
 # Use a single throttle instance for rate limiting.  Limits will be applied
@@ -184,10 +210,21 @@ def delete_namespace(namespace_id, throttle=False, dry_run=False):
     if account_discriminator == 'easaccount':
         filters['easuid'] = ('easaccount_id', account_id)
         filters['easfoldersyncstatus'] = ('account_id', account_id)
+        uid_table, folder_tables = 'easuid', ['easfoldersyncstatus']
     else:
         filters['imapuid'] = ('account_id', account_id)
         filters['imapfoldersyncstatus'] = ('account_id', account_id)
         filters['imapfolderinfo'] = ('account_id', account_id)
+        uid_table = 'imapuid'
+        folder_tables = ['imapfoldersyncstatus', 'imapfolderinfo']
+
+    # Tables within a group are deleted from in order, because deleting
+    # from one cascades to rows the others reference (e.g. message to
+    # imapuid, or contact and event to their association tables). Separate
+    # groups don't touch the same rows, so they're deleted concurrently.
+    groups = [['message', 'block', 'thread', 'event', 'contact', uid_table],
+              ['transaction'], ['actionlog'], ['dataprocessingcache'],
+              folder_tables]
 
     from inbox.ignition import engine_manager
     # Bypass the ORM for performant bulk deletion;
@@ -195,9 +232,25 @@ def delete_namespace(namespace_id, throttle=False, dry_run=False):
     # so this is okay.
     engine = engine_manager.get_for_id(namespace_id)
 
-    for cls in filters:
-        _batch_delete(engine, cls, filters[cls], account_id, throttle=throttle,
-                      dry_run=dry_run)
+    progress = DeletionProgress(namespace_id, dry_run=dry_run)
+    # Blobs orphaned by a previous, interrupted run.
+    progress.delete_orphans(force=True)
+
+    def delete_tables(tables):
+        for table in tables:
+            if table in progress.completed_tables:
+                log.info('Skipping table deleted by a previous run',
+                         table=table)
+                continue
+            _batch_delete(engine, table, filters[table], account_id,
+                          progress, throttle=throttle, dry_run=dry_run)
+            progress.complete_table(table)
+
+    pool = Pool(DELETION_CONCURRENCY)
+    for tables in groups:
+        pool.spawn(delete_tables, tables)
+    pool.join(raise_error=True)
+    progress.delete_orphans(force=True)
 
     # Use a single delete for the other tables. Rows from tables which contain
     # cascade-deleted foreign keys to other tables deleted here (or above)
@@ -242,12 +295,112 @@ def delete_namespace(namespace_id, throttle=False, dry_run=False):
     log.debug('Deleting liveness data', account_id=account_id)
     clear_heartbeat_status(account_id)
 
+    progress.report()
+    progress.clear()
+
     statsd_client.timing('mailsync.account_deletion.queue.deleted',
                          time.time() - start_time)
 
 
-def _batch_delete(engine, table, column_id_filters, account_id, throttle=False,
-                  dry_run=False):
+class DeletionProgress(object):
+    """
+    Tracks the deletion of a namespace: which tables are done, which blobs
+    are no longer referenced but not yet deleted, and throughput.
+
+    Progress is checkpointed to redis, so that if deletion is interrupted
+    (e.g. bin/delete-marked-accounts is restarted) the next run skips
+    finished tables and still deletes blobs whose rows are already gone.
+    Checkpointing is best-effort; without it, deletion simply starts over.
+
+    """
+
+    def __init__(self, namespace_id, dry_run=False):
+        self.namespace_id = namespace_id
+        self.dry_run = dry_run
+        self.tables_key = DELETION_PROGRESS_KEY.format(namespace_id, 'tables')
+        self.orphans_key = DELETION_PROGRESS_KEY.format(namespace_id,
+                                                        'orphans')
+        self.rows = 0
+        self.blobs = 0
+        self.start = time.time()
+        self.completed_tables = set()
+        self.orphans = set()
+        if not dry_run:
+            self.completed_tables = self._checkpoint('smembers',
+                                                     self.tables_key) or set()
+            self.orphans = self._checkpoint('smembers',
+                                            self.orphans_key) or set()
+
+    def _checkpoint(self, command, *args):
+        if self.dry_run:
+            return None
+        try:
+            return getattr(redis_txn, command)(*args)
+        except Exception:
+            log.warning('Error checkpointing deletion progress',
+                        namespace_id=self.namespace_id, exc_info=True)
+            return None
+
+    def complete_table(self, table):
+        self.completed_tables.add(table)
+        self._checkpoint('sadd', self.tables_key, table)
+
+    def add_rows(self, count):
+        self.rows += count
+
+    def checkpoint_orphans(self, hashes):
+        """ Checkpoint blobs about to lose their last reference, before the
+        transaction deleting it commits; add them with add_orphans after.
+        """
+        if hashes:
+            self._checkpoint('sadd', self.orphans_key, *hashes)
+
+    def add_orphans(self, hashes):
+        if not hashes:
+            return
+        self.orphans.update(hashes)
+        self.delete_orphans()
+
+    def delete_orphans(self, force=False):
+        """ Delete unreferenced blobs from the blockstore once there are
+        enough for a full batch (or regardless, if `force`).
+        """
+        if not self.orphans or (not force and
+                                len(self.orphans) < BLOB_DELETE_BATCH_SIZE):
+            return
+        orphans = list(self.orphans)
+        self.orphans.difference_update(orphans)
+        deleted = orphans
+        if not self.dry_run:
+            # Checkpointed blobs may still be referenced, if the deletion
+            # they were checkpointed for didn't commit, and any blob may
+            # have been referenced again since.
+            with session_scope(self.namespace_id) as db_session:
+                deleted = unreferenced_hashes(db_session, orphans)
+                db_session.commit()
+            delete_from_blockstore(*deleted)
+        self._checkpoint('srem', self.orphans_key, *orphans)
+        self.blobs += len(deleted)
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-3)
+        rows_per_second = self.rows / elapsed
+        blobs_per_second = self.blobs / elapsed
+        statsd_client.gauge('mailsync.account_deletion.rows_per_second',
+                            rows_per_second)
+        statsd_client.gauge('mailsync.account_deletion.blobs_per_second',
+                            blobs_per_second)
+        log.info('Deletion progress', namespace_id=self.namespace_id,
+                 rows=self.rows, blobs=self.blobs, elapsed=elapsed,
+                 rows_per_second=rows_per_second,
+                 blobs_per_second=blobs_per_second)
+
+    def clear(self):
+        self._checkpoint('delete', self.tables_key, self.orphans_key)
+
+
+def _batch_delete(engine, table, column_id_filters, account_id, progress,
+                  throttle=False, dry_run=False):
     (column, id_) = column_id_filters
     count = engine.execute(
         'SELECT COUNT(*) FROM {} WHERE {}={};'.format(table, column, id_)).\
@@ -274,60 +427,59 @@ def _batch_delete(engine, table, column_id_filters, account_id, throttle=False,
         if throttle:
             bulk_throttle()
 
-        if table == 'block':
-            with session_scope(account_id) as db_session:
-                blocks = list(db_session.query(Block.id, Block.data_sha256)
-                                        .filter(Block.namespace_id == id_)
-                                        .limit(CHUNK_SIZE))
-            blocks = list(blocks)
-            block_ids = [b[0] for b in blocks]
-            block_hashes = [b[1] for b in blocks]
-
-            # XXX: We currently don't check for existing blocks.
-            if dry_run is False:
-                delete_from_blockstore(*block_hashes)
-
-            with session_scope(account_id) as db_session:
-                query = db_session.query(Block).filter(Block.id.in_(block_ids))
-                if dry_run is False:
-                    query.delete(synchronize_session=False)
-
-        elif table == 'message':
-            with session_scope(account_id) as db_session:
-                # messages must be order by the foreign key `received_date`
-                # otherwise MySQL will raise an error when deleting
-                # from the message table
-                messages = list(db_session.query(Message.id, Message.data_sha256)
-                                          .filter(Message.namespace_id == id_)
-                                          .order_by(desc(Message.received_date))
-                                          .limit(CHUNK_SIZE)
-                                          .with_hint(Message, 'use index (ix_message_namespace_id_received_date)'))
-
-            message_ids = [m[0] for m in messages]
-            message_hashes = [m[1] for m in messages]
-
+        if table in ('message', 'block'):
             with session_scope(account_id) as db_session:
-                existing_hashes = list(db_session.query(Message.data_sha256)
-                            .filter(Message.data_sha256.in_(message_hashes))
-                            .filter(Message.namespace_id != id_)
-                            .distinct())
-            existing_hashes = [h[0] for h in existing_hashes]
-
-            remove_hashes = set(message_hashes) - set(existing_hashes)
-            if dry_run is False:
-                delete_from_blockstore(*list(remove_hashes))
-
-            with session_scope(account_id) as db_session:
-                query = db_session.query(Message).filter(Message.id.in_(message_ids))
+                if table == 'block':
+                    rows = list(db_session.query(Block.id, Block.data_sha256)
+                                .filter(Block.namespace_id == id_)
+                                .limit(CHUNK_SIZE))
+                    model = Block
+                else:
+                    # messages must be order by the foreign key
+                    # `received_date` otherwise MySQL will raise an error
+                    # when deleting from the message table
+                    rows = list(db_session.query(Message.id,
+                                                 Message.data_sha256)
+                                .filter(Message.namespace_id == id_)
+                                .order_by(desc(Message.received_date))
+                                .limit(CHUNK_SIZE)
+                                .with_hint(Message, 'use index (ix_message_namespace_id_received_date)'))
+                    model = Message
+                ids = [r[0] for r in rows]
+                hashes = [r[1] for r in rows]
+
+                orphans = set()
                 if dry_run is False:
-                    query.delete(synchronize_session=False)
+                    if model is Message and ids:
+                        # Bodies stored out of row aren't removed by the
+                        # database when their message is.
+                        bodies = MessageBody.message_id.in_(ids)
+                        hashes += [h for h, in db_session.query(
+                            MessageBody.data_sha256).filter(bodies)]
+                        db_session.query(MessageBody).filter(bodies).\
+                            delete(synchronize_session=False)
+                    db_session.query(model).filter(model.id.in_(ids)).\
+                        delete(synchronize_session=False)
+                    # Bulk deletes bypass the ORM events which maintain
+                    # reference counts.
+                    remove_blob_references(db_session, hashes)
+                    orphans = unreferenced_hashes(db_session, hashes)
+                    progress.checkpoint_orphans(orphans)
+                    db_session.commit()
+
+            # Blobs are deleted only once the rows referencing them are.
+            progress.add_rows(len(ids))
+            progress.add_orphans(orphans)
 
         else:
             if dry_run is False:
-                engine.execute(query)
+                progress.add_rows(engine.execute(query).rowcount)
             else:
                 log.debug(query)
 
+        if i % 100 == 0:
+            progress.report()
+
     end = time.time()
     log.info('Completed batch deletion', time=end - start, table=table)
 
@@ -350,43 +502,181 @@ def check_throttle():
     return True
 
 
-def purge_transactions(shard_id, days_ago=60, limit=1000, throttle=False,
-                       dry_run=False, now=None):
+def partition_name(bound):
+    """ The name of the daily transaction table partition with the given
+    (TO_DAYS) upper bound, for the day it holds. """
+    # TO_DAYS counts days from year 0, ordinals from year 1.
+    return 'p{:%Y%m%d}'.format(datetime.date.fromordinal(bound - 1 - 365))
+
+
+def get_partitions(db_session, table):
+    """
+    The (name, upper bound) of `table`'s partitions in order, with a bound of
+    None for the MAXVALUE partition. Empty if the table isn't partitioned.
+
+    """
+    rows = db_session.execute(
+        "SELECT partition_name, partition_description "
+        "FROM information_schema.partitions WHERE table_schema = DATABASE() "
+        "AND table_name = :table AND partition_name IS NOT NULL "
+        "ORDER BY partition_ordinal_position", {'table': table})
+    return [(name, None if bound == 'MAXVALUE' else int(bound))
+            for name, bound in rows]
+
+
+def partition_transaction_tables(engine, days_ahead=PARTITION_DAYS_AHEAD):
+    """
+    Partition the transaction tables of a new shard by day, as migration 252
+    does for existing ones: a partition for today and each of the next
+    `days_ahead` days, and the MAXVALUE partition. Called by init_db.
+
+    """
+    # Partitioned tables can't be referenced by foreign keys.
+    for constraint_name, in engine.execute(
+            "SELECT constraint_name FROM information_schema.key_column_usage "
+            "WHERE table_name = 'contactsearchindexcursor' "
+            "AND referenced_table_name = 'transaction' "
+            "AND constraint_schema = DATABASE()").fetchall():
+        engine.execute("ALTER TABLE contactsearchindexcursor "
+                       "DROP FOREIGN KEY {}".format(constraint_name))
+
+    today, = engine.execute("SELECT TO_DAYS(NOW())").fetchone()
+    partitions = ', '.join(
+        "PARTITION {} VALUES LESS THAN ({})".format(partition_name(bound),
+                                                    bound)
+        for bound in range(today + 1, today + days_ahead + 2))
+    for table in TRANSACTION_TABLES:
+        # The partitioning column has to be part of every unique key.
+        engine.execute("ALTER TABLE `{}` DROP PRIMARY KEY, "
+                       "ADD PRIMARY KEY (id, created_at)".format(table))
+        engine.execute("ALTER TABLE `{}` PARTITION BY RANGE "
+                       "(TO_DAYS(created_at)) ({}, PARTITION pmax VALUES "
+                       "LESS THAN MAXVALUE)".format(table, partitions))
+
+
+def add_transaction_partitions(shard_id, days_ahead=PARTITION_DAYS_AHEAD,
+                               dry_run=False, now=None):
+    """
+    Make sure the partitioned transaction tables have a daily partition for
+    each of the next `days_ahead` days, by splitting them off the MAXVALUE
+    partition. Should be run (at least) daily.
+
+    """
     start = 'now()'
     if now is not None:
         start = "'{}'".format(now.strftime('%Y-%m-%d %H:%M:%S'))
 
-    # Delete all items from the transaction table that are older than
-    # `days_ago` days.
+    for table in TRANSACTION_TABLES:
+        try:
+            with session_scope_by_shard_id(shard_id, versioned=False) as \
+                    db_session:
+                partitions = get_partitions(db_session, table)
+                bounds = [bound for _, bound in partitions if bound]
+                if not bounds:
+                    continue
+                today, = db_session.execute(
+                    "SELECT TO_DAYS({})".format(start)).fetchone()
+                new_bounds = range(max(bounds) + 1, today + days_ahead + 2)
+                if not new_bounds:
+                    continue
+                if db_session.execute(
+                        "SELECT 1 FROM `{}` PARTITION (pmax) LIMIT 1".
+                        format(table)).fetchone():
+                    # Splitting it has to copy these rows.
+                    log.warning("Transactions in MAXVALUE partition",
+                                shard_id=shard_id, table=table)
+                if not dry_run:
+                    db_session.execute(
+                        "ALTER TABLE `{}` REORGANIZE PARTITION pmax INTO "
+                        "({}, PARTITION pmax VALUES LESS THAN MAXVALUE)".
+                        format(table, ', '.join(
+                            "PARTITION {} VALUES LESS THAN ({})".format(
+                                partition_name(bound), bound)
+                            for bound in new_bounds)))
+            log.info("Added transaction partitions", shard_id=shard_id,
+                     table=table, dry_run=dry_run,
+                     partitions=[partition_name(b) for b in new_bounds])
+        except Exception as e:
+            log.critical("Exception encountered adding partitions",
+                         table=table, exception=e)
+
+
+def _drop_transaction_partitions(shard_id, table, start, days_ago, dry_run):
+    """
+    Drop the partitions of `table` which only hold transactions older than
+    `days_ago` days. Returns False if the table isn't partitioned.
+
+    """
+    with session_scope_by_shard_id(shard_id, versioned=False) as db_session:
+        partitions = get_partitions(db_session, table)
+        if not partitions:
+            return False
+        cutoff, = db_session.execute(
+            "SELECT TO_DAYS(DATE_SUB({}, INTERVAL {} day))".
+            format(start, days_ago)).fetchone()
+        expired = [name for name, bound in partitions
+                   if bound is not None and bound <= cutoff]
+        if expired and not dry_run:
+            db_session.execute("ALTER TABLE `{}` DROP PARTITION {}".
+                               format(table, ', '.join(expired)))
+    log.info("Dropped transaction partitions", shard_id=shard_id,
+             table=table, partitions=expired, dry_run=dry_run)
+    return True
+
+
+def _delete_transactions(shard_id, table, start, days_ago, limit, throttle,
+                         dry_run):
+    # Delete all items from the table that are older than `days_ago` days.
     if dry_run:
         offset = 0
-        query = ("SELECT id FROM transaction where created_at < "
+        query = ("SELECT id FROM `{}` where created_at < "
                  "DATE_SUB({}, INTERVAL {} day) LIMIT {}".
-                 format(start, days_ago, limit))
+                 format(table, start, days_ago, limit))
     else:
-        query = ("DELETE FROM transaction where created_at < DATE_SUB({},"
-                 " INTERVAL {} day) LIMIT {}".format(start, days_ago, limit))
-    try:
-        # delete from rows until there are no more rows affected
-        rowcount = 1
-        while rowcount > 0:
-            if throttle:
-                bulk_throttle()
+        query = ("DELETE FROM `{}` where created_at < DATE_SUB({},"
+                 " INTERVAL {} day) LIMIT {}".format(table, start, days_ago,
+                                                     limit))
+    # delete from rows until there are no more rows affected
+    rowcount = 1
+    while rowcount > 0:
+        if throttle:
+            bulk_throttle()
 
-            with session_scope_by_shard_id(shard_id, versioned=False) as \
-                    db_session:
-                if dry_run:
-                    rowcount = db_session.execute(
-                        "{} OFFSET {}".format(query, offset)).rowcount
-                    offset += rowcount
-                else:
-                    rowcount = db_session.execute(query).rowcount
-            log.info("Deleted batch from transaction table", batch_size=limit,
-                     rowcount=rowcount)
-        log.info("Finished purging transaction table for shard",
-                 shard_id=shard_id, date_delta=days_ago)
-    except Exception as e:
-        log.critical("Exception encountered during deletion", exception=e)
+        with session_scope_by_shard_id(shard_id, versioned=False) as \
+                db_session:
+            if dry_run:
+                rowcount = db_session.execute(
+                    "{} OFFSET {}".format(query, offset)).rowcount
+                offset += rowcount
+            else:
+                rowcount = db_session.execute(query).rowcount
+        log.info("Deleted batch from transaction table", table=table,
+                 batch_size=limit, rowcount=rowcount)
+
+
+def purge_transactions(shard_id, days_ago=60, limit=1000, throttle=False,
+                       dry_run=False, now=None):
+    """
+    Delete transactions and account transactions older than `days_ago`
+    days. Partitioned tables lose whole days at a time, by dropping their
+    partitions; otherwise, rows are deleted `limit` at a time.
+
+    """
+    start = 'now()'
+    if now is not None:
+        start = "'{}'".format(now.strftime('%Y-%m-%d %H:%M:%S'))
+
+    for table in TRANSACTION_TABLES:
+        try:
+            if not _drop_transaction_partitions(shard_id, table, start,
+                                                days_ago, dry_run):
+                _delete_transactions(shard_id, table, start, days_ago, limit,
+                                     throttle, dry_run)
+            log.info("Finished purging transaction table for shard",
+                     shard_id=shard_id, table=table, date_delta=days_ago)
+        except Exception as e:
+            log.critical("Exception encountered during deletion",
+                         table=table, exception=e)
 
     # remove old entries from the redis transaction zset
     if dry_run:
@@ -406,3 +696,136 @@ def purge_transactions(shard_id, days_ago=60, limit=1000, throttle=False,
         )
     except Exception as e:
         log.critical("Exception encountered during deletion", exception=e)
+
+
+def move_messages_to_cold_storage(shard_id, months=12, limit=100,
+                                  throttle=False, dry_run=False, now=None):
+    """
+    Move the raw messages, bodies and attachments of messages received more
+    than `months` months ago to cold storage. Inline bodies are first moved
+    out of the message table, to the blockstore. Blobs which are also
+    referenced by messages received since are left where they are.
+
+    Messages are visited in received_date order, and the position reached
+    is checkpointed, so later runs continue from there. Messages created
+    since the previous run with an earlier received_date than its position
+    (e.g. the old mail of newly synced accounts) are visited first. Moving
+    is idempotent.
+
+    """
+    now = now or datetime.datetime.utcnow()
+    cutoff = now - datetime.timedelta(days=30 * months)
+    started_at = datetime.datetime.utcnow()
+    checkpoint_key = COLD_STORAGE_PROGRESS_KEY.format(shard_id)
+    try:
+        progress = redis_txn.hgetall(checkpoint_key) or {}
+    except Exception:
+        log.warning('Error loading cold storage checkpoint', exc_info=True)
+        progress = {}
+    position_date = datetime.datetime.utcfromtimestamp(
+        int(progress.get('received_date', 0)))
+    position_id = int(progress.get('id', 0))
+    previous_start = progress.get('started_at')
+    moved = 0
+
+    def visit(query, order_by):
+        if throttle:
+            bulk_throttle()
+        with session_scope_by_shard_id(shard_id, versioned=False) as \
+                db_session:
+            # Versioning is off since only where data is stored changes.
+            messages = query(db_session.query(Message).options(
+                load_only('id', 'received_date', 'data_sha256',
+                          '_compacted_body'),
+                subqueryload('stored_body'),
+                subqueryload('parts').joinedload('block').
+                load_only('data_sha256')).filter(
+                Message.id >= shard_id << 48,
+                Message.id < (shard_id + 1) << 48,
+                Message.received_date < cutoff)).\
+                order_by(*order_by).limit(limit).all()
+            hashes = set()
+            for message in messages:
+                if message._compacted_body is not None and not dry_run:
+                    message.store_body(message._compacted_body, 'blockstore')
+                if message.stored_body is not None:
+                    hashes.add(message.stored_body.data_sha256)
+                hashes.add(message.data_sha256)
+                hashes.update(part.block.data_sha256
+                              for part in message.parts)
+            hashes -= _recently_referenced(db_session, hashes, cutoff)
+            # Commit bodies moved out of row before moving their blobs.
+            db_session.commit()
+            if not messages:
+                return None, 0
+            last = messages[-1].received_date, messages[-1].id
+
+        count = 0
+        if not dry_run and hashes:
+            count = len(move_to_cold_storage(*hashes))
+        log.info('Moved batch to cold storage', shard_id=shard_id,
+                 position=last, moved=count, dry_run=dry_run)
+        return last, count
+
+    def checkpoint():
+        if dry_run:
+            return
+        try:
+            redis_txn.hmset(checkpoint_key, {
+                'received_date': calendar.timegm(position_date.timetuple()),
+                'id': position_id,
+                'started_at': calendar.timegm(started_at.timetuple())})
+        except Exception:
+            log.warning('Error saving cold storage checkpoint',
+                        exc_info=True)
+
+    if previous_start is not None:
+        created_since = datetime.datetime.utcfromtimestamp(
+            int(previous_start))
+        min_id = 0
+        while True:
+            last, count = visit(lambda q: q.filter(
+                Message.created_at >= created_since,
+                Message.received_date < position_date,
+                Message.id >= min_id), [Message.id])
+            if last is None:
+                break
+            moved += count
+            min_id = last[1] + 1
+    checkpoint()
+
+    while True:
+        last, count = visit(lambda q: q.filter(or_(
+            Message.received_date > position_date,
+            and_(Message.received_date == position_date,
+                 Message.id > position_id))),
+            [Message.received_date, Message.id])
+        if last is None:
+            break
+        moved += count
+        position_date, position_id = last
+        checkpoint()
+
+    log.info('Finished moving messages to cold storage', shard_id=shard_id,
+             months=months, moved=moved)
+
+
+def _recently_referenced(db_session, hashes, cutoff):
+    """ The subset of `hashes` referenced by messages (or their bodies or
+    attachments) received since `cutoff`. """
+    hashes = filter(None, hashes)
+    if not hashes:
+        return set()
+    queries = [
+        db_session.query(Message.data_sha256).filter(
+            Message.data_sha256.in_(hashes)),
+        db_session.query(MessageBody.data_sha256).join(
+            Message, MessageBody.message_id == Message.id).filter(
+            MessageBody.data_sha256.in_(hashes)),
+        db_session.query(Block.data_sha256).join(
+            Part, Part.block_id == Block.id).join(
+            Message, Part.message_id == Message.id).filter(
+            Block.data_sha256.in_(hashes))]
+    return {h for query in queries
+            for h, in query.filter(Message.received_date >= cutoff).
+            distinct()}
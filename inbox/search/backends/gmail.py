@@ -39,7 +39,8 @@ class GmailSearchClient(object):
         query = db_session.query(Message). \
             filter(Message.namespace_id == self.account.namespace.id,
                    Message.g_msgid.in_(g_msgids)). \
-            order_by(desc(Message.received_date))
+            order_by(desc(Message.received_date)). \
+            options(*Message.body_loading_options())
 
         if offset:
             query = query.offset(offset)
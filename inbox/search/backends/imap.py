@@ -67,6 +67,7 @@ class IMAPSearchClient(object):
             .filter(ImapUid.account_id == self.account_id,
                     ImapUid.msg_uid.in_(imap_uids))\
             .order_by(desc(Message.received_date))\
+            .options(*Message.body_loading_options())
 
         if offset:
             query = query.offset(offset)
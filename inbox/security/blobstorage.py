@@ -7,18 +7,52 @@ binary blobs. These have the following data format:
 | scheme |              key version          |               data
 +--------+--------+--------+--------+--------+--------+--------+--------+-----
 
-The "scheme" byte can be used to version the data format. Currently the only
-values are 0 (no encryption) and 1 (encryption with a static key). The key
-version bytes can be used to rotate encryption keys. (Right now these are
-always just null bytes.)
+The "scheme" byte can be used to version the data format. Its low four bits
+are the encryption scheme: 0 (no encryption) or 1 (encryption with a static
+key). Its high four bits are the compression scheme: 0 (zlib) or 1 (zstd).
+The key version bytes can be used to rotate encryption keys. (Right now these
+are always just null bytes.)
+
+zstd blobs are followed by four more header bytes: the id of the dictionary
+they were compressed with, or 0 if none.
+
+|<1 byte>|
++--------+--------+--------+--------+--------+--------+--------+--------+-----
+| scheme |              key version          |     dictionary id     | data
++--------+--------+--------+--------+--------+--------+--------+--------+-----
+
+Message bodies are short and repetitive, so zstd with a dictionary trained on
+a sample of them (see bin/train-blob-dictionary) compresses them much better
+than zlib. New blobs are compressed with the scheme set by BLOB_COMPRESSION
+('zlib' or 'zstd') and the dictionary set by BLOB_DICTIONARY_ID, which is
+loaded from BLOB_DICTIONARY_DIR. Dictionaries must be kept for as long as
+blobs compressed with them exist.
 """
+import os
 import struct
 import zlib
+
+import zstandard as zstd
+
+from inbox.config import config
 from inbox.security.oracles import get_encryption_oracle, get_decryption_oracle
 
 
 KEY_VERSION = 0
 HEADER_WIDTH = 5
+DICTIONARY_ID_WIDTH = 4
+
+COMPRESSION_ZLIB = 0
+COMPRESSION_ZSTD = 1
+COMPRESSION_SCHEMES = {'zlib': COMPRESSION_ZLIB, 'zstd': COMPRESSION_ZSTD}
+
+ZSTD_LEVEL = 3
+DICTIONARY_SIZE = 112640
+
+# Dictionaries, compressors and decompressors by dictionary id.
+_dictionaries = {}
+_compressors = {}
+_decompressors = {}
 
 
 def _pack_header(scheme):
@@ -31,20 +65,94 @@ def _unpack_header(header):
     return scheme
 
 
+def dictionary_path(dictionary_id):
+    return os.path.join(config.get_required('BLOB_DICTIONARY_DIR'),
+                        '{}.zdict'.format(dictionary_id))
+
+
+def load_dictionary(dictionary_id):
+    """ The zstd dictionary with the given id, or None for id 0. """
+    if not dictionary_id:
+        return None
+    if dictionary_id not in _dictionaries:
+        with open(dictionary_path(dictionary_id), 'rb') as f:
+            dictionary = zstd.ZstdCompressionDict(f.read())
+        assert dictionary.dict_id() == dictionary_id, \
+            'Dictionary file has id {}'.format(dictionary.dict_id())
+        _dictionaries[dictionary_id] = dictionary
+    return _dictionaries[dictionary_id]
+
+
+def train_dictionary(samples, dictionary_size=DICTIONARY_SIZE):
+    """ Train a zstd dictionary on `samples` (a list of bytes), and save it
+    to BLOB_DICTIONARY_DIR. Returns the dictionary's id.
+    """
+    dictionary = zstd.train_dictionary(dictionary_size, samples)
+    with open(dictionary_path(dictionary.dict_id()), 'wb') as f:
+        f.write(dictionary.as_bytes())
+    return dictionary.dict_id()
+
+
+def _dictionary_kwargs(dictionary_id):
+    dictionary = load_dictionary(dictionary_id)
+    return {'dict_data': dictionary} if dictionary is not None else {}
+
+
+def _get_compressor(dictionary_id):
+    if dictionary_id not in _compressors:
+        _compressors[dictionary_id] = zstd.ZstdCompressor(
+            level=config.get('BLOB_ZSTD_LEVEL', ZSTD_LEVEL),
+            write_dict_id=False, write_checksum=False,
+            **_dictionary_kwargs(dictionary_id))
+    return _compressors[dictionary_id]
+
+
+def _get_decompressor(dictionary_id):
+    if dictionary_id not in _decompressors:
+        _decompressors[dictionary_id] = zstd.ZstdDecompressor(
+            **_dictionary_kwargs(dictionary_id))
+    return _decompressors[dictionary_id]
+
+
+def compress(plaintext, compression_scheme, dictionary_id=0):
+    """
+    Returns the compressed data and the header bytes, besides the scheme
+    byte, that it has to be stored with.
+
+    """
+    if compression_scheme == COMPRESSION_ZLIB:
+        return zlib.compress(plaintext), ''
+    compressed = _get_compressor(dictionary_id).compress(plaintext)
+    return compressed, struct.pack('<I', dictionary_id)
+
+
 def encode_blob(plaintext):
     assert isinstance(plaintext, bytes), 'Plaintext should be bytes'
-    compressed = zlib.compress(plaintext)
+    compression_scheme = COMPRESSION_SCHEMES[
+        config.get('BLOB_COMPRESSION', 'zlib')]
+    compressed, compression_header = compress(
+        plaintext, compression_scheme,
+        config.get('BLOB_DICTIONARY_ID', 0))
     encryption_oracle = get_encryption_oracle('BLOCK_ENCRYPTION_KEY')
     ciphertext, scheme = encryption_oracle.encrypt(compressed)
-    header = _pack_header(scheme)
-    return header + ciphertext
+    header = _pack_header(scheme | compression_scheme << 4)
+    return header + compression_header + ciphertext
 
 
 def decode_blob(blob):
     header = blob[:HEADER_WIDTH]
     body = blob[HEADER_WIDTH:]
     scheme = _unpack_header(header)
+    encryption_scheme, compression_scheme = scheme & 0xf, scheme >> 4
+    if compression_scheme == COMPRESSION_ZSTD:
+        dictionary_id, = struct.unpack('<I', body[:DICTIONARY_ID_WIDTH])
+        body = body[DICTIONARY_ID_WIDTH:]
     decryption_oracle = get_decryption_oracle('BLOCK_ENCRYPTION_KEY')
-    compressed_plaintext = decryption_oracle.decrypt(body, scheme)
-    result = zlib.decompress(compressed_plaintext)
+    compressed_plaintext = decryption_oracle.decrypt(body, encryption_scheme)
+    if compression_scheme == COMPRESSION_ZSTD:
+        result = _get_decompressor(dictionary_id).decompress(
+            compressed_plaintext)
+    else:
+        assert compression_scheme == COMPRESSION_ZLIB
+        result = zlib.decompress(compressed_plaintext)
     return result
@@ -6,7 +6,7 @@ from inbox.api.validation import (
     get_recipients, get_attachments, get_thread, get_message)
 from inbox.api.err import InputError
 from inbox.contacts.processing import update_contacts_from_message
-from inbox.models import Message, Part
+from inbox.models import Block, Message, Part
 from inbox.models.action_log import schedule_action
 from inbox.sqlalchemy_ext.util import generate_public_id
 
@@ -325,6 +325,7 @@ def delete_draft(db_session, account, draft):
 
 
 def generate_attachments(message, blocks):
+    prefetched = Block.prefetch(blocks)
     attachment_dicts = []
     for block in blocks:
         content_disposition = 'attachment'
@@ -336,7 +337,7 @@ def generate_attachments(message, blocks):
         attachment_dicts.append({
             'block_id': block.public_id,
             'filename': block.filename,
-            'data': block.data,
+            'data': prefetched.get(block.data_sha256) or block.data,
             'content_type': block.content_type,
             'content_disposition': content_disposition,
         })
@@ -0,0 +1,163 @@
+"""
+Per-request (or per-batch) SQL profiling.
+
+While a profile is active in a greenlet, every statement it executes is
+counted and timed, grouped by fingerprint: the statement with literals and
+IN lists normalized away. A fingerprint executed many times in one profile
+usually means lazy loads in a loop (an N+1 pattern), and is logged.
+
+Profiling is off unless QUERY_PROFILING is set, or, for API requests, the
+X-Query-Profile request header is sent and QUERY_PROFILE_HEADER is set. The
+X-Query-Profile response header then has the counts and times, with
+statements identified only by a short hash of their fingerprint; the
+statements themselves are logged with their ids.
+
+"""
+import json
+import re
+import time
+from hashlib import sha1
+from collections import defaultdict
+from contextlib import contextmanager
+
+from gevent.local import local
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from inbox.config import config
+from inbox.util.stats import statsd_client
+from nylas.logging import get_logger
+log = get_logger()
+
+TOP_STATEMENTS = config.get('QUERY_PROFILE_TOP_STATEMENTS', 5)
+# A fingerprint executed this many times in a profile is reported as a
+# repeated query.
+REPEATED_QUERY_THRESHOLD = config.get('QUERY_PROFILE_REPEAT_THRESHOLD', 10)
+
+# Items must be separated by commas: with optional separators, a long list
+# of numbers which doesn't match can be split up exponentially many ways.
+_IN_ITEM = r"(?:%s|\?|-?[\d.]+|'[^']*')"
+_IN_LIST = re.compile(r'\bIN \(\s*{0}(?:\s*,\s*{0})*\s*\)'.format(_IN_ITEM),
+                      re.IGNORECASE)
+_STRING = re.compile(r"'(?:[^'\\]|\\.)*'")
+_NUMBER = re.compile(r'\b\d+\b')
+_WHITESPACE = re.compile(r'\s+')
+
+_state = local()
+
+
+def fingerprint(statement):
+    """ The statement, with literals and parameter lists normalized. """
+    statement = _IN_LIST.sub('IN (...)', statement)
+    statement = _STRING.sub('?', statement)
+    statement = _NUMBER.sub('?', statement)
+    return _WHITESPACE.sub(' ', statement).strip()
+
+
+def fingerprint_id(key):
+    """ A short id for a fingerprint, which doesn't reveal the schema. """
+    return sha1(key).hexdigest()[:12]
+
+
+class QueryProfile(object):
+    """ Statement counts and times for one request or batch. """
+
+    def __init__(self, name):
+        self.name = name
+        self.statements = 0
+        self.duration = 0
+        self.counts = defaultdict(int)
+        self.durations = defaultdict(float)
+
+    def record(self, statement, duration):
+        key = fingerprint(statement)
+        self.statements += 1
+        self.duration += duration
+        self.counts[key] += 1
+        self.durations[key] += duration
+
+    def top(self, n=TOP_STATEMENTS):
+        return sorted(self.counts, key=lambda key: self.durations[key],
+                      reverse=True)[:n]
+
+    def repeated(self, threshold=REPEATED_QUERY_THRESHOLD):
+        return {key: count for key, count in self.counts.iteritems()
+                if count >= threshold}
+
+    def header(self):
+        """ Counts and times, for a response header. Statements are only
+        identified by fingerprint_id. """
+        return json.dumps({
+            'statements': self.statements,
+            'db_time_ms': int(self.duration * 1000),
+            'top': [{'id': fingerprint_id(key), 'count': self.counts[key],
+                     'db_time_ms': int(self.durations[key] * 1000)}
+                    for key in self.top()],
+        }, separators=(',', ':'))
+
+    def report(self, log_top=False):
+        """ Send metrics, and log repeated queries. With `log_top`, the top
+        statements are logged by id too, to look up a header's ids. """
+        metric = 'query_profile.{}'.format(self.name.replace('.', '-'))
+        statsd_client.timing(metric + '.statements', self.statements)
+        statsd_client.timing(metric + '.db_time', int(self.duration * 1000))
+        if log_top:
+            log.info('Query profile', profile=self.name,
+                     top={fingerprint_id(key): key for key in self.top()})
+        repeated = self.repeated()
+        if repeated:
+            statsd_client.incr(metric + '.repeated_queries')
+            log.warning('Repeated queries', profile=self.name,
+                        repeated=repeated)
+
+
+def current_profile():
+    return getattr(_state, 'profile', None)
+
+
+def start_profile(name):
+    _state.profile = QueryProfile(name)
+    return _state.profile
+
+
+def stop_profile():
+    profile = current_profile()
+    _state.profile = None
+    return profile
+
+
+@contextmanager
+def profile_queries(name, enabled=None):
+    """
+    Profile the queries run in the block, if `enabled` (by default, if
+    QUERY_PROFILING is set), and report them when it exits. Yields the
+    profile, or None.
+
+    """
+    if enabled is None:
+        enabled = config.get('QUERY_PROFILING', False)
+    if not enabled or current_profile() is not None:
+        yield None
+        return
+    profile = start_profile(name)
+    try:
+        yield profile
+    finally:
+        stop_profile()
+        profile.report()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if current_profile() is not None:
+        context._query_profile_start = time.time()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    profile = current_profile()
+    start = getattr(context, '_query_profile_start', None)
+    if profile is not None and start is not None:
+        profile.record(statement, time.time() - start)
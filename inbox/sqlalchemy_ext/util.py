@@ -19,6 +19,7 @@ from sqlalchemy.ext.mutable import Mutable
 from sqlalchemy.ext.declarative import DeclarativeMeta
 
 from inbox.util.encoding import base36encode, base36decode
+from inbox.util.json_codec import get_codec
 
 from nylas.logging import get_logger
 log = get_logger()
@@ -119,13 +120,15 @@ class StringWithTransform(TypeDecorator):
 
 # http://docs.sqlalchemy.org/en/rel_0_9/core/types.html#marshal-json-strings
 class JSON(TypeDecorator):
+    """ Stores values as bson extended JSON, encoded and decoded with the
+    codec from inbox.util.json_codec. """
     impl = Text
 
     def process_bind_param(self, value, dialect):
         if value is None:
             return None
 
-        return json_util.dumps(value)
+        return get_codec().dumps(value)
 
     def process_result_value(self, value, dialect):
         if not value:
@@ -136,13 +139,13 @@ class JSON(TypeDecorator):
         # log and return None for now.
         # http://bugs.python.org/issue11489
         try:
-            return json_util.loads(value)
+            return get_codec().loads(value)
         except ValueError:
             log.error('ValueError on decoding JSON', value=value)
 
 
 def json_field_too_long(value):
-    return len(json_util.dumps(value)) > MAX_TEXT_CHARS
+    return len(get_codec().dumps(value)) > MAX_TEXT_CHARS
 
 
 class LittleJSON(JSON):
@@ -0,0 +1,59 @@
+from inbox.api import namespace_cache
+from inbox.api.namespace_cache import get_cached_namespace
+from inbox.models.account import bump_account_versions
+from inbox.test.api.base import api_client
+
+__all__ = ['api_client']
+
+
+def test_namespace_cache(db, default_namespace):
+    namespace_cache.clear()
+    cached = get_cached_namespace(default_namespace.public_id)
+    assert cached.summary.id == default_namespace.id
+    assert cached.summary.account_id == default_namespace.account_id
+    assert cached.summary.provider == default_namespace.account.provider
+    assert get_cached_namespace(default_namespace.public_id) is cached
+
+    # Changing the account invalidates the entry.
+    default_namespace.account.sync_state = 'stopped'
+    db.session.commit()
+    refreshed = get_cached_namespace(default_namespace.public_id)
+    assert refreshed is not cached
+    assert refreshed.summary.sync_state == 'stopped'
+
+    assert get_cached_namespace('0' * 25) is None
+
+
+def test_changes_by_other_processes_invalidate(db, default_namespace):
+    namespace_cache.clear()
+    cached = get_cached_namespace(default_namespace.public_id)
+    assert get_cached_namespace(default_namespace.public_id) is cached
+
+    # Another process changed the account (or deleted it) and bumped its
+    # version.
+    bump_account_versions([default_namespace.account_id])
+    assert get_cached_namespace(default_namespace.public_id) is not cached
+
+
+def test_unknown_versions_are_not_cached(db, default_namespace,
+                                         monkeypatch):
+    import redis
+
+    def get(key):
+        raise redis.ConnectionError()
+    namespace_cache.clear()
+    monkeypatch.setattr('inbox.models.account.redis_txn.get', get)
+    cached = get_cached_namespace(default_namespace.public_id)
+    assert cached.summary.id == default_namespace.id
+    assert get_cached_namespace(default_namespace.public_id) is not cached
+
+
+def test_cached_namespace_used_for_reads(db, api_client, default_namespace):
+    namespace_cache.clear()
+    assert api_client.get_raw('/threads').status_code == 200
+    cached = get_cached_namespace(default_namespace.public_id)
+    assert api_client.get_raw('/threads').status_code == 200
+    assert get_cached_namespace(default_namespace.public_id) is cached
+
+    response = api_client.get_data('/account')
+    assert response['id'] == default_namespace.public_id
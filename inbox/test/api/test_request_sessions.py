@@ -0,0 +1,55 @@
+from sqlalchemy import event
+from sqlalchemy.orm.session import Session
+
+from inbox.models.session import has_writes
+from inbox.test.api.base import api_client
+
+__all__ = ['api_client']
+
+
+def test_has_writes(db, default_namespace):
+    db.session.commit()
+    assert not has_writes(db.session)
+    default_namespace.account.name = 'Changed'
+    assert has_writes(db.session)
+    db.session.flush()
+    assert has_writes(db.session)
+    db.session.commit()
+    assert not has_writes(db.session)
+
+
+def test_read_only_requests_skip_commit(db, api_client, thread):
+    commits = []
+
+    def count_commit(session):
+        commits.append(session)
+    event.listen(Session, 'before_commit', count_commit)
+    try:
+        assert api_client.get_raw('/threads').status_code == 200
+        assert not commits
+        api_client.put_data('/threads/{}'.format(thread.public_id),
+                            {'unread': True})
+        assert commits
+    finally:
+        event.remove(Session, 'before_commit', count_commit)
+
+
+def test_release_db_session_keeps_namespace(db, default_namespace):
+    from flask import g
+    from inbox.api.ns_api import release_db_session
+    from inbox.api.srv import app
+    from inbox.ignition import engine_manager
+    from inbox.models import Namespace
+    from inbox.models.session import new_session
+
+    with app.test_request_context('/'):
+        g.db_session = new_session(
+            engine_manager.get_for_id(default_namespace.id))
+        g.namespace = Namespace.get(default_namespace.id, g.db_session)
+        g.namespace.account.name = 'Changed'
+        release_db_session()
+        assert g.namespace.id == default_namespace.id
+        assert g.namespace.public_id == default_namespace.public_id
+
+    db.session.expire_all()
+    assert default_namespace.account.name == 'Changed'
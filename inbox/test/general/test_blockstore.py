@@ -0,0 +1,134 @@
+import gevent
+import pytest
+
+from inbox.util import blockstore
+from inbox.util.blockstore import WriteBehindUploader
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    uploaded = []
+
+    def save(data_sha256, bucket_name, data, bucket=None):
+        uploaded.append((data_sha256, data))
+
+    monkeypatch.setattr('inbox.util.blockstore._get_s3_bucket',
+                        lambda bucket_name: None)
+    monkeypatch.setattr('inbox.util.blockstore._save_to_s3_bucket', save)
+    return uploaded
+
+
+def test_queued_blocks_are_uploaded_before_barrier_returns(uploads,
+                                                           monkeypatch):
+    uploader = WriteBehindUploader('bucket', concurrency=2)
+    monkeypatch.setattr('inbox.util.blockstore._uploader', uploader)
+    uploader.save('a' * 64, 'hello')
+    uploader.save('a' * 64, 'hello')
+    uploader.save('b' * 64, 'world')
+
+    # Queued blocks can be read back before they're uploaded.
+    assert uploader.get_pending('a' * 64) == 'hello'
+
+    blockstore.wait_for_uploads()
+    assert sorted(uploads) == [('a' * 64, 'hello'), ('b' * 64, 'world')]
+    assert uploader.pending == {}
+    assert uploader.get_pending('a' * 64) is None
+
+
+def test_failed_upload_fails_barrier(monkeypatch):
+    def fail(*args, **kwargs):
+        raise IOError('S3 is down')
+
+    monkeypatch.setattr('inbox.util.blockstore._get_s3_bucket',
+                        lambda bucket_name: None)
+    monkeypatch.setattr('inbox.util.blockstore._save_to_s3_bucket', fail)
+    monkeypatch.setattr('inbox.util.blockstore.UPLOAD_ATTEMPTS', 1)
+    uploader = WriteBehindUploader('bucket', concurrency=1)
+    uploader.save('a' * 64, 'hello')
+    with pytest.raises(IOError):
+        uploader.wait()
+
+
+def test_failed_upload_reconnects(monkeypatch):
+    buckets = []
+    uploaded = []
+
+    def get_bucket(bucket_name):
+        buckets.append(object())
+        return buckets[-1]
+
+    def save(data_sha256, bucket_name, data, bucket=None):
+        if bucket is buckets[0]:
+            raise IOError('Connection reset by peer')
+        uploaded.append(data_sha256)
+
+    monkeypatch.setattr('inbox.util.blockstore._get_s3_bucket', get_bucket)
+    monkeypatch.setattr('inbox.util.blockstore._save_to_s3_bucket', save)
+    uploader = WriteBehindUploader('bucket', concurrency=1)
+    uploader.save('a' * 64, 'hello')
+    uploader.wait()
+    assert len(buckets) == 2
+    assert uploaded == ['a' * 64]
+
+
+def test_full_queue_applies_backpressure(uploads):
+    uploader = WriteBehindUploader('bucket', queue_size=1, concurrency=0)
+    uploader.save('a' * 64, 'hello')
+    blocked = gevent.spawn(uploader.save, 'b' * 64, 'world')
+    gevent.sleep(0)
+    assert not blocked.ready()
+    uploader.queue.get()
+    blocked.join(timeout=1)
+    assert blocked.ready()
+
+
+def test_cold_storage(config, monkeypatch, tmpdir):
+    from hashlib import sha256
+    cold = str(tmpdir)
+    monkeypatch.setattr('inbox.util.blockstore.COLD_STORAGE', cold)
+    monkeypatch.setattr('inbox.util.blockstore.COLD_MSG_PARTS_DIRECTORY',
+                        cold)
+    data = 'old attachment'
+    data_sha256 = sha256(data).hexdigest()
+    blockstore.save_to_blockstore(data_sha256, data)
+
+    assert blockstore.move_to_cold_storage(data_sha256) == [data_sha256]
+    assert blockstore._get_from_disk(data_sha256) is None
+    # Reads fall through to the cold tier.
+    assert blockstore.get_from_blockstore(data_sha256) == data
+    # Moving again is a no-op.
+    assert blockstore.move_to_cold_storage(data_sha256) == []
+
+    blockstore.delete_from_blockstore(data_sha256)
+    assert blockstore.get_from_blockstore(data_sha256) is None
+
+
+def test_get_many(config):
+    from hashlib import sha256
+    blocks = {sha256(data).hexdigest(): data
+              for data in ('first', 'second', 'third')}
+    for data_sha256, data in blocks.items():
+        blockstore.save_to_blockstore(data_sha256, data)
+    missing = sha256('missing').hexdigest()
+
+    assert blockstore.get_many_from_blockstore(blocks.keys() + [missing]) \
+        == dict(blocks, **{missing: None})
+    assert all(blockstore._cache.get(h) == data
+               for h, data in blocks.items())
+
+    blockstore.delete_from_blockstore(*blocks)
+    assert blockstore._cache.get(blocks.keys()[0]) is None
+
+
+def test_block_cache_evicts_least_recently_used():
+    cache = blockstore.BlockCache(size=80)
+    cache.add('a', 'x' * 10)
+    cache.add('b', 'x' * 10)
+    cache.add('huge', 'x' * 11)
+    assert cache.get('huge') is None
+    cache.get('a')
+    for i in range(7):
+        cache.add(str(i), 'x' * 10)
+    assert cache.get('a') is not None
+    assert cache.get('b') is None
+    assert cache.used <= 80
@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from inbox.test.util.base import add_fake_message, add_fake_thread
+
+
+@pytest.fixture
+def moved(monkeypatch):
+    from mockredis import mock_strict_redis_client
+    monkeypatch.setattr('inbox.models.util.redis_txn',
+                        mock_strict_redis_client())
+    moved = []
+
+    def move(*hashes):
+        moved.extend(hashes)
+        return hashes
+    monkeypatch.setattr('inbox.models.util.move_to_cold_storage', move)
+    return moved
+
+
+def add_message(db, namespace_id, data_sha256, days_ago):
+    thread = add_fake_thread(db.session, namespace_id)
+    message = add_fake_message(
+        db.session, namespace_id, thread,
+        received_date=datetime.utcnow() - timedelta(days=days_ago))
+    message.body = None
+    message.data_sha256 = data_sha256
+    db.session.commit()
+
+
+def test_cold_storage_skips_recently_referenced_blobs(db, default_namespace,
+                                                      moved):
+    from inbox.models.util import move_messages_to_cold_storage
+    old, shared = 'a' * 64, 'b' * 64
+    add_message(db, default_namespace.id, old, 800)
+    add_message(db, default_namespace.id, shared, 700)
+    add_message(db, default_namespace.id, shared, 1)
+
+    move_messages_to_cold_storage(0)
+    assert moved == [old]
+
+    # Old mail synced since the last run is visited too.
+    synced = 'c' * 64
+    add_message(db, default_namespace.id, synced, 900)
+    move_messages_to_cold_storage(0)
+    assert moved == [old, synced]
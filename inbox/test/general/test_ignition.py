@@ -60,3 +60,95 @@ def test_reset_autoincrements(base_db):
 
     assert len(reset_tables) > 0
     verify_db(engines[key], shard_schemas[key], key)
+
+
+def test_checkout_sampling(db, monkeypatch):
+    from inbox import ignition
+    engine = ignition.engine_manager.engines[0]
+
+    monkeypatch.setattr(ignition, 'DB_CHECKOUT_SAMPLE_INTERVAL', 1)
+    connection = engine.connect()
+    checkout = ignition.pool_tracker[connection.connection.connection]
+    assert checkout['source'].startswith('inbox.test.general.test_ignition')
+    connection.close()
+
+    monkeypatch.setattr(ignition, 'DB_CHECKOUT_SAMPLE_INTERVAL', 10 ** 9)
+    connections = [engine.connect() for _ in range(2)]
+    assert not all(ignition.pool_tracker[c.connection.connection]['source']
+                   for c in connections)
+    for c in connections:
+        dbapi_connection = c.connection.connection
+        c.close()
+        assert dbapi_connection not in ignition.pool_tracker
+
+
+def test_replica_routing(config, monkeypatch):
+    from inbox.ignition import EngineManager
+    databases = [dict(database, REPLICAS=[{
+        'HOSTNAME': database['HOSTNAME'], 'PORT': database['PORT']}])
+        for database in config['DATABASE_HOSTS']]
+    manager = EngineManager(databases, config['DATABASE_USERS'])
+    primary = manager.get_for_id(0)
+    replica, = manager.replica_engines[0]
+    assert replica is not primary
+
+    lags = {replica: 0}
+    monkeypatch.setattr(manager, 'replica_lag', lambda engine: lags[engine])
+    assert manager.get_replica_for_id(0) is replica
+
+    # Lagging or broken replicas aren't used.
+    lags[replica] = 60
+    assert manager.get_replica_for_id(0) is primary
+    lags[replica] = None
+    assert manager.get_replica_for_id(0) is primary
+    monkeypatch.undo()
+
+    # The test database isn't a replica.
+    manager._check_replica_lag(replica)
+    assert manager.replica_lag(replica) is None
+
+
+class FakeConnection(object):
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_adaptive_pool_resizing():
+    from sqlalchemy.exc import TimeoutError
+    from inbox.ignition import AdaptiveQueuePool
+    pool = AdaptiveQueuePool(FakeConnection, pool_size=4, max_overflow=0,
+                             timeout=0.01)
+    pool.min_size, pool.max_size = 2, 5
+    pool.wait_slo = 0.0005
+    connections = [pool.connect() for _ in range(4)]
+    assert pool.size() == 4
+
+    # Checkouts which wait too long grow the pool up to max_size.
+    pool.resize_interval = 0
+    with pytest.raises(TimeoutError):
+        pool.connect()
+    assert pool.size() == 5
+    pool.resize_interval = 60
+    connections.append(pool.connect())
+    assert pool.checkedout() == 5
+    assert pool.saturated()
+
+    for c in connections:
+        c.close()
+    assert pool.checkedin() == 5
+
+    # Once waits are short again and few connections are in use, the pool
+    # shrinks down to min_size, closing idle connections.
+    pool.wait_avg = 0
+    pool.resize_interval = 0
+    for _ in range(10):
+        pool.connect().close()
+    assert pool.size() == 2
+    assert pool.checkedin() == 2
+    assert pool.checkedout() == 0
+    assert not pool.saturated()
+    assert pool.stats()['size'] == 2
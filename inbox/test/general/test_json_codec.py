@@ -0,0 +1,39 @@
+import datetime
+import json
+
+import pytest
+from bson import json_util
+
+from inbox.util.json_codec import JSONCodec, get_codec
+
+VALUES = [
+    [['Alice', 'alice@example.com'], [u'B\xf6b', 'bob@example.com']],
+    ['<a@example.com>', '<b@example.com>'],
+    {'state': 'running', 'sync_start_time': datetime.datetime(2016, 1, 1),
+     'nested': {'$date-like': 1}},
+    {'price': '$5'},
+    [],
+    None,
+]
+
+
+@pytest.mark.parametrize('value', VALUES)
+def test_codec_matches_json_util(value):
+    codec = JSONCodec(json)
+    encoded = codec.dumps(value)
+    assert encoded == json_util.dumps(value)
+    assert codec.loads(encoded) == json_util.loads(encoded)
+
+
+def test_codec_falls_back_for_other_iterables():
+    assert json.loads(get_codec().dumps({'labels': set(['a'])})) == \
+        {'labels': ['a']}
+
+
+def test_json_column_round_trip(db, default_account):
+    sync_start_time = datetime.datetime(2016, 1, 1)
+    default_account._sync_status['sync_start_time'] = sync_start_time
+    db.session.commit()
+    db.session.expire(default_account)
+    assert default_account.sync_status['sync_start_time'] == \
+        sync_start_time
@@ -0,0 +1,82 @@
+from hashlib import sha256
+
+import mock
+
+from inbox.util.known_hashes import KnownHashes, filter_size
+
+
+def h(i):
+    return sha256(str(i)).hexdigest()
+
+
+def test_filter_size():
+    num_bits, num_hashes = filter_size(1000000, 1e-6)
+    assert 28 * 10 ** 6 < num_bits < 29 * 10 ** 6
+    assert num_hashes == 20
+
+
+def test_known_hashes():
+    known = KnownHashes(capacity=1000, error_rate=1e-4)
+    for i in range(1000):
+        known.add(h(i))
+    assert all(h(i) in known for i in range(1000))
+    false_positives = sum(h(i) in known for i in range(1000, 11000))
+    assert false_positives < 10
+
+
+def test_generations_rotate():
+    known = KnownHashes(capacity=10, error_rate=1e-4)
+    for i in range(10):
+        known.add(h(i))
+    known.add(h('new'))
+    # The previous generation is still consulted.
+    assert known.previous is not None
+    assert h(0) in known
+    assert h('new') in known
+
+    for i in range(10, 21):
+        known.add(h(i))
+    assert h(0) not in known
+
+
+def test_clear():
+    known = KnownHashes(capacity=10, error_rate=1e-4)
+    known.add(h(0))
+    known.clear()
+    assert h(0) not in known
+
+
+def test_redis_errors_mean_unknown():
+    redis = mock.Mock()
+    redis.pipeline.side_effect = Exception('redis is down')
+    known = KnownHashes(capacity=10, error_rate=1e-4, redis=redis)
+    known.add(h(0))
+    # Deletions by other processes can't be checked for.
+    assert h(0) not in known
+    assert h(1) not in known
+
+
+def test_deletions_are_seen_by_other_processes():
+    from mockredis import mock_strict_redis_client
+    redis = mock_strict_redis_client()
+    deleting = KnownHashes(capacity=10, error_rate=1e-4, redis=redis)
+    saving = KnownHashes(capacity=10, error_rate=1e-4, redis=redis)
+    saving.add(h(0))
+    saving.add(h(1))
+    assert h(0) in saving
+
+    deleting.discard(h(0))
+    assert h(0) not in saving
+    assert h(1) in saving
+
+    deleting.clear()
+    assert h(1) not in saving
+
+
+def test_discard():
+    known = KnownHashes(capacity=10, error_rate=1e-4)
+    known.add(h(0))
+    known.discard(h(0))
+    assert h(0) not in known
+    known.add(h(0))
+    assert h(0) in known
@@ -0,0 +1,123 @@
+from hashlib import sha256
+
+import pytest
+
+from inbox.models import Message, MessageBody
+from inbox.test.util.base import add_fake_message, add_fake_thread
+
+
+@pytest.fixture
+def blockstore(monkeypatch):
+    blobs = {}
+    monkeypatch.setattr('inbox.models.message.save_to_blockstore',
+                        lambda h, data, repair=False: blobs.update({h: data}))
+    monkeypatch.setattr('inbox.models.message.get_from_blockstore',
+                        blobs.get)
+    monkeypatch.setattr('inbox.models.message.get_many_from_blockstore',
+                        lambda hashes: {h: blobs.get(h) for h in hashes})
+    return blobs
+
+
+RAW_MESSAGE = '''From: alice@example.com
+To: bob@example.com
+Subject: Hello
+Content-Type: text/html
+
+<p>Hello</p>
+'''
+
+
+@pytest.mark.parametrize('storage', ['table', 'blockstore'])
+def test_out_of_row_body(db, default_namespace, monkeypatch, blockstore,
+                         storage):
+    monkeypatch.setattr('inbox.models.message.BODY_STORAGE', storage)
+    thread = add_fake_thread(db.session, default_namespace.id)
+    message = add_fake_message(db.session, default_namespace.id, thread,
+                               body=u'<p>Hello</p>')
+    message_id = message.id
+    db.session.expunge_all()
+
+    message = db.session.query(Message).get(message_id)
+    assert message._compacted_body is None
+    assert message.body == u'<p>Hello</p>'
+    assert (message.stored_body.data is None) == (storage == 'blockstore')
+    assert len(blockstore) == (storage == 'blockstore')
+
+    db.session.delete(message)
+    db.session.commit()
+    assert db.session.query(MessageBody).filter(
+        MessageBody.message_id == message_id).count() == 0
+
+
+def test_moving_inline_body(db, default_namespace):
+    thread = add_fake_thread(db.session, default_namespace.id)
+    message = add_fake_message(db.session, default_namespace.id, thread,
+                               body=u'<p>Hello</p>')
+    blob = message._compacted_body
+    assert blob is not None and message.stored_body is None
+
+    message.store_body(blob, 'table')
+    db.session.commit()
+    db.session.expire(message)
+    assert message._compacted_body is None
+    assert message.stored_body.data == blob
+    assert message.body == u'<p>Hello</p>'
+
+    # Bodies written inline again no longer need the stored copy.
+    message.body = u'<p>Bye</p>'
+    db.session.commit()
+    assert message._compacted_body is not None
+    assert db.session.query(MessageBody).filter(
+        MessageBody.message_id == message.id).count() == 0
+
+
+def test_inline_body_does_not_load_stored_body(db, default_namespace):
+    from sqlalchemy import inspect
+    thread = add_fake_thread(db.session, default_namespace.id)
+    message = add_fake_message(db.session, default_namespace.id, thread)
+    message.body = None
+    db.session.commit()
+    db.session.expire(message)
+
+    assert message.body is None
+    message.body = u'<p>Hello</p>'
+    assert 'stored_body' in inspect(message).unloaded
+
+
+@pytest.mark.parametrize('raw_in_blockstore', [True, False])
+def test_missing_body_is_rebuilt_from_raw_message(db, default_namespace,
+                                                  monkeypatch, blockstore,
+                                                  raw_in_blockstore):
+    monkeypatch.setattr('inbox.models.message.BODY_STORAGE', 'blockstore')
+    monkeypatch.setattr('inbox.models.message.get_raw_from_provider',
+                        lambda message: RAW_MESSAGE)
+    thread = add_fake_thread(db.session, default_namespace.id)
+    message = add_fake_message(db.session, default_namespace.id, thread,
+                               body=u'<p>Hello</p>')
+    message.data_sha256 = sha256(RAW_MESSAGE).hexdigest()
+    db.session.commit()
+    message_id = message.id
+    blockstore.clear()
+    if raw_in_blockstore:
+        blockstore[message.data_sha256] = RAW_MESSAGE
+    db.session.expunge_all()
+
+    message = db.session.query(Message).get(message_id)
+    assert message.body == u'<p>Hello</p>'
+    assert sha256(RAW_MESSAGE).hexdigest() in blockstore
+
+
+def test_prefetch_bodies(db, default_namespace, monkeypatch, blockstore):
+    monkeypatch.setattr('inbox.models.message.BODY_STORAGE', 'blockstore')
+    thread = add_fake_thread(db.session, default_namespace.id)
+    message_ids = [add_fake_message(db.session, default_namespace.id, thread,
+                                    body=u'<p>{}</p>'.format(i)).id
+                   for i in range(3)]
+    db.session.expunge_all()
+
+    messages = db.session.query(Message).filter(
+        Message.id.in_(message_ids)).order_by(Message.id).all()
+    Message.prefetch_bodies(messages)
+    monkeypatch.setattr('inbox.models.message.get_from_blockstore', None)
+    assert [m.body for m in messages] == [u'<p>0</p>', u'<p>1</p>',
+                                          u'<p>2</p>']
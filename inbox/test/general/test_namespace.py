@@ -464,3 +464,118 @@ def test_multiple_fake_accounts(empty_db):
     # check that we didn't delete a secret that wasn't ours.
     assert db.session.query(Secret).count() == secret_count
     assert db.session.query(GmailAuthCredentials).count() == authcredentials_count
+
+
+def test_namespace_deletion_keeps_shared_blobs(db, default_account,
+                                               monkeypatch):
+    from inbox.models import Account, BlobReference
+    from inbox.models.util import delete_namespace
+
+    deleted_hashes = []
+    monkeypatch.setattr('inbox.models.util.delete_from_blockstore',
+                        lambda *hashes: deleted_hashes.extend(hashes))
+
+    namespace_id = default_account.namespace.id
+    other_account = add_generic_imap_account(db.session)
+    other_namespace_id = other_account.namespace.id
+
+    shared, unique = 'a' * 64, 'b' * 64
+    for ns_id, data_sha256 in ((namespace_id, shared),
+                               (namespace_id, unique),
+                               (other_namespace_id, shared)):
+        thread = add_fake_thread(db.session, ns_id)
+        message = add_fake_message(db.session, ns_id, thread)
+        message.data_sha256 = data_sha256
+        db.session.commit()
+
+    refcounts = dict(db.session.query(BlobReference.data_sha256,
+                                      BlobReference.refcount))
+    assert refcounts[shared] == 2
+    assert refcounts[unique] == 1
+
+    account = db.session.query(Account).get(default_account.id)
+    account.mark_for_deletion()
+    db.session.commit()
+    delete_namespace(namespace_id)
+    db.session.commit()
+
+    assert unique in deleted_hashes
+    assert shared not in deleted_hashes
+    refcounts = dict(db.session.query(BlobReference.data_sha256,
+                                      BlobReference.refcount))
+    assert refcounts[shared] == 1
+    assert unique not in refcounts
+
+
+def test_namespace_deletion_resumes(db, default_account, monkeypatch):
+    from mockredis import mock_strict_redis_client
+    from inbox.models import Account
+    from inbox.models import util
+    from inbox.models.util import delete_namespace, DELETION_PROGRESS_KEY
+
+    redis = mock_strict_redis_client()
+    monkeypatch.setattr('inbox.models.util.redis_txn', redis)
+    deleted_hashes = []
+    monkeypatch.setattr('inbox.models.util.delete_from_blockstore',
+                        lambda *hashes: deleted_hashes.extend(hashes))
+    deleted_tables = []
+    batch_delete = util._batch_delete
+
+    def record_batch_delete(engine, table, *args, **kwargs):
+        deleted_tables.append(table)
+        return batch_delete(engine, table, *args, **kwargs)
+
+    monkeypatch.setattr('inbox.models.util._batch_delete',
+                        record_batch_delete)
+
+    # Checkpoint of a run interrupted after deleting from actionlog, and
+    # before deleting a blob whose message was already gone.
+    namespace_id = default_account.namespace.id
+    tables_key = DELETION_PROGRESS_KEY.format(namespace_id, 'tables')
+    orphans_key = DELETION_PROGRESS_KEY.format(namespace_id, 'orphans')
+    redis.sadd(tables_key, 'actionlog')
+    redis.sadd(orphans_key, 'c' * 64)
+
+    account = db.session.query(Account).get(default_account.id)
+    account.mark_for_deletion()
+    db.session.commit()
+    delete_namespace(namespace_id)
+    db.session.commit()
+
+    assert 'actionlog' not in deleted_tables
+    assert 'message' in deleted_tables
+    assert 'c' * 64 in deleted_hashes
+    assert not redis.exists(tables_key)
+    assert not redis.exists(orphans_key)
+
+
+def test_namespace_deletion_rechecks_checkpointed_blobs(db, default_account,
+                                                        monkeypatch):
+    from mockredis import mock_strict_redis_client
+    from inbox.models import Account
+    from inbox.models.util import delete_namespace, DELETION_PROGRESS_KEY
+
+    redis = mock_strict_redis_client()
+    monkeypatch.setattr('inbox.models.util.redis_txn', redis)
+    deleted_hashes = []
+    monkeypatch.setattr('inbox.models.util.delete_from_blockstore',
+                        lambda *hashes: deleted_hashes.extend(hashes))
+
+    # Checkpointed by a run whose deletion then failed to commit.
+    other_account = add_generic_imap_account(db.session)
+    thread = add_fake_thread(db.session, other_account.namespace.id)
+    message = add_fake_message(db.session, other_account.namespace.id,
+                               thread)
+    message.data_sha256 = 'd' * 64
+    db.session.commit()
+    namespace_id = default_account.namespace.id
+    redis.sadd(DELETION_PROGRESS_KEY.format(namespace_id, 'orphans'),
+               'd' * 64)
+
+    account = db.session.query(Account).get(default_account.id)
+    account.mark_for_deletion()
+    db.session.commit()
+    delete_namespace(namespace_id)
+    db.session.commit()
+
+    assert 'd' * 64 not in deleted_hashes
@@ -0,0 +1,61 @@
+import json
+
+from inbox.models import Message
+from inbox.sqlalchemy_ext.query_profile import fingerprint, profile_queries
+from inbox.test.util.base import add_fake_message
+from inbox.test.api.base import api_client
+
+__all__ = ['api_client']
+
+
+def test_fingerprint():
+    assert fingerprint(
+        "SELECT id FROM message\n WHERE namespace_id = 12 AND "
+        "id IN (%s, %s, %s) AND subject = 'it\\'s'") == \
+        "SELECT id FROM message WHERE namespace_id = ? AND id IN (...) " \
+        "AND subject = ?"
+    assert fingerprint('SELECT id FROM message WHERE id IN (%s)') == \
+        fingerprint('SELECT id FROM message WHERE id IN (%s, %s)')
+
+
+def test_fingerprint_unmatched_long_in_list():
+    # An IN list which isn't closed must fail to match quickly.
+    statement = 'SELECT id FROM message WHERE id IN ({} AND 1'.format(
+        ', '.join(['1234567890'] * 1000))
+    assert fingerprint(statement).startswith(
+        'SELECT id FROM message WHERE id IN (?, ?, ')
+
+
+def test_profile_finds_repeated_queries(db, default_namespace, thread):
+    ids = [add_fake_message(db.session, default_namespace.id, thread).id
+           for _ in range(10)]
+    db.session.expunge_all()
+
+    with profile_queries('test', enabled=True) as profile:
+        for id_ in ids:
+            db.session.query(Message).get(id_)
+
+    assert profile.statements >= 10
+    repeated = profile.repeated()
+    assert any(statement.startswith('SELECT') and 'FROM message' in statement
+               for statement in repeated)
+    assert set(profile.top()) & set(repeated)
+
+
+def test_profile_response_header(api_client, monkeypatch):
+    from inbox.config import config
+    response = api_client.get_raw('/threads',
+                                  headers={'X-Query-Profile': '1'})
+    assert 'X-Query-Profile' not in response.headers
+
+    monkeypatch.setitem(config, 'QUERY_PROFILE_HEADER', True)
+    response = api_client.get_raw('/threads',
+                                  headers={'X-Query-Profile': '1'})
+    profile = json.loads(response.headers['X-Query-Profile'])
+    assert profile['statements'] > 0
+    assert profile['top']
+    assert all(len(top['id']) == 12 for top in profile['top'])
+    assert 'SELECT' not in response.headers['X-Query-Profile']
+
+    response = api_client.get_raw('/threads')
+    assert 'X-Query-Profile' not in response.headers
@@ -0,0 +1,105 @@
+import os
+from hashlib import sha256
+
+import gevent
+
+from inbox.util import segment_store
+from inbox.util.segment_store import SegmentStore
+
+
+def block(i):
+    data = 'block {}'.format(i) * 10
+    return sha256(data).hexdigest(), data
+
+
+def test_save_and_get(tmpdir):
+    store = SegmentStore(str(tmpdir))
+    blocks = [block(i) for i in range(10)]
+    for data_sha256, data in blocks:
+        store.save(data_sha256, data)
+    for data_sha256, data in blocks:
+        assert store.get(data_sha256) == data
+    assert store.get(block(10)[0]) is None
+
+
+def test_processes_share_segments(tmpdir):
+    writer, reader = SegmentStore(str(tmpdir)), SegmentStore(str(tmpdir))
+    data_sha256, data = block(0)
+    assert reader.get(data_sha256) is None
+    writer.save(data_sha256, data)
+    assert reader.get(data_sha256) == data
+    # Blocks appended after the reader mapped the segment are found too.
+    data_sha256, data = block(1)
+    writer.save(data_sha256, data)
+    assert reader.get(data_sha256) == data
+
+
+def test_segments_roll_over(tmpdir):
+    store = SegmentStore(str(tmpdir), segment_size=200)
+    for i in range(10):
+        store.save(*block(i))
+    segments = [f for f in os.listdir(store.directory) if f.endswith('.seg')]
+    assert len(segments) == 10
+    assert all(store.get(block(i)[0]) == block(i)[1] for i in range(10))
+
+
+def test_delete_and_compact(tmpdir):
+    store = SegmentStore(str(tmpdir), segment_size=1000)
+    for i in range(10):
+        store.save(*block(i))
+    deleted = [block(i)[0] for i in range(8)]
+    assert sorted(store.delete(*deleted)) == sorted(deleted)
+    assert store.get(block(0)[0]) is None
+
+    before = set(os.listdir(store.directory))
+    assert store.compact() > 0
+    after = set(os.listdir(store.directory))
+    assert before - after
+    for i in range(8, 10):
+        assert store.get(block(i)[0]) == block(i)[1]
+
+
+def test_pack_files(tmpdir):
+    data_sha256, data = block(0)
+    path = tmpdir.join(data_sha256)
+    path.write(data)
+    store = SegmentStore(str(tmpdir))
+    assert store.pack_files(str(tmpdir), lambda h: str(tmpdir.join(h))) == 1
+    assert not path.check()
+    assert store.get(data_sha256) == data
+
+
+def test_only_sealed_segments_are_compacted(tmpdir, monkeypatch):
+    monkeypatch.setattr(segment_store, 'IDLE_SEGMENT_AGE', 0)
+    writer = SegmentStore(str(tmpdir))
+    for i in range(2):
+        writer.save(*block(i))
+    writer.delete(block(0)[0])
+    # The writer is still running, however idle its segment is.
+    assert SegmentStore(str(tmpdir)).compact(min_dead_ratio=0.1) == 0
+    writer.save(*block(2))
+    assert writer.get(block(2)[0]) == block(2)[1]
+
+    # A writer whose segment was sealed under it starts a new one.
+    segment = writer.segment
+    writer._execute('UPDATE segment SET sealed = 1')
+    writer.save(*block(3))
+    assert writer.segment != segment
+    assert writer.compact(min_dead_ratio=0.1) > 0
+    for i in range(1, 4):
+        assert writer.get(block(i)[0]) == block(i)[1]
+
+
+def test_concurrent_saves_share_fsyncs(tmpdir, monkeypatch):
+    fsync = os.fsync
+    fsyncs = []
+
+    def count_fsync(fd):
+        fsyncs.append(fd)
+        fsync(fd)
+    monkeypatch.setattr(os, 'fsync', count_fsync)
+    store = SegmentStore(str(tmpdir))
+    gevent.joinall([gevent.spawn(store.save, *block(i)) for i in range(10)],
+                   raise_error=True)
+    assert len(fsyncs) < 10
+    assert all(store.get(block(i)[0]) == block(i)[1] for i in range(10))
@@ -6,13 +6,17 @@ want to test that we handle unsolicited FETCH responses, which may be returned
 by some providers (Gmail, Fastmail).
 """
 from datetime import datetime
+import errno
+import socket
+import zlib
 import mock
 import imapclient
 import pytest
 
 from inbox.crispin import (CrispinClient, GmailCrispinClient, GMetadata,
                            GmailFlags, RawMessage, Flags,
-                           FolderMissingError, localized_folder_names)
+                           FolderMissingError, localized_folder_names,
+                           enable_compression)
 
 
 class MockedIMAPClient(imapclient.IMAPClient):
@@ -649,3 +653,134 @@ def test_imap_many_folders_one_role(monkeypatch, constants):
                           map(lambda y: y.role, raw_folders))
         assert len(test_set) == number_roles,\
             "assigned wrong number of {}".format(role)
+
+
+def patch_status_responses(crispin_client, capabilities, resp):
+    imap = crispin_client.conn._imap
+    imap.untagged_responses = {}
+    crispin_client.conn.capabilities = lambda: capabilities
+
+    def complete(*args):
+        imap.untagged_responses['STATUS'] = resp
+        return ('OK', ['Success'])
+    imap._command_complete.side_effect = complete
+    imap._simple_command.side_effect = complete
+
+
+def test_pipelined_folder_statuses(generic_client):
+    patch_status_responses(generic_client, ('IMAP4REV1', 'CONDSTORE'), [
+        '"INBOX" (UIDNEXT 10 HIGHESTMODSEQ 100)',
+        '"Sent Items" (UIDNEXT 22 HIGHESTMODSEQ 200)'])
+    statuses = generic_client.folder_statuses(
+        ['INBOX', 'Sent Items', 'Deleted'], ['UIDNEXT', 'HIGHESTMODSEQ'])
+    assert generic_client.conn._imap._command.call_count == 3
+    assert statuses == {
+        'INBOX': {'UIDNEXT': 10, 'HIGHESTMODSEQ': 100},
+        'Sent Items': {'UIDNEXT': 22, 'HIGHESTMODSEQ': 200},
+    }
+
+
+def test_list_status_folder_statuses(generic_client):
+    patch_status_responses(generic_client, ('IMAP4REV1', 'LIST-STATUS'), [
+        '"INBOX" (UIDNEXT 10)',
+        '"Archive" (UIDNEXT 7)',
+        '"Notes" (UIDNEXT 3)'])
+    statuses = generic_client.folder_statuses(['INBOX', 'Archive'],
+                                              ['UIDNEXT'])
+    assert not generic_client.conn._imap._command.called
+    assert statuses == {'INBOX': {'UIDNEXT': 10}, 'Archive': {'UIDNEXT': 7}}
+
+
+class DeflatingServer(object):
+    """Plays the server side of a COMPRESS=DEFLATE connection."""
+
+    def __init__(self):
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                           zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.chunks = []
+        self.received = ''
+        self.blocking = True
+
+    def respond(self, data, chunk_size=7):
+        compressed = (self.compressor.compress(data) +
+                      self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        for i in range(0, len(compressed), chunk_size):
+            self.chunks.append(compressed[i:i + chunk_size])
+
+    def recv(self, size):
+        if not self.chunks and not self.blocking:
+            raise socket.error(errno.EAGAIN, 'Try again')
+        return self.chunks.pop(0) if self.chunks else ''
+
+    def setblocking(self, flag):
+        self.blocking = bool(flag)
+
+    def sendall(self, data):
+        self.received += self.decompressor.decompress(data)
+
+
+def test_compressed_transport(generic_client):
+    server = DeflatingServer()
+    conn = generic_client.conn
+    imap = conn._imap
+    conn.capabilities = lambda: ('IMAP4REV1', 'COMPRESS=DEFLATE')
+    imap._simple_command.return_value = ('OK', ['DEFLATE active'])
+    imap.socket.return_value = server
+    imap.send.side_effect = server.sendall
+
+    assert enable_compression(conn, 'custom')
+    imap._simple_command.assert_called_once_with('COMPRESS', 'DEFLATE')
+
+    imap.send('A001 UID FETCH 1 (BODY.PEEK[])\r\n')
+    assert server.received == 'A001 UID FETCH 1 (BODY.PEEK[])\r\n'
+
+    body = 'Subject: hello\r\n\r\n' + 'x' * 5000
+    server.respond('* 1 FETCH (UID 1 BODY[] {%d}\r\n%s)\r\n'
+                   'A001 OK done\r\n' % (len(body), body))
+    assert imap.readline() == '* 1 FETCH (UID 1 BODY[] {%d}\r\n' % len(body)
+    assert imap.read(len(body)) == body
+    assert imap.readline() == ')\r\n'
+    assert imap.readline() == 'A001 OK done\r\n'
+
+
+def test_compressed_idle_check(generic_client, monkeypatch):
+    server = DeflatingServer()
+    conn = generic_client.conn
+    imap = conn._imap
+    conn.capabilities = lambda: ('IMAP4REV1', 'COMPRESS=DEFLATE')
+    imap._simple_command.return_value = ('OK', ['DEFLATE active'])
+    imap.socket.return_value = server
+    assert enable_compression(conn, 'custom')
+
+    def select(rlist, wlist, xlist, timeout=None):
+        return [r for r in rlist if r.chunks], [], []
+    monkeypatch.setattr('inbox.crispin.select.select', select)
+    assert conn.idle_check(10) == []
+
+    # Both responses arrive in one chunk; reading the first buffers the
+    # second, which the socket won't signal.
+    server.respond('* 3 EXISTS\r\n* 4 EXISTS\r\n', chunk_size=1000)
+    assert imap.readline() == '* 3 EXISTS\r\n'
+    assert conn.idle_check(10) == [(4, 'EXISTS')]
+    assert server.blocking
+
+    # A partial response is kept until the rest arrives.
+    server.respond('* OK Still here\r\n* 5 EXI', chunk_size=1000)
+    assert conn.idle_check(10) == [('OK', 'Still here')]
+    server.respond('STS\r\n')
+    assert conn.idle_check(10) == [(5, 'EXISTS')]
+
+
+def test_compression_not_negotiated(generic_client):
+    conn = generic_client.conn
+    imap = conn._imap
+    conn.capabilities = lambda: ('IMAP4REV1',)
+    assert not enable_compression(conn, 'custom')
+    assert not imap._simple_command.called
+
+    conn.capabilities = lambda: ('IMAP4REV1', 'COMPRESS=DEFLATE')
+    imap._simple_command.return_value = ('NO', ['Compression unavailable'])
+    read = imap.read
+    assert not enable_compression(conn, 'custom')
+    assert imap.read is read
@@ -0,0 +1,79 @@
+import time
+
+import mock
+
+from inbox.mailsync.backends.imap.poller import FolderStatusPoller
+from inbox.mailsync.backends.imap.scheduler import (ColdFolderScheduler,
+                                                    is_hot_folder,
+                                                    MIN_VISIT_INTERVAL,
+                                                    MAX_VISIT_INTERVAL)
+
+
+def engine(folder_name, changed=False):
+    engine = mock.Mock()
+    engine.folder_name = folder_name
+    engine.visit.return_value = changed
+    return engine
+
+
+def test_hot_folders():
+    for role in ('inbox', 'sent', 'drafts', 'all'):
+        assert is_hot_folder(role)
+    for role in ('archive', 'trash', 'spam', None):
+        assert not is_hot_folder(role)
+
+
+def test_visit_interval_adapts_to_changes():
+    scheduler = ColdFolderScheduler(1)
+    quiet = engine('Quiet')
+    scheduler.add(quiet)
+    scheduler.visit(quiet)
+    assert scheduler.intervals['Quiet'] == 2 * MIN_VISIT_INTERVAL
+    for _ in range(10):
+        scheduler.visit(quiet)
+    assert scheduler.intervals['Quiet'] == MAX_VISIT_INTERVAL
+
+    quiet.visit.return_value = True
+    scheduler.visit(quiet)
+    assert scheduler.intervals['Quiet'] == MIN_VISIT_INTERVAL
+
+
+def test_only_due_folders_are_visited():
+    scheduler = ColdFolderScheduler(1)
+    for name in ('Old', 'New'):
+        scheduler.add(engine(name))
+    now = time.time()
+    scheduler.next_visit['Old'] = now - 1
+    scheduler.next_visit['New'] = now + 100
+    assert [e.folder_name for e in scheduler.due(now)] == ['Old']
+
+    # Folders being visited aren't handed out again.
+    scheduler._visiting.add('Old')
+    assert scheduler.due(now) == []
+
+
+def test_status_change_makes_folder_due():
+    poller = FolderStatusPoller(1, None, poll_frequency=10)
+    scheduler = ColdFolderScheduler(1, status_poller=poller)
+    scheduler.add(engine('Archive'))
+    now = time.time()
+    assert scheduler.due(now) == []
+    poller.update({'Archive': {'UIDNEXT': 10}})
+    assert [e.folder_name for e in scheduler.due(now)] == ['Archive']
+    assert scheduler.due(now) == []
+
+
+def test_failing_folder_is_handed_back():
+    poller = FolderStatusPoller(1, None, poll_frequency=10)
+    scheduler = ColdFolderScheduler(1, status_poller=poller)
+    broken = engine('Broken')
+    broken.visit.side_effect = Exception('UIDVALIDITY changed')
+    scheduler.add(broken)
+    scheduler.visit(broken)
+    assert 'Broken' not in scheduler
+    assert 'Broken' not in scheduler._visiting
+    assert 'Broken' not in poller._changed
+    # Its next engine has to run before handing the folder back.
+    assert 'Broken' in scheduler.handed_back
+    scheduler.add(engine('Broken'))
+    assert 'Broken' not in scheduler.handed_back
@@ -0,0 +1,67 @@
+import contextlib
+
+import mock
+
+from inbox.mailsync.backends.imap.poller import FolderStatusPoller
+
+
+class MockConnectionPool(object):
+
+    def __init__(self, statuses):
+        self.client = mock.Mock()
+        self.client.condstore_supported.return_value = True
+        self.client.folder_statuses.side_effect = \
+            lambda names, what: {name: statuses[name] for name in names
+                                 if name in statuses}
+
+    @contextlib.contextmanager
+    def get(self):
+        yield self.client
+
+
+def test_poll_fetches_watched_folders_in_one_call():
+    pool = MockConnectionPool({'INBOX': {'UIDNEXT': 5},
+                               'Sent': {'UIDNEXT': 9}})
+    poller = FolderStatusPoller(1, pool, poll_frequency=10)
+    poller.watch('INBOX')
+    poller.watch('Sent')
+    poller.poll()
+    assert pool.client.folder_statuses.call_count == 1
+    names, what = pool.client.folder_statuses.call_args[0]
+    assert set(names) == {'INBOX', 'Sent'}
+    assert what == ['UIDNEXT', 'HIGHESTMODSEQ']
+    assert poller.status('INBOX', max_age=10) == {'UIDNEXT': 5}
+    assert poller.status('Sent', max_age=10) == {'UIDNEXT': 9}
+
+
+def test_stale_and_unknown_statuses():
+    poller = FolderStatusPoller(1, None, poll_frequency=10)
+    poller.watch('INBOX')
+    assert poller.status('INBOX', max_age=10) is None
+    poller.update({'INBOX': {'UIDNEXT': 5}})
+    assert poller.status('INBOX', max_age=-1) is None
+
+
+def test_only_changed_folders_are_woken():
+    poller = FolderStatusPoller(1, None, poll_frequency=10)
+    poller.watch('INBOX')
+    poller.watch('Sent')
+    poller.update({'INBOX': {'UIDNEXT': 5}, 'Sent': {'UIDNEXT': 9}})
+    for name in ('INBOX', 'Sent'):
+        poller.wait_for_change(name, timeout=0)
+
+    poller.update({'INBOX': {'UIDNEXT': 6}, 'Sent': {'UIDNEXT': 9}})
+    assert poller._changed['INBOX'].is_set()
+    assert not poller._changed['Sent'].is_set()
+    poller.wait_for_change('INBOX', timeout=0)
+    assert not poller._changed['INBOX'].is_set()
+
+
+def test_unwatched_folders_are_not_polled():
+    pool = MockConnectionPool({'INBOX': {'UIDNEXT': 5}})
+    poller = FolderStatusPoller(1, pool, poll_frequency=10)
+    poller.watch('INBOX')
+    poller.unwatch('INBOX')
+    poller.poll()
+    assert not pool.client.folder_statuses.called
+    assert poller.status('INBOX', max_age=10) is None
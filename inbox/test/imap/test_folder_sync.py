@@ -9,6 +9,7 @@ from inbox.models.backends.imap import (ImapFolderSyncStatus, ImapUid,
 from inbox.mailsync.backends.imap.generic import (FolderSyncEngine, UidInvalid,
                                                   MAX_UIDINVALID_RESYNCS)
 from inbox.mailsync.backends.gmail import GmailFolderSyncEngine
+from inbox.mailsync.backends.imap.folderstate import FolderStateWriter
 from inbox.mailsync.backends.base import MailsyncDone
 from inbox.test.imap.data import uids, uid_data # noqa
 from inbox.util.testutils import mock_imapclient  # noqa
@@ -94,6 +95,43 @@ def test_new_uids_synced_when_polling(db, generic_account, inbox_folder,
     assert {u.msg_uid for u in saved_uids} == set(uid_dict)
 
 
+def test_folder_state_writes_are_coalesced(db, generic_account, inbox_folder):
+    inbox_folder.imapfolderinfo = ImapFolderInfo(account=generic_account,
+                                                 uidvalidity=1,
+                                                 uidnext=1)
+    db.session.commit()
+    writer = FolderStateWriter(generic_account.id,
+                               generic_account.namespace.id)
+    folder_sync_engine = FolderSyncEngine(generic_account.id,
+                                          generic_account.namespace.id,
+                                          inbox_folder.name,
+                                          generic_account.email_address,
+                                          'custom',
+                                          BoundedSemaphore(1),
+                                          state_writer=writer)
+    folder_sync_engine.uidnext = 5
+    folder_sync_engine.highestmodseq = 10
+    folder_sync_engine.update_uid_counts(None, remote_uid_count=3)
+    assert folder_sync_engine.uidnext == 5
+
+    # Nothing is written until the writer flushes.
+    db.session.expire_all()
+    assert inbox_folder.imapfolderinfo.uidnext == 1
+    writer.flush()
+    db.session.expire_all()
+    assert inbox_folder.imapfolderinfo.uidnext == 5
+    assert inbox_folder.imapfolderinfo.highestmodseq == 10
+    assert inbox_folder.imapsyncstatus.metrics['remote_uid_count'] == 3
+
+    # Discarded updates are never written.
+    folder_sync_engine.uidnext = 6
+    folder_sync_engine.discard_folder_state()
+    writer.flush()
+    db.session.expire_all()
+    assert inbox_folder.imapfolderinfo.uidnext == 5
+    assert folder_sync_engine.uidnext == 5
+
+
 def test_condstore_flags_refresh(db, default_account, all_mail_folder,
                                  mock_imapclient, monkeypatch):
     monkeypatch.setattr(
@@ -6,7 +6,7 @@ import pytest
 import mock
 from backports import ssl
 
-from inbox.crispin import CrispinConnectionPool
+from inbox.crispin import CrispinConnectionPool, _get_connection_pool
 
 
 class TestableConnectionPool(CrispinConnectionPool):
@@ -64,3 +64,70 @@ def test_connection_retained_on_other_errors():
             raise ValueError
     assert conn in pool._queue
     assert not conn.logout.called
+
+
+def test_keepalive_prewarms_min_connections():
+    pool = TestableConnectionPool(1, num_connections=3, readonly=True,
+                                  min_connections=2)
+    pool._keepalive()
+    clients = [pool._queue.get() for _ in range(3)]
+    assert len([c for c in clients if c is not None]) == 2
+
+
+def test_keepalive_noops_idle_connections():
+    pool = TestableConnectionPool(1, num_connections=3, readonly=True,
+                                  min_connections=1)
+    with pool.get() as conn:
+        pass
+    pool._keepalive()
+    assert conn.conn.noop.called
+    assert conn in pool._queue
+    # The already-open connection satisfies min_connections.
+    assert len([c for c in pool._queue.queue if c is not None]) == 1
+
+
+def test_keepalive_discards_broken_connections():
+    pool = TestableConnectionPool(1, num_connections=1, readonly=True,
+                                  min_connections=0)
+    with pool.get() as conn:
+        pass
+    conn.conn.noop.side_effect = socket.error
+    pool._keepalive()
+    assert pool._queue.peek() is None
+    assert not conn.logout.called
+
+
+def test_keepalive_logs_out_unused_pools(monkeypatch):
+    pool = TestableConnectionPool(1, num_connections=2, readonly=True,
+                                  min_connections=2)
+    with pool.get() as conn:
+        pass
+    monkeypatch.setattr('inbox.crispin.POOL_IDLE_TIMEOUT', -1)
+    pool._keepalive()
+    assert conn.logout.called
+    assert all(c is None for c in pool._queue.queue)
+
+
+def test_close_stops_keepalive():
+    pool = TestableConnectionPool(1, num_connections=1, readonly=True)
+    pool.start_keepalive()
+    keepalive = pool._keepalive_greenlet
+    gevent.sleep(0)
+    conn = pool._queue.peek()
+    pool.close()
+    assert keepalive.dead
+    assert conn.logout.called
+    assert pool._queue.peek() is None
+
+
+def test_keepalive_only_in_sync_processes(monkeypatch):
+    monkeypatch.setattr('inbox.crispin.CrispinConnectionPool',
+                        TestableConnectionPool)
+    pools = {}
+    pool = _get_connection_pool(1, 1, pools, readonly=True)
+    assert pool._keepalive_greenlet is None
+
+    monkeypatch.setattr('inbox.crispin._pool_keepalive', True)
+    pool = _get_connection_pool(2, 1, pools, readonly=True)
+    assert pool._keepalive_greenlet is not None
+    pool.close()
@@ -0,0 +1,102 @@
+import imaplib
+
+import pytest
+
+from inbox.mailsync.backends.imap import ratecontrol
+from inbox.mailsync.backends.imap.ratecontrol import (RateController,
+                                                      is_throttling_error,
+                                                      suggested_backoff)
+
+
+@pytest.mark.parametrize('message,expected', [
+    ('[THROTTLED] Too many simultaneous connections', True),
+    ('[OVERQUOTA] Account exceeded command or bandwidth limits', True),
+    ('Request is throttled. Suggested Backoff Time: 29963 milliseconds',
+     True),
+    ('[NONEXISTENT] Unknown Mailbox: Foo', False),
+])
+def test_throttling_signal_detection(message, expected):
+    assert is_throttling_error(imaplib.IMAP4.error(message)) is expected
+
+
+def test_non_imap_errors_are_not_throttling_signals():
+    assert not is_throttling_error(ValueError('[THROTTLED]'))
+
+
+def test_suggested_backoff():
+    exc = imaplib.IMAP4.error(
+        'Request is throttled. Suggested Backoff Time: 29963 milliseconds')
+    assert suggested_backoff(exc) == 29.963
+    assert suggested_backoff(imaplib.IMAP4.error('[THROTTLED]')) is None
+
+
+def test_additive_increase():
+    controller = RateController('test')
+    assert controller.batch_size == ratecontrol.MIN_BATCH_SIZE
+    for _ in range(5):
+        controller.record_success(1, 1000, controller.batch_size)
+    assert controller.batch_size == ratecontrol.MIN_BATCH_SIZE + 5
+
+
+def test_increase_is_capped():
+    controller = RateController('test')
+    for _ in range(ratecontrol.MAX_BATCH_SIZE * 2):
+        controller.record_success(1, 1000, controller.batch_size)
+    assert controller.batch_size == ratecontrol.MAX_BATCH_SIZE
+    assert controller.concurrency == ratecontrol.MAX_CONCURRENCY
+
+
+def test_partial_batches_do_not_grow_window():
+    controller = RateController('test')
+    for _ in range(5):
+        controller.record_success(1, 1000, controller.batch_size)
+    size = controller.batch_size
+    controller.record_success(1, 1000, 1)
+    assert controller.batch_size == size
+
+
+def test_slow_batches_decrease():
+    controller = RateController('test')
+    for _ in range(9):
+        controller.record_success(1, 1000, controller.batch_size)
+    assert controller.batch_size == 10
+    controller.record_success(ratecontrol.TARGET_BATCH_LATENCY + 1, 1000, 10)
+    assert controller.batch_size == 5
+
+
+def test_throttle_decreases_and_backs_off():
+    controller = RateController('test')
+    for _ in range(9):
+        controller.record_success(1, 1000, controller.batch_size)
+    controller.record_throttle(imaplib.IMAP4.error('[THROTTLED]'))
+    assert controller.batch_size == 5
+    assert controller.backoff_remaining > 0
+    assert controller.consecutive_throttles == 1
+    controller.record_success(1, 1000, 1)
+    assert controller.consecutive_throttles == 0
+
+
+def test_host_limits_apply_to_accounts():
+    host = RateController('host', initial_batch_size=ratecontrol.MAX_BATCH_SIZE,
+                          latency_sensitive=False)
+    account = RateController('account', parent=host)
+    for _ in range(20):
+        account.record_success(1, 1000, account.batch_size)
+    assert account.batch_size == 21
+    # A slow batch is a signal for the account, but not for the whole host.
+    account.record_success(ratecontrol.TARGET_BATCH_LATENCY + 1, 1000, 21)
+    assert host.batch_size == ratecontrol.MAX_BATCH_SIZE
+
+
+def test_throttling_backs_off_only_the_account():
+    host = RateController('host', initial_batch_size=ratecontrol.MAX_BATCH_SIZE,
+                          decrease_factor=ratecontrol.HOST_DECREASE_FACTOR,
+                          latency_sensitive=False)
+    account = RateController('account', parent=host)
+    other = RateController('other', parent=host)
+    account.record_throttle(imaplib.IMAP4.error('[THROTTLED]'))
+    assert account.backoff_remaining > 0
+    assert host.batch_size == int(ratecontrol.MAX_BATCH_SIZE *
+                                  ratecontrol.HOST_DECREASE_FACTOR)
+    assert host.backoff_remaining == 0
+    assert other.backoff_remaining == 0
@@ -1,6 +1,8 @@
+import struct
 import zlib
 import hypothesis
-from inbox.security.blobstorage import encode_blob, decode_blob
+from inbox.security.blobstorage import (encode_blob, decode_blob,
+                                        train_dictionary)
 
 
 # This will run the test for a bunch of randomly-chosen values of sample_input.
@@ -32,3 +34,32 @@ def test_message_body_storage(config, message, sample_input, encrypt):
     assert message._compacted_body.startswith(
         chr(encrypt) + '\x00\x00\x00\x00')
     assert message.body == sample_input
+
+
+@hypothesis.given(str, bool)
+def test_zstd_blobstorage(config, monkeypatch, sample_input, encrypt):
+    config['ENCRYPT_SECRETS'] = encrypt
+    monkeypatch.setitem(config, 'BLOB_COMPRESSION', 'zstd')
+    encoded = encode_blob(sample_input)
+    assert encoded.startswith(chr(0x10 | encrypt) + '\x00' * 8)
+    assert decode_blob(encoded) == sample_input
+
+
+def test_zstd_dictionary(config, monkeypatch, tmpdir):
+    config['ENCRYPT_SECRETS'] = False
+    monkeypatch.setitem(config, 'BLOB_DICTIONARY_DIR', str(tmpdir))
+    samples = ['<html><body><p>Message {}</p><div class="signature">'
+               'Sent from my phone</div></body></html>'.format(i) * (i % 5 + 1)
+               for i in range(1000)]
+    old_blob = encode_blob(samples[0])
+
+    dictionary_id = train_dictionary(samples, 4096)
+    monkeypatch.setitem(config, 'BLOB_COMPRESSION', 'zstd')
+    monkeypatch.setitem(config, 'BLOB_DICTIONARY_ID', dictionary_id)
+    encoded = encode_blob(samples[0])
+    assert encoded[:9] == ('\x10' + '\x00' * 4 +
+                           struct.pack('<I', dictionary_id))
+    assert len(encoded) < len(old_blob)
+    assert decode_blob(encoded) == samples[0]
+    # Blobs written before the dictionary was are still readable.
+    assert decode_blob(old_blob) == samples[0]
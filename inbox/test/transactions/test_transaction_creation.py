@@ -1,10 +1,14 @@
 from datetime import datetime
 
+import redis
 from sqlalchemy import desc
 from flanker import mime
 
+from inbox.ignition import redis_txn
 from inbox.models import Transaction, AccountTransaction, Calendar
+from inbox.models import transaction as transaction_module
 from inbox.models.mixins import HasRevisions
+from inbox.models.transaction import marked_dirty, TXN_REDIS_KEY
 from inbox.models.util import transaction_objects
 
 from inbox.test.util.base import (add_fake_message, add_fake_thread, add_fake_event,
@@ -341,3 +345,52 @@ def test_accounttransactions(db, default_namespace):
         assert len(accounttransactions) == 2
         assert accounttransactions[1].id != accounttransaction_id
         assert accounttransactions[1].command == 'update'
+
+
+def test_marked_dirty_objects_create_transaction(db, default_namespace):
+    thr = add_fake_thread(db.session, default_namespace.id)
+    version = thr.version
+    thr.dirty = True
+    db.session.commit()
+    transaction = get_latest_transaction(db.session, 'thread', thr.id,
+                                         default_namespace.id)
+    assert transaction.command == 'update'
+    assert thr.version == version + 1
+    assert not thr.dirty
+    assert thr not in marked_dirty(db.session)
+
+    # Only objects which changed are revised.
+    db.session.commit()
+    assert get_latest_transaction(db.session, 'thread', thr.id,
+                                  default_namespace.id).id == transaction.id
+
+
+def test_latest_transaction_ids_published_on_commit(db, default_namespace):
+    thr = add_fake_thread(db.session, default_namespace.id)
+    redis_txn.zrem(TXN_REDIS_KEY, default_namespace.public_id)
+    thr.subject = 'Changed'
+    db.session.flush()
+    assert redis_txn.zscore(TXN_REDIS_KEY, default_namespace.public_id) is None
+
+    db.session.commit()
+    transaction = get_latest_transaction_any(db.session, default_namespace.id)
+    assert redis_txn.zscore(TXN_REDIS_KEY, default_namespace.public_id) == \
+        transaction.id
+
+
+def test_unpublished_transaction_ids_are_retried(db, default_namespace,
+                                                 monkeypatch):
+    def fail(mappings):
+        raise redis.ConnectionError()
+    monkeypatch.setattr(transaction_module, '_retry_after', 0)
+    monkeypatch.setattr(transaction_module, '_zadd_gt', fail)
+    add_fake_thread(db.session, default_namespace.id)
+    assert default_namespace.public_id in transaction_module._unpublished
+    monkeypatch.undo()
+
+    # Bumps wait for the retry interval, then include the missed ids.
+    add_fake_thread(db.session, default_namespace.id)
+    transaction = get_latest_transaction_any(db.session, default_namespace.id)
+    assert not transaction_module._unpublished
+    assert redis_txn.zscore(TXN_REDIS_KEY, default_namespace.public_id) == \
+        transaction.id
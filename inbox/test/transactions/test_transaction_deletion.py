@@ -1,13 +1,18 @@
 import random
 import uuid
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 
 import pytest
 from sqlalchemy import desc
 
 from inbox.ignition import redis_txn
-from inbox.models.transaction import Transaction, TXN_REDIS_KEY
-from inbox.models.util import purge_transactions
+from inbox.models.session import session_scope_by_shard_id
+from inbox.models.transaction import (AccountTransaction, Transaction,
+                                      TXN_REDIS_KEY)
+from inbox.models.util import (get_partitions, partition_name,
+                               purge_transactions, add_transaction_partitions,
+                               partition_transaction_tables,
+                               PARTITION_DAYS_AHEAD, TRANSACTION_TABLES)
 
 
 def get_latest_transaction(db_session, namespace_id):
@@ -140,3 +145,73 @@ class TestTransactionDeletion:
 
         assert not db.session.query(Transaction).count()
         assert not len(_get_redis_transactions())
+
+    def test_account_transaction_deletion(self, now, db, default_namespace):
+        for days_ago in (0, 31):
+            db.session.add(AccountTransaction(
+                created_at=now - timedelta(days=days_ago),
+                namespace_id=default_namespace.id, object_type="account",
+                command="update", record_id=default_namespace.account.id,
+                object_public_id=uuid.uuid4().hex))
+        db.session.commit()
+
+        # Test databases aren't partitioned, so rows are deleted.
+        assert get_partitions(db.session, "accounttransaction") == []
+        shard_id = default_namespace.id >> 48
+        purge_transactions(shard_id, days_ago=30, dry_run=False, now=now)
+        assert not db.session.query(AccountTransaction).filter(
+            AccountTransaction.created_at < now - timedelta(days=30)).count()
+        assert db.session.query(AccountTransaction).filter(
+            AccountTransaction.created_at >= now - timedelta(days=1)).count()
+
+
+def test_partition_name():
+    # MySQL's TO_DAYS('2020-03-01') is 737850.
+    assert partition_name(737851) == "p20200301"
+    assert date.fromordinal(737850 - 365) == date(2020, 3, 1)
+
+
+@pytest.yield_fixture
+def partitioned(db):
+    from inbox.ignition import engine_manager
+    engine = engine_manager.engines[0]
+    # DDL waits for open transactions on the tables.
+    db.session.commit()
+    partition_transaction_tables(engine)
+    yield
+    db.session.commit()
+    for table in TRANSACTION_TABLES:
+        engine.execute("ALTER TABLE `{}` REMOVE PARTITIONING".format(table))
+        engine.execute("ALTER TABLE `{}` DROP PRIMARY KEY, "
+                       "ADD PRIMARY KEY (id)".format(table))
+    engine.execute("ALTER TABLE contactsearchindexcursor ADD FOREIGN KEY "
+                   "(transaction_id) REFERENCES transaction(id)")
+
+
+def partition_bounds(shard_id, table):
+    with session_scope_by_shard_id(shard_id, versioned=False) as db_session:
+        return [bound for _, bound in get_partitions(db_session, table)]
+
+
+def test_partitioned_transaction_tables(db, default_namespace, partitioned):
+    shard_id = default_namespace.id >> 48
+    now = datetime.now()
+    for table in TRANSACTION_TABLES:
+        bounds = partition_bounds(shard_id, table)
+        assert len(bounds) == PARTITION_DAYS_AHEAD + 2
+        assert bounds[-1] is None
+
+    # Partitions are added as days go by.
+    add_transaction_partitions(shard_id, now=now + timedelta(days=3))
+    bounds = partition_bounds(shard_id, "transaction")
+    assert len(bounds) == PARTITION_DAYS_AHEAD + 5
+    assert bounds[:-1] == range(bounds[0], bounds[0] + PARTITION_DAYS_AHEAD + 4)
+
+    # Old days are purged by dropping their partitions.
+    create_transaction(db, now, default_namespace.id)
+    create_transaction(db, now + timedelta(days=2), default_namespace.id)
+    db.session.commit()
+    purge_transactions(shard_id, days_ago=30, now=now + timedelta(days=31))
+    assert partition_bounds(shard_id, "transaction")[0] == bounds[1]
+    assert db.session.query(Transaction).filter(
+        Transaction.namespace_id == default_namespace.id).count() == 1
@@ -1,8 +1,17 @@
 import os
 import time
+from collections import OrderedDict
 from hashlib import sha256
 
+import gevent
+from gevent.event import AsyncResult
+from gevent.local import local
+from gevent.pool import Pool
+from gevent.queue import Queue
+from gevent.threadpool import ThreadPool
+
 from inbox.config import config
+from inbox.util.known_hashes import known_hashes
 from inbox.util.stats import statsd_client
 from nylas.logging import get_logger
 log = get_logger()
@@ -10,21 +19,68 @@ log = get_logger()
 # TODO: store AWS credentials in a better way.
 STORE_MSG_ON_S3 = config.get('STORE_MESSAGES_ON_S3', None)
 
+# Upload S3 blocks from a pool of background greenlets instead of in the
+# caller. See WriteBehindUploader.
+ASYNC_UPLOADS = config.get('BLOCKSTORE_ASYNC_UPLOADS', False)
+UPLOAD_QUEUE_SIZE = config.get('BLOCKSTORE_UPLOAD_QUEUE_SIZE', 100)
+UPLOAD_CONCURRENCY = config.get('BLOCKSTORE_UPLOAD_CONCURRENCY', 8)
+UPLOAD_ATTEMPTS = 3
+# How long (in seconds) a commit waits for the uploads it depends on.
+UPLOAD_BARRIER_TIMEOUT = 300
+
+# S3 deletes up to 1000 keys per DeleteObjects request; batches are sent
+# concurrently. Files on disk are unlinked from a thread pool, since
+# os.remove blocks the hub.
+DELETE_BATCH_SIZE = 1000
+DELETE_CONCURRENCY = config.get('BLOCKSTORE_DELETE_CONCURRENCY', 4)
+
+# Blocks of old mail can be moved to a cold tier (see move_to_cold_storage):
+# a separate, cheaper bucket or directory. Reads fall through to it.
+COLD_STORAGE_BUCKET_NAME = config.get('COLD_STORAGE_BUCKET_NAME')
+COLD_MSG_PARTS_DIRECTORY = config.get('COLD_MSG_PARTS_DIRECTORY')
+COLD_STORAGE = (COLD_STORAGE_BUCKET_NAME if STORE_MSG_ON_S3 else
+                COLD_MSG_PARTS_DIRECTORY)
+TIERING_CONCURRENCY = config.get('BLOCKSTORE_TIERING_CONCURRENCY', 8)
+
+# Pack blocks on disk into segment files rather than storing one file per
+# block. Blocks already stored as files are still read (and can be packed
+# with bin/compact-blockstore).
+DISK_SEGMENTS = config.get('BLOCKSTORE_DISK_SEGMENTS', False)
+
+# Recently read blocks are cached in memory (see BlockCache), and
+# get_many_from_blockstore fetches blocks concurrently.
+CACHE_SIZE = config.get('BLOCKSTORE_CACHE_SIZE', 64 * 1024 * 1024)
+GET_MANY_CONCURRENCY = config.get('BLOCKSTORE_GET_MANY_CONCURRENCY', 10)
+
 if STORE_MSG_ON_S3:
     from boto.s3.connection import S3Connection
     from boto.s3.key import Key
 else:
     from inbox.util.file import mkdirp
+    from inbox.util.segment_store import SegmentStore
+
+    _segment_stores = {}
 
-    def _data_file_directory(h):
-        return os.path.join(config.get_required('MSG_PARTS_DIRECTORY'),
-                            h[0], h[1], h[2], h[3], h[4], h[5])
+    def _get_segment_store(root=None):
+        root = root or config.get_required('MSG_PARTS_DIRECTORY')
+        if root not in _segment_stores:
+            _segment_stores[root] = SegmentStore(root)
+        return _segment_stores[root]
 
-    def _data_file_path(h):
-        return os.path.join(_data_file_directory(h), h)
+    def _data_file_directory(h, root=None):
+        root = root or config.get_required('MSG_PARTS_DIRECTORY')
+        return os.path.join(root, h[0], h[1], h[2], h[3], h[4], h[5])
 
+    def _data_file_path(h, root=None):
+        return os.path.join(_data_file_directory(h, root), h)
 
-def save_to_blockstore(data_sha256, data):
+
+def save_to_blockstore(data_sha256, data, repair=False):
+    """
+    Save a block. Blocks in known_hashes() aren't saved again, unless
+    `repair` is set, because the block was found missing.
+
+    """
     assert data is not None
     assert type(data) is not unicode
 
@@ -32,14 +88,27 @@ def save_to_blockstore(data_sha256, data):
         log.warning('Not saving 0-length data blob')
         return
 
-    if STORE_MSG_ON_S3:
+    if STORE_MSG_ON_S3 and not repair and data_sha256 in known_hashes():
+        return
+
+    if STORE_MSG_ON_S3 and ASYNC_UPLOADS:
+        _get_uploader().save(data_sha256, data)
+    elif STORE_MSG_ON_S3:
         _save_to_s3(data_sha256, data)
     else:
-        directory = _data_file_directory(data_sha256)
-        mkdirp(directory)
+        _save_to_disk(data_sha256, data)
+
+
+def _save_to_disk(data_sha256, data, root=None):
+    if DISK_SEGMENTS:
+        _get_segment_store(root).save(data_sha256, data)
+        return
 
-        with open(_data_file_path(data_sha256), 'wb') as f:
-            f.write(data)
+    directory = _data_file_directory(data_sha256, root)
+    mkdirp(directory)
+
+    with open(_data_file_path(data_sha256, root), 'wb') as f:
+        f.write(data)
 
 
 def _save_to_s3(data_sha256, data):
@@ -50,44 +119,267 @@ def _save_to_s3(data_sha256, data):
                        config.get('TEMP_MESSAGE_STORE_BUCKET_NAME'), data)
 
 
-def _save_to_s3_bucket(data_sha256, bucket_name, data):
+def _get_s3_bucket(bucket_name):
     assert 'AWS_ACCESS_KEY_ID' in config, 'Need AWS key!'
     assert 'AWS_SECRET_ACCESS_KEY' in config, 'Need AWS secret!'
-    start = time.time()
 
     # Boto pools connections at the class level
     conn = S3Connection(config.get('AWS_ACCESS_KEY_ID'),
                         config.get('AWS_SECRET_ACCESS_KEY'))
-    bucket = conn.get_bucket(bucket_name, validate=False)
+    return conn.get_bucket(bucket_name, validate=False)
+
+
+def _save_to_s3_bucket(data_sha256, bucket_name, data, bucket=None):
+    start = time.time()
+
+    if bucket is None:
+        bucket = _get_s3_bucket(bucket_name)
 
     # See if it already exists; if so, don't recreate.
     key = bucket.get_key(data_sha256)
     if key:
+        known_hashes().add(data_sha256)
         return
 
     key = Key(bucket)
     key.key = data_sha256
     key.set_contents_from_string(data)
+    known_hashes().add(data_sha256)
 
     end = time.time()
     latency_millis = (end - start) * 1000
     statsd_client.timing('s3_blockstore.save_latency', latency_millis)
 
 
+class WriteBehindUploader(object):
+    """
+    Uploads blocks to S3 from a pool of greenlets, so that saving a block
+    during sync doesn't wait on S3 round trips.
+
+    Blocks are queued in memory until uploaded; reads of a queued block are
+    served from the queue. When the queue is full, `save` blocks until an
+    uploader frees up a spot. Since database rows must never reference
+    blocks which didn't make it to S3, every commit first waits for the
+    uploads queued by the committing greenlet (see `wait`).
+
+    Parameters
+    ----------
+    bucket_name : str
+        The bucket to upload to.
+    queue_size : int
+        How many blocks may be waiting for upload.
+    concurrency : int
+        How many uploads may be in flight. Each uploader reuses its own S3
+        connection.
+
+    """
+
+    def __init__(self, bucket_name, queue_size=UPLOAD_QUEUE_SIZE,
+                 concurrency=UPLOAD_CONCURRENCY):
+        self.bucket_name = bucket_name
+        self.queue = Queue(maxsize=queue_size)
+        # hash -> (data, AsyncResult) for blocks queued or being uploaded.
+        self.pending = {}
+        # Per-greenlet {hash: AsyncResult} of uploads not yet waited for.
+        self._local = local()
+        self.uploaders = [gevent.spawn(self._upload_loop)
+                          for _ in range(concurrency)]
+
+    def _queued_by_current(self):
+        if not hasattr(self._local, 'results'):
+            self._local.results = {}
+        return self._local.results
+
+    def save(self, data_sha256, data):
+        if data_sha256 not in self.pending:
+            self.pending[data_sha256] = (data, AsyncResult())
+            start = time.time()
+            self.queue.put(data_sha256)
+            statsd_client.timing('s3_blockstore.upload_queue_wait',
+                                 (time.time() - start) * 1000)
+        self._queued_by_current()[data_sha256] = \
+            self.pending[data_sha256][1]
+
+    def get_pending(self, data_sha256):
+        """ The data for `data_sha256` if it's waiting for upload, else
+        None.
+        """
+        entry = self.pending.get(data_sha256)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def wait(self, timeout=UPLOAD_BARRIER_TIMEOUT):
+        """
+        Block until every upload queued by the current greenlet is done.
+        Raises the upload's exception if one failed, or gevent.Timeout.
+
+        """
+        results = self._queued_by_current()
+        while results:
+            _, result = results.popitem()
+            result.get(timeout=timeout)
+
+    def _upload_loop(self):
+        bucket = None
+        while True:
+            data_sha256 = self.queue.get()
+            data, result = self.pending[data_sha256]
+            for attempt in range(UPLOAD_ATTEMPTS):
+                try:
+                    if bucket is None:
+                        bucket = _get_s3_bucket(self.bucket_name)
+                    _save_to_s3_bucket(data_sha256, self.bucket_name, data,
+                                       bucket=bucket)
+                    result.set()
+                    break
+                except Exception as exc:
+                    log.warning('Error uploading block', sha256=data_sha256,
+                                attempt=attempt, error=exc)
+                    # The connection may be broken; reconnect next time.
+                    bucket = None
+                    gevent.sleep(2 ** attempt)
+            else:
+                statsd_client.incr('s3_blockstore.upload_failures')
+                result.set_exception(exc)
+            del self.pending[data_sha256]
+
+
+_uploader = None
+
+
+def _get_uploader():
+    global _uploader
+    if _uploader is None:
+        assert 'TEMP_MESSAGE_STORE_BUCKET_NAME' in config, \
+            'Need temp bucket name to store message data!'
+        _uploader = WriteBehindUploader(
+            config.get('TEMP_MESSAGE_STORE_BUCKET_NAME'))
+    return _uploader
+
+
+def wait_for_uploads():
+    """
+    Durability barrier: returns once the blocks saved by the current
+    greenlet are stored. Called before every database commit.
+
+    """
+    if _uploader is not None:
+        _uploader.wait()
+
+
+class BlockCache(object):
+    """
+    In-memory LRU cache of blocks, holding up to `size` bytes. Blocks are
+    immutable, so entries only need to be dropped when blocks are deleted.
+
+    """
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.used = 0
+        self.blocks = OrderedDict()
+
+    def get(self, data_sha256):
+        value = self.blocks.pop(data_sha256, None)
+        statsd_client.incr('blockstore.cache.{}'.format(
+            'hits' if value is not None else 'misses'))
+        if value is not None:
+            self.blocks[data_sha256] = value
+        return value
+
+    def add(self, data_sha256, value):
+        # A few large attachments shouldn't flush everything else.
+        if len(value) > self.size // 8 or data_sha256 in self.blocks:
+            return
+        self.blocks[data_sha256] = value
+        self.used += len(value)
+        while self.used > self.size and self.blocks:
+            _, evicted = self.blocks.popitem(last=False)
+            self.used -= len(evicted)
+
+    def discard(self, data_sha256):
+        value = self.blocks.pop(data_sha256, None)
+        if value is not None:
+            self.used -= len(value)
+
+
+_cache = BlockCache()
+
+
 def get_from_blockstore(data_sha256):
+    value = _get_local(data_sha256)
+    if value is not None:
+        return value
+
+    value, cold = _fetch(data_sha256)
+    # The cache is kept for recent mail, so blocks from the cold tier
+    # aren't cached.
+    if value is not None and not cold:
+        _cache.add(data_sha256, value)
+    return value
+
+
+def _get_local(data_sha256):
+    if _uploader is not None:
+        value = _uploader.get_pending(data_sha256)
+        if value is not None:
+            return value
+    return _cache.get(data_sha256)
+
+
+def _fetch(data_sha256):
+    """ Read a block from the blockstore, bypassing the cache. Returns the
+    data (or None) and whether it came from the cold tier. """
     if STORE_MSG_ON_S3:
         value = _get_from_s3(data_sha256)
     else:
         value = _get_from_disk(data_sha256)
 
+    cold = False
+    if value is None and COLD_STORAGE:
+        value = _get_from_cold_storage(data_sha256)
+        cold = True
+
     if value is None:
-        # The block may have expired.
+        # The block may have expired. Make sure it's saved again.
         log.warning('No data returned!')
-        return value
+        if STORE_MSG_ON_S3:
+            known_hashes().discard(data_sha256)
+        return None, cold
 
     assert data_sha256 == sha256(value).hexdigest(), \
         "Returned data doesn't match stored hash!"
-    return value
+    return value, cold
+
+
+def get_many_from_blockstore(data_sha256_hashes):
+    """
+    Fetch several blocks concurrently. Returns a dict of hash to data (or
+    None, if the block couldn't be found).
+
+    """
+    data_sha256_hashes = set(filter(None, data_sha256_hashes))
+    if len(data_sha256_hashes) <= 1:
+        return {h: get_from_blockstore(h) for h in data_sha256_hashes}
+
+    values = {h: _get_local(h) for h in data_sha256_hashes}
+    missing = [h for h, value in values.iteritems() if value is None]
+    if not missing:
+        return values
+
+    pool = _get_pool(GET_MANY_CONCURRENCY)
+    try:
+        fetched = pool.map(_fetch, missing)
+    finally:
+        pool.kill()
+    # Blocks are fetched from threads when stored on disk, so the cache,
+    # which isn't thread-safe, is only filled from here.
+    for data_sha256, (value, cold) in zip(missing, fetched):
+        values[data_sha256] = value
+        if value is not None and not cold:
+            _cache.add(data_sha256, value)
+    return values
 
 
 def _get_from_s3(data_sha256):
@@ -127,48 +419,143 @@ def _get_from_s3_bucket(data_sha256, bucket_name):
         log.warning('No key with name: {} returned!'.format(data_sha256))
         return
 
-    return key.get_contents_as_string()
+    data = key.get_contents_as_string()
+    known_hashes().add(data_sha256)
+    return data
 
 
-def _get_from_disk(data_sha256):
+def _get_from_disk(data_sha256, root=None):
     if not data_sha256:
         return None
 
+    value = _read_from_disk(data_sha256, root)
+    if value is None:
+        log.warning('No file with name: {}!'.format(data_sha256))
+    return value
+
+
+def _read_from_disk(data_sha256, root=None):
+    if DISK_SEGMENTS:
+        value = _get_segment_store(root).get(data_sha256)
+        if value is not None:
+            return value
+
     try:
-        with open(_data_file_path(data_sha256), 'rb') as f:
+        with open(_data_file_path(data_sha256, root), 'rb') as f:
             return f.read()
     except IOError:
-        log.warning('No file with name: {}!'.format(data_sha256))
-        return
+        return None
+
+
+def _get_from_cold_storage(data_sha256):
+    if STORE_MSG_ON_S3:
+        value = _get_from_s3_bucket(data_sha256, COLD_STORAGE_BUCKET_NAME)
+    else:
+        value = _get_from_disk(data_sha256, COLD_MSG_PARTS_DIRECTORY)
+    if value is not None:
+        statsd_client.incr('blockstore.cold_storage.reads')
+    return value
+
+
+def _get_pool(size):
+    # Reading and writing files blocks the hub, so it's done from threads.
+    # Segment stores aren't thread-safe, and S3 requests cooperate.
+    if STORE_MSG_ON_S3 or DISK_SEGMENTS:
+        return Pool(size)
+    return ThreadPool(size)
+
+
+def move_to_cold_storage(*data_sha256_hashes):
+    """
+    Move blocks from the blockstore to the cold tier. Blocks which aren't
+    in the blockstore (e.g. because they were already moved) are skipped.
+    Returns the hashes of the blocks moved.
+
+    Moved blocks aren't forgotten by known_hashes(): saving one again is
+    skipped, and reads find it in the cold tier.
+
+    """
+    assert COLD_STORAGE, 'No cold storage configured!'
+    data_sha256_hashes = set(filter(None, data_sha256_hashes))
+    if not data_sha256_hashes:
+        return []
+
+    if STORE_MSG_ON_S3:
+        hot = _get_s3_bucket(config.get('TEMP_MESSAGE_STORE_BUCKET_NAME'))
+        cold = _get_s3_bucket(COLD_STORAGE_BUCKET_NAME)
+
+    def move(data_sha256):
+        if STORE_MSG_ON_S3:
+            key = hot.get_key(data_sha256)
+            if not key:
+                return None
+            _save_to_s3_bucket(data_sha256, COLD_STORAGE_BUCKET_NAME,
+                               key.get_contents_as_string(), bucket=cold)
+        else:
+            data = _read_from_disk(data_sha256)
+            if data is None:
+                return None
+            _save_to_disk(data_sha256, data, COLD_MSG_PARTS_DIRECTORY)
+        return data_sha256
+
+    pool = _get_pool(TIERING_CONCURRENCY)
+    try:
+        moved = filter(None, pool.map(move, data_sha256_hashes))
+    finally:
+        pool.kill()
+
+    if STORE_MSG_ON_S3:
+        _delete_from_s3_bucket(moved,
+                               config.get('TEMP_MESSAGE_STORE_BUCKET_NAME'),
+                               forget_known_hashes=False)
+    else:
+        for data_sha256 in moved:
+            _delete_from_disk(data_sha256)
+    statsd_client.incr('blockstore.cold_storage.moved', len(moved))
+    return moved
 
 
-def _delete_from_s3_bucket(data_sha256_hashes, bucket_name):
+def _delete_from_s3_bucket(data_sha256_hashes, bucket_name,
+                           forget_known_hashes=True):
     data_sha256_hashes = filter(None, data_sha256_hashes)
     if not data_sha256_hashes:
         return None
 
-    assert 'AWS_ACCESS_KEY_ID' in config, 'Need AWS key!'
-    assert 'AWS_SECRET_ACCESS_KEY' in config, 'Need AWS secret!'
     start = time.time()
-
-    # Boto pools connections at the class level
-    conn = S3Connection(config.get('AWS_ACCESS_KEY_ID'),
-                        config.get('AWS_SECRET_ACCESS_KEY'))
-    bucket = conn.get_bucket(bucket_name, validate=False)
-
-    bucket.delete_keys([key for key in data_sha256_hashes], quiet=True)
+    bucket = _get_s3_bucket(bucket_name)
+    # Forget the hashes both before and after deleting, since a save racing
+    # with the deletion may find a block still there and remember it.
+    if forget_known_hashes:
+        known_hashes().discard(*data_sha256_hashes)
+
+    def delete_batch(keys):
+        result = bucket.delete_keys(keys, quiet=True)
+        if result.errors:
+            log.error('Error deleting from S3', bucket_name=bucket_name,
+                      errors=[(e.key, e.code) for e in result.errors])
+
+    pool = Pool(DELETE_CONCURRENCY)
+    for i in range(0, len(data_sha256_hashes), DELETE_BATCH_SIZE):
+        pool.spawn(delete_batch,
+                   data_sha256_hashes[i:i + DELETE_BATCH_SIZE])
+    pool.join(raise_error=True)
+    if forget_known_hashes:
+        known_hashes().discard(*data_sha256_hashes)
 
     end = time.time()
     latency_millis = (end - start) * 1000
     statsd_client.timing('s3_blockstore.delete_latency', latency_millis)
 
 
-def _delete_from_disk(data_sha256):
+def _delete_from_disk(data_sha256, root=None):
     if not data_sha256:
         return None
 
+    if DISK_SEGMENTS and _get_segment_store(root).delete(data_sha256):
+        return
+
     try:
-        os.remove(_data_file_path(data_sha256))
+        os.remove(_data_file_path(data_sha256, root))
     except OSError:
         log.warning('No file with name: {}!'.format(data_sha256))
 
@@ -176,9 +563,23 @@ def _delete_from_disk(data_sha256):
 def delete_from_blockstore(*data_sha256_hashes):
     log.info('deleting from blockstore', sha256=data_sha256_hashes)
 
+    for data_sha256 in data_sha256_hashes:
+        _cache.discard(data_sha256)
+
     if STORE_MSG_ON_S3:
         _delete_from_s3_bucket(data_sha256_hashes,
                                config.get('TEMP_MESSAGE_STORE_BUCKET_NAME'))
+        if COLD_STORAGE:
+            _delete_from_s3_bucket(data_sha256_hashes,
+                                   COLD_STORAGE_BUCKET_NAME)
     else:
-        for data_sha256 in data_sha256_hashes:
-            _delete_from_disk(data_sha256)
+        pool = _get_pool(DELETE_CONCURRENCY)
+        try:
+            for data_sha256 in data_sha256_hashes:
+                pool.spawn(_delete_from_disk, data_sha256)
+                if COLD_STORAGE:
+                    pool.spawn(_delete_from_disk, data_sha256,
+                               COLD_MSG_PARTS_DIRECTORY)
+            pool.join()
+        finally:
+            pool.kill()
@@ -0,0 +1,68 @@
+"""
+JSON encoding and decoding for JSON columns and API responses.
+
+Columns hold bson's extended JSON, which represents datetimes and other
+types JSON lacks as objects with $-prefixed keys. bson.json_util.dumps and
+loads build a new encoder or decoder on every call, and dumps walks the
+whole value in Python first. A JSONCodec builds them once, and only runs
+json_util's object hook on documents which have such keys; address lists
+and references never do.
+
+The json module a codec uses is set by JSON_CODEC. It must provide
+JSONEncoder and JSONDecoder classes, like simplejson; the default is the
+stdlib json module.
+
+"""
+from bson import json_util
+
+from inbox.config import config
+from nylas.logging import get_logger
+log = get_logger()
+
+
+class JSONCodec(object):
+
+    def __init__(self, module):
+        self.module = module
+        self.name = module.__name__
+        self._encoder = module.JSONEncoder(default=json_util.default)
+        self._decoder = module.JSONDecoder()
+        self._hook_decoder = module.JSONDecoder(
+            object_hook=json_util.object_hook)
+
+    def dumps(self, value):
+        try:
+            return self._encoder.encode(value)
+        except TypeError:
+            # json_util also encodes other iterables, such as sets, as
+            # lists.
+            return json_util.dumps(value)
+
+    def loads(self, value):
+        if '"$' in value:
+            return self._hook_decoder.decode(value)
+        return self._decoder.decode(value)
+
+
+def load_codec(name):
+    try:
+        module = __import__(name)
+    except ImportError:
+        log.warning('JSON codec not installed, using json', codec=name)
+        import json as module
+    return JSONCodec(module)
+
+
+_codec = load_codec(config.get('JSON_CODEC', 'json'))
+
+
+def get_codec():
+    return _codec
+
+
+def set_codec(codec):
+    """ Use `codec` for JSON columns and API responses from now on. Returns
+    the previous codec. """
+    global _codec
+    previous, _codec = _codec, codec
+    return previous
@@ -0,0 +1,267 @@
+"""
+Membership filter for blocks known to be in the S3 blockstore.
+
+The same attachments and messages (newsletters, forwarded files, signature
+images) get saved over and over across namespaces. Every save used to pay
+for an S3 HEAD request to find that out. KnownHashes remembers the hashes
+of blocks recently saved to or read from S3, so that saving them again can
+skip both the HEAD and the PUT.
+
+Hashes are kept in bloom filters: a fixed amount of memory per
+BLOCKSTORE_KNOWN_HASHES_CAPACITY hashes, with a false positive rate of
+BLOCKSTORE_KNOWN_HASHES_ERROR_RATE. Filters are rotated when full or after
+BLOCKSTORE_KNOWN_HASHES_TTL seconds, with the previous generation still
+consulted, so stale entries age out. The filters are mirrored to redis
+(KNOWN_HASHES_REDIS_HOSTNAME) so that all processes share them.
+
+A false positive or a stale entry means a block isn't saved, so hashes of
+deleted or missing blocks must be forgotten by every process. Bloom filters
+can't forget single entries, so such hashes are recorded as deleted in
+redis (with the time, for as long as filter entries may live), and every
+lookup checks that record and a shared epoch, which clear() bumps to make
+all processes drop their local filters, before trusting the filters. If the
+shared state can't be checked, hashes are treated as unknown. Without
+KNOWN_HASHES_REDIS_HOSTNAME, other processes' deletions couldn't be seen,
+so nothing is skipped. Saves which repair a missing block bypass the
+filters altogether.
+
+"""
+from __future__ import division
+import math
+import time
+
+from inbox.config import config
+from inbox.util.stats import statsd_client
+from nylas.logging import get_logger
+log = get_logger()
+
+CAPACITY = config.get('BLOCKSTORE_KNOWN_HASHES_CAPACITY', 1000000)
+ERROR_RATE = config.get('BLOCKSTORE_KNOWN_HASHES_ERROR_RATE', 1e-6)
+TTL = config.get('BLOCKSTORE_KNOWN_HASHES_TTL', 6 * 3600)
+REDIS_HOSTNAME = config.get('KNOWN_HASHES_REDIS_HOSTNAME')
+REDIS_DB = config.get('KNOWN_HASHES_REDIS_DB', 0)
+REDIS_KEY = 'blockstore-known-hashes'
+REDIS_DELETED_KEY = 'blockstore-known-hashes:deleted'
+REDIS_EPOCH_KEY = 'blockstore-known-hashes:epoch'
+
+
+def filter_size(capacity, error_rate):
+    """ The optimal number of bits and hash functions for a bloom filter
+    holding `capacity` items with a false positive rate of `error_rate`.
+    """
+    num_bits = int(math.ceil(-capacity * math.log(error_rate) /
+                             math.log(2) ** 2))
+    num_hashes = max(1, int(round(num_bits / capacity * math.log(2))))
+    return num_bits, num_hashes
+
+
+def bit_positions(data_sha256, num_bits, num_hashes):
+    # The hashes are already uniformly distributed, so two slices of them
+    # give us all the hash functions we need (Kirsch-Mitzenmacher).
+    h1 = int(data_sha256[:16], 16)
+    h2 = int(data_sha256[16:32], 16)
+    return [(h1 + i * h2) % num_bits for i in range(num_hashes)]
+
+
+class BloomFilter(object):
+
+    def __init__(self, capacity, error_rate):
+        self.num_bits, self.num_hashes = filter_size(capacity, error_rate)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def add(self, data_sha256):
+        for position in bit_positions(data_sha256, self.num_bits,
+                                      self.num_hashes):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, data_sha256):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in bit_positions(data_sha256, self.num_bits,
+                                                 self.num_hashes))
+
+
+class KnownHashes(object):
+    """
+    Two generations of bloom filters of block hashes, optionally mirrored
+    to redis.
+
+    Parameters
+    ----------
+    capacity : int
+        Hashes per generation.
+    error_rate : float
+        False positive rate of each generation.
+    ttl : int
+        Maximum age (in seconds) of a generation.
+    redis : redis.StrictRedis, optional
+        Where to share filters with other processes.
+
+    """
+
+    def __init__(self, capacity=CAPACITY, error_rate=ERROR_RATE, ttl=TTL,
+                 redis=None):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.ttl = ttl
+        self.redis = redis
+        self.num_bits, self.num_hashes = filter_size(capacity, error_rate)
+        # The shared epoch the local filters belong to.
+        self.epoch = None
+        self.clear_local()
+
+    def clear_local(self):
+        self.current = BloomFilter(self.capacity, self.error_rate)
+        self.previous = None
+        self.rotated_at = time.time()
+        # Hashes in the filters which turned out not to be stored.
+        self.missing = set()
+
+    def _maybe_rotate(self):
+        if (self.current.count >= self.capacity or
+                time.time() - self.rotated_at > self.ttl):
+            self.previous = self.current
+            self.current = BloomFilter(self.capacity, self.error_rate)
+            self.rotated_at = time.time()
+
+    def _redis_keys(self):
+        # Shared generations are aligned to wall clock time rather than
+        # rotated on capacity, so that all processes agree on them.
+        generation = int(time.time() // self.ttl)
+        return ['{}:{}'.format(REDIS_KEY, generation),
+                '{}:{}'.format(REDIS_KEY, generation - 1)]
+
+    def add(self, data_sha256):
+        self._maybe_rotate()
+        self.current.add(data_sha256)
+        self.missing.discard(data_sha256)
+        if self.redis is not None:
+            key = self._redis_keys()[0]
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                for position in bit_positions(data_sha256, self.num_bits,
+                                              self.num_hashes):
+                    pipe.setbit(key, position, 1)
+                pipe.expire(key, 2 * self.ttl)
+                pipe.zrem(REDIS_DELETED_KEY, data_sha256)
+                pipe.execute()
+            except Exception:
+                log.warning('Error adding to shared known hashes',
+                            exc_info=True)
+
+    def discard(self, *data_sha256_hashes):
+        """ Forget hashes, because their blocks were deleted or found
+        missing. """
+        self.missing.update(data_sha256_hashes)
+        if self.redis is None or not data_sha256_hashes:
+            return
+        now = time.time()
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for data_sha256 in data_sha256_hashes:
+                pipe.zadd(REDIS_DELETED_KEY, now, data_sha256)
+            # Entries older than any filter generation are no longer needed.
+            pipe.zremrangebyscore(REDIS_DELETED_KEY, '-inf',
+                                  now - 2 * self.ttl)
+            pipe.expire(REDIS_DELETED_KEY, 2 * self.ttl)
+            pipe.execute()
+        except Exception:
+            log.warning('Error discarding from shared known hashes',
+                        exc_info=True)
+
+    def _check_shared(self, data_sha256):
+        """ Whether local entries for `data_sha256` may be trusted: it isn't
+        recorded as deleted, and no clear() happened since the local filters
+        were filled. """
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.get(REDIS_EPOCH_KEY)
+            pipe.zscore(REDIS_DELETED_KEY, data_sha256)
+            epoch, deleted = pipe.execute()
+        except Exception:
+            log.warning('Error checking shared known hashes', exc_info=True)
+            return False
+        if epoch != self.epoch:
+            self.clear_local()
+            self.epoch = epoch
+        return deleted is None
+
+    def _in_redis(self, data_sha256):
+        positions = bit_positions(data_sha256, self.num_bits,
+                                  self.num_hashes)
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            keys = self._redis_keys()
+            for key in keys:
+                for position in positions:
+                    pipe.getbit(key, position)
+            bits = pipe.execute()
+        except Exception:
+            log.warning('Error checking shared known hashes', exc_info=True)
+            return False
+        return any(all(bits[i:i + len(positions)])
+                   for i in range(0, len(bits), len(positions)))
+
+    def __contains__(self, data_sha256):
+        if self.redis is not None and not self._check_shared(data_sha256):
+            known = False
+        else:
+            known = data_sha256 not in self.missing and (
+                data_sha256 in self.current or
+                (self.previous is not None and
+                 data_sha256 in self.previous))
+            if not known and self.redis is not None:
+                known = self._in_redis(data_sha256)
+                if known:
+                    self.current.add(data_sha256)
+        statsd_client.incr('s3_blockstore.known_hashes.{}'.format(
+            'hits' if known else 'misses'))
+        return known
+
+    def clear(self):
+        """ Forget all hashes, in every process. """
+        self.clear_local()
+        if self.redis is not None:
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                pipe.incr(REDIS_EPOCH_KEY)
+                pipe.delete(REDIS_DELETED_KEY, *self._redis_keys())
+                pipe.execute()
+            except Exception:
+                log.warning('Error clearing shared known hashes',
+                            exc_info=True)
+
+
+class NoKnownHashes(object):
+    """ Used without shared filters: every hash is unknown. """
+
+    def add(self, data_sha256):
+        pass
+
+    def discard(self, *data_sha256_hashes):
+        pass
+
+    def __contains__(self, data_sha256):
+        return False
+
+    def clear(self):
+        pass
+
+
+_known_hashes = None
+
+
+def known_hashes():
+    """ The process-wide KnownHashes. """
+    global _known_hashes
+    if _known_hashes is None:
+        if REDIS_HOSTNAME:
+            from redis import StrictRedis
+            redis = StrictRedis(host=REDIS_HOSTNAME,
+                                port=int(config.get('REDIS_PORT')),
+                                db=REDIS_DB)
+            _known_hashes = KnownHashes(redis=redis)
+        else:
+            _known_hashes = NoKnownHashes()
+    return _known_hashes
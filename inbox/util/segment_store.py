@@ -0,0 +1,438 @@
+"""
+Log-structured storage for the disk blockstore.
+
+Storing every block in its own file means millions of tiny files, which
+exhaust inodes, make backups crawl and cost a directory walk per read.
+Instead, blocks are appended to large segment files and found through an
+index of hash -> (segment, offset, length), kept in a SQLite database next
+to the segments so that all processes on a host share it.
+
+Each process appends to its own segment, and seals it and starts a new
+one once that's SEGMENT_SIZE bytes. Records are synced and indexed in
+batches: saves made while a batch is being written share the next fsync
+and index transaction. Index queries and syncing wait on the disk and on
+other processes' locks, so they run in the hub's threadpool rather than
+blocking every greenlet. Reads memory-map segments. Deleting a
+block only removes it from the index; `compact` reclaims the space by
+copying the live blocks of mostly-dead sealed segments to a new segment.
+Segments whose writer exited without sealing them are sealed by `compact`.
+
+Records in a segment are a header (the block's hash and length) followed
+by the block, so segments are self-describing.
+
+"""
+import errno
+import mmap
+import os
+import re
+import socket
+import sqlite3
+import struct
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import gevent
+from gevent.event import AsyncResult
+from gevent.lock import RLock
+
+from inbox.config import config
+from nylas.logging import get_logger
+log = get_logger()
+
+SEGMENT_SIZE = config.get('BLOCKSTORE_SEGMENT_SIZE', 256 * 1024 * 1024)
+# Mapped segments hold a file descriptor each.
+MAX_MAPPED_SEGMENTS = 64
+# Unsealed segments are only sealed by `compact` if their writer has exited
+# and they haven't been written to for this long.
+IDLE_SEGMENT_AGE = 86400
+# SQLite limits the number of parameters in a statement.
+QUERY_CHUNK_SIZE = 500
+
+HEADER = struct.Struct('<64sQ')
+HASH_PATTERN = re.compile('^[0-9a-f]{64}$')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS block (
+    data_sha256 TEXT PRIMARY KEY,
+    segment TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_block_segment ON block (segment);
+CREATE TABLE IF NOT EXISTS segment (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL DEFAULT 0,
+    live INTEGER NOT NULL DEFAULT 0,
+    sealed INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _chunks(items, size=QUERY_CHUNK_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class SegmentStore(object):
+    """
+    Blocks packed into segment files under `root`/segments.
+
+    Parameters
+    ----------
+    root : str
+        The blockstore directory.
+    segment_size : int
+        Size (in bytes) after which a process starts a new segment.
+
+    """
+
+    def __init__(self, root, segment_size=SEGMENT_SIZE):
+        self.directory = os.path.join(root, 'segments')
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.segment_size = segment_size
+        self.lock = RLock()
+        self.pid = None
+        self.segment = None
+        self.maps = OrderedDict()
+        # hash -> (data, segment, offset, AsyncResult) of records appended
+        # but not yet synced and indexed.
+        self.pending = OrderedDict()
+        self.flushing = False
+        # Segments rolled over from, which are sealed once their records
+        # are indexed.
+        self.rolled = []
+
+        # Only used under `lock`, but from threadpool threads.
+        self.db = sqlite3.connect(
+            os.path.join(self.directory, 'index.sqlite'), timeout=60,
+            isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+
+    def _path(self, segment):
+        return os.path.join(self.directory, segment)
+
+    def _execute(self, statement, *args):
+        return self.db.execute(statement, args)
+
+    def _blocking(self, function, *args):
+        return gevent.get_hub().threadpool.apply(function, args)
+
+    @contextmanager
+    def _transaction(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    def _writer(self, record_size):
+        # Segments belong to a single process, and forked children start
+        # their own.
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.segment = None
+        if (self.segment is not None and self.written and
+                self.written + record_size > self.segment_size):
+            self._blocking(self._sync)
+            self.file.close()
+            self.rolled.append(self.segment)
+            self.segment = None
+        if self.segment is None:
+            self.segment = '{}-{}-{}.seg'.format(
+                socket.gethostname(), self.pid, uuid.uuid4().hex)
+            self._blocking(self._execute,
+                           'INSERT INTO segment (name) VALUES (?)',
+                           self.segment)
+            self.file = open(self._path(self.segment), 'ab')
+            self.written = 0
+        return self.segment
+
+    def _seal_rolled(self):
+        for segment in self.rolled:
+            self._execute('UPDATE segment SET sealed = 1 WHERE name = ?',
+                          segment)
+        self.rolled = []
+
+    def _append(self, data_sha256, data):
+        """ Append a record, returning its segment and the offset of its
+        data. Call _sync before indexing it. """
+        segment = self._writer(HEADER.size + len(data))
+        offset = self.written
+        self.file.write(HEADER.pack(str(data_sha256), len(data)))
+        self.file.write(data)
+        self.written += HEADER.size + len(data)
+        return segment, offset + HEADER.size
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def _index(self, data_sha256, segment, offset, length, previous=None):
+        """ Point the index at a record just appended, within a transaction.
+        If `previous` is given, only if the block is still in that segment.
+        Returns whether the index was updated; otherwise the record is dead.
+        """
+        record_size = HEADER.size + length
+        if previous is None:
+            indexed = self._execute(
+                'INSERT OR IGNORE INTO block VALUES (?, ?, ?, ?)',
+                data_sha256, segment, offset, length).rowcount
+        else:
+            indexed = self._execute(
+                'UPDATE block SET segment = ?, offset = ? '
+                'WHERE data_sha256 = ? AND segment = ?',
+                segment, offset, data_sha256, previous).rowcount
+        self._execute('UPDATE segment SET size = size + ?, '
+                      'live = live + ? WHERE name = ?', record_size,
+                      record_size if indexed else 0, segment)
+        return bool(indexed)
+
+    def save(self, data_sha256, data):
+        with self.lock:
+            pending = self.pending.get(data_sha256)
+            if pending is None:
+                if self._blocking(self._contains, data_sha256):
+                    return
+                segment, offset = self._append(data_sha256, data)
+                pending = self.pending[data_sha256] = (
+                    data, segment, offset, AsyncResult())
+        if not self.flushing:
+            self._flush()
+        pending[3].get()
+
+    def _flush(self):
+        """ Sync and index pending records, a batch at a time, until there
+        are none left. """
+        self.flushing = True
+        try:
+            while self.pending:
+                with self.lock:
+                    batch, self.pending = self.pending, OrderedDict()
+                    try:
+                        lost = self._blocking(self._sync_and_index, batch)
+                    except Exception as exc:
+                        for _, _, _, result in batch.values():
+                            result.set_exception(exc)
+                        continue
+                    if self.segment in lost:
+                        self.file.close()
+                        self.segment = None
+                    for data_sha256, (data, segment, _, result) in \
+                            batch.items():
+                        if segment not in lost:
+                            result.set()
+                            continue
+                        # Append again, to a segment of our own.
+                        segment, offset = self._append(data_sha256, data)
+                        self.pending[data_sha256] = (data, segment, offset,
+                                                     result)
+        finally:
+            self.flushing = False
+
+    def _sync_and_index(self, batch):
+        """ Sync the current segment and index `batch` in one transaction.
+        Returns the segments which were sealed or removed under us; records
+        appended to them aren't indexed, since the index wouldn't find
+        them. Segments only get sealed under a running writer by hand. """
+        self._sync()
+        segments = set(segment for _, segment, _, _ in batch.values())
+        with self._transaction():
+            open_segments = set()
+            for chunk in _chunks(segments):
+                open_segments.update(name for name, in self._execute(
+                    'SELECT name FROM segment WHERE NOT sealed AND name '
+                    'IN ({})'.format(', '.join('?' * len(chunk))), *chunk))
+            lost = segments - open_segments
+            for data_sha256, (data, segment, offset, _) in batch.items():
+                if segment not in lost:
+                    self._index(data_sha256, segment, offset, len(data))
+            self._seal_rolled()
+        if lost:
+            log.warning('Blockstore segments sealed under their writer',
+                        segments=list(lost))
+        return lost
+
+    def __contains__(self, data_sha256):
+        with self.lock:
+            return self._blocking(self._contains, data_sha256)
+
+    def _contains(self, data_sha256):
+        return self._execute('SELECT 1 FROM block WHERE data_sha256 = ?',
+                             data_sha256).fetchone() is not None
+
+    def _map(self, segment, end):
+        m = self.maps.pop(segment, None)
+        if m is None or len(m) < end:
+            # Not mapped yet, or mapped before the block was appended.
+            if m is not None:
+                m.close()
+            with open(self._path(segment), 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.maps[segment] = m
+        while len(self.maps) > MAX_MAPPED_SEGMENTS:
+            self.maps.popitem(last=False)[1].close()
+        return m
+
+    def _unmap(self, segment):
+        m = self.maps.pop(segment, None)
+        if m is not None:
+            m.close()
+
+    def get(self, data_sha256):
+        with self.lock:
+            return self._blocking(self._get, data_sha256)
+
+    def _get(self, data_sha256):
+        for attempt in range(2):
+            row = self._execute(
+                'SELECT segment, offset, length FROM block '
+                'WHERE data_sha256 = ?', data_sha256).fetchone()
+            if row is None:
+                return None
+            segment, offset, length = row
+            try:
+                m = self._map(segment, offset + length)
+                if len(m) >= offset + length:
+                    return m[offset:offset + length]
+            except (IOError, OSError, ValueError):
+                # The segment was compacted since we looked the block up;
+                # it has moved.
+                self._unmap(segment)
+        log.warning('Block missing from segment', sha256=data_sha256,
+                    segment=segment)
+        return None
+
+    def delete(self, *data_sha256_hashes):
+        """ Delete blocks, returning the hashes of those that were found.
+        """
+        with self.lock:
+            return self._blocking(self._delete, data_sha256_hashes)
+
+    def _delete(self, data_sha256_hashes):
+        deleted = []
+        for chunk in _chunks(set(data_sha256_hashes)):
+            placeholders = ', '.join('?' * len(chunk))
+            rows = self._execute(
+                'SELECT data_sha256, segment, length FROM block '
+                'WHERE data_sha256 IN ({})'.format(placeholders),
+                *chunk).fetchall()
+            if not rows:
+                continue
+            freed = {}
+            for data_sha256, segment, length in rows:
+                freed[segment] = (freed.get(segment, 0) +
+                                  HEADER.size + length)
+            with self._transaction():
+                self._execute('DELETE FROM block WHERE data_sha256 '
+                              'IN ({})'.format(placeholders), *chunk)
+                for segment, size in freed.items():
+                    self._execute('UPDATE segment SET live = live - ? '
+                                  'WHERE name = ?', size, segment)
+            deleted.extend(row[0] for row in rows)
+        return deleted
+
+    def compact(self, min_dead_ratio=0.5):
+        """
+        Copy the live blocks of sealed segments which are at least
+        `min_dead_ratio` dead to a new segment, and delete them.
+
+        """
+        reclaimed = 0
+        with self.lock:
+            self._seal_abandoned()
+            segments = self._execute(
+                'SELECT name, size, live FROM segment WHERE sealed'
+            ).fetchall()
+            for name, size, live in segments:
+                if not size or float(size - live) / size < min_dead_ratio:
+                    continue
+                try:
+                    self._compact_segment(name)
+                except (IOError, OSError, ValueError):
+                    log.error('Error compacting segment', segment=name,
+                              exc_info=True)
+                    continue
+                reclaimed += size - live
+        log.info('Compacted blockstore segments', directory=self.directory,
+                 reclaimed=reclaimed)
+        return reclaimed
+
+    def _seal_abandoned(self):
+        """ Seal this host's segments whose writer has exited, once they've
+        been idle for IDLE_SEGMENT_AGE. """
+        prefix = socket.gethostname() + '-'
+        for name, in self._execute(
+                'SELECT name FROM segment WHERE NOT sealed').fetchall():
+            if not name.startswith(prefix):
+                continue
+            pid = int(name[len(prefix):].split('-', 1)[0])
+            path = self._path(name)
+            if pid == os.getpid() or _process_exists(pid):
+                continue
+            if (os.path.exists(path) and
+                    time.time() - os.path.getmtime(path) < IDLE_SEGMENT_AGE):
+                continue
+            self._execute('UPDATE segment SET sealed = 1 WHERE name = ?',
+                          name)
+
+    def _compact_segment(self, name):
+        blocks = self._execute(
+            'SELECT data_sha256, offset, length FROM block '
+            'WHERE segment = ?', name).fetchall()
+        copies = []
+        for data_sha256, offset, length in blocks:
+            data = self._map(name, offset + length)[offset:offset + length]
+            segment, new_offset = self._append(data_sha256, data)
+            copies.append((data_sha256, segment, new_offset, length))
+        if copies:
+            self._sync()
+        with self._transaction():
+            for data_sha256, segment, new_offset, length in copies:
+                # If the block was deleted meanwhile, its copy is dead.
+                self._index(data_sha256, segment, new_offset, length,
+                            previous=name)
+            self._seal_rolled()
+        self._execute('DELETE FROM segment WHERE name = ?', name)
+        self._unmap(name)
+        try:
+            os.remove(self._path(name))
+        except OSError:
+            pass
+
+    def pack_files(self, root, data_file_path):
+        """
+        Move blocks stored as individual files under `root` (at
+        `data_file_path(hash)`) into segments.
+
+        """
+        packed = 0
+        for directory, _, filenames in os.walk(root):
+            if directory.startswith(self.directory):
+                continue
+            for filename in filenames:
+                if not HASH_PATTERN.match(filename):
+                    continue
+                path = data_file_path(filename)
+                with open(path, 'rb') as f:
+                    self.save(filename, f.read())
+                os.remove(path)
+                packed += 1
+        log.info('Packed blockstore files into segments', root=root,
+                 packed=packed)
+        return packed
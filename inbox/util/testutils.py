@@ -52,7 +52,9 @@ def setup_test_db():
         for shard in host['SHARDS']:
             key = shard['ID']
             engine = engine_manager.engines[key]
-            init_db(engine, key)
+            # Transactions are purged by deleting rows, unless the tests
+            # partition the tables themselves.
+            init_db(engine, key, partition_transactions=False)
 
 
 class MockAnswer(object):
@@ -0,0 +1,46 @@
+"""add blobreference table
+
+Revision ID: 4f3a6ab2b8d1
+Revises: 36ce9c8635ef
+Create Date: 2026-10-18 10:12:41.118213
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4f3a6ab2b8d1'
+down_revision = '36ce9c8635ef'
+
+from alembic import op, context
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+def upgrade():
+    shard_id = int(context.get_x_argument(as_dictionary=True).get('shard_id'))
+
+    op.create_table(
+        'blobreference',
+        sa.Column('id', sa.BigInteger(), nullable=False),
+        sa.Column('created_at', sa.DateTime(),
+                  server_default=sa.func.now(), nullable=False),
+        sa.Column('data_sha256', mysql.VARCHAR(64, charset='ascii'),
+                  nullable=False),
+        sa.Column('refcount', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('data_sha256')
+    )
+    op.create_index('ix_blobreference_created_at', 'blobreference',
+                    ['created_at'], unique=False)
+
+    conn = op.get_bind()
+    increment = (shard_id << 48) + 1
+    conn.execute('ALTER TABLE blobreference AUTO_INCREMENT={}'.
+                 format(increment))
+
+    op.create_index('ix_block_data_sha256', 'block', ['data_sha256'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_block_data_sha256', table_name='block')
+    op.drop_table('blobreference')
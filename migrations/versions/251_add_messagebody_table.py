@@ -0,0 +1,45 @@
+"""add messagebody table
+
+Revision ID: 2c7c5b6e1d3a
+Revises: 4f3a6ab2b8d1
+Create Date: 2026-10-18 14:03:27.551102
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2c7c5b6e1d3a'
+down_revision = '4f3a6ab2b8d1'
+
+from alembic import op, context
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+def upgrade():
+    shard_id = int(context.get_x_argument(as_dictionary=True).get('shard_id'))
+
+    op.create_table(
+        'messagebody',
+        sa.Column('id', sa.BigInteger(), nullable=False),
+        sa.Column('created_at', sa.DateTime(),
+                  server_default=sa.func.now(), nullable=False),
+        sa.Column('message_id', sa.BigInteger(), nullable=False),
+        sa.Column('data', mysql.LONGBLOB(), nullable=True),
+        sa.Column('data_sha256', mysql.VARCHAR(64, charset='ascii'),
+                  nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('message_id')
+    )
+    op.create_index('ix_messagebody_created_at', 'messagebody',
+                    ['created_at'], unique=False)
+    op.create_index('ix_messagebody_data_sha256', 'messagebody',
+                    ['data_sha256'], unique=False)
+
+    conn = op.get_bind()
+    increment = (shard_id << 48) + 1
+    conn.execute('ALTER TABLE messagebody AUTO_INCREMENT={}'.
+                 format(increment))
+
+
+def downgrade():
+    op.drop_table('messagebody')
@@ -0,0 +1,72 @@
+"""partition transaction tables by day
+
+Partitions `transaction` and `accounttransaction` by RANGE on
+TO_DAYS(created_at), so that purge_transactions can drop old days instead
+of deleting them row by row. The existing rows go into a single partition
+for everything up to today; a week of daily partitions is created ahead,
+and after that purge_transactions keeps adding them.
+
+MySQL requires the partitioning column in every unique key, so the primary
+keys become (id, created_at), and partitioned tables can't be referenced by
+foreign keys, so contactsearchindexcursor's is dropped.
+
+This rebuilds both tables. On large shards, run the equivalent ALTERs with
+an online schema change tool instead.
+
+Revision ID: 3e1f0c9a7b2d
+Revises: 2c7c5b6e1d3a
+Create Date: 2026-10-18 16:21:09.340127
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3e1f0c9a7b2d'
+down_revision = '2c7c5b6e1d3a'
+
+from datetime import date
+
+from alembic import op
+
+TABLES = ('transaction', 'accounttransaction')
+DAYS_AHEAD = 7
+
+
+def partition_name(bound):
+    # Partitions are named for the day they hold, the one before their
+    # bound. TO_DAYS counts from year 0.
+    return 'p{:%Y%m%d}'.format(date.fromordinal(bound - 1 - 365))
+
+
+def upgrade():
+    conn = op.get_bind()
+
+    for constraint_name, in conn.execute(
+            '''SELECT constraint_name FROM information_schema.key_column_usage
+               WHERE table_name='contactsearchindexcursor'
+               AND referenced_table_name='transaction'
+               AND constraint_schema=DATABASE()''').fetchall():
+        conn.execute('ALTER TABLE contactsearchindexcursor '
+                     'DROP FOREIGN KEY {}'.format(constraint_name))
+
+    today, = conn.execute('SELECT TO_DAYS(NOW())').fetchone()
+    partitions = ', '.join(
+        'PARTITION {} VALUES LESS THAN ({})'.format(
+            partition_name(today + i + 1), today + i + 1)
+        for i in range(DAYS_AHEAD + 1))
+    for table in TABLES:
+        conn.execute('ALTER TABLE `{}` DROP PRIMARY KEY, '
+                     'ADD PRIMARY KEY (id, created_at)'.format(table))
+        conn.execute('ALTER TABLE `{}` PARTITION BY RANGE (TO_DAYS(created_at)) '
+                     '({}, PARTITION pmax VALUES LESS THAN MAXVALUE)'.
+                     format(table, partitions))
+
+
+def downgrade():
+    conn = op.get_bind()
+    for table in TABLES:
+        conn.execute('ALTER TABLE `{}` REMOVE PARTITIONING'.format(table))
+        conn.execute('ALTER TABLE `{}` DROP PRIMARY KEY, '
+                     'ADD PRIMARY KEY (id)'.format(table))
+    conn.execute('ALTER TABLE contactsearchindexcursor ADD CONSTRAINT '
+                 'contactsearchindexcursor_ibfk_1 FOREIGN KEY (transaction_id) '
+                 'REFERENCES transaction(id)')